@@ -0,0 +1,9 @@
+"""
+Benchmarks for the EMDS data structures and serializers. These are not run
+as part of the unit tests. Each module may be ran directly, for example::
+
+    python -m emds.benchmarks.memory
+    python -m emds.benchmarks.throughput 1000 100000
+
+The data they run on comes from :py:mod:`emds.benchmarks.generator`.
+"""
@@ -0,0 +1,156 @@
+"""
+Seeded generators of realistic market data, for the benchmarks (and any
+other load testing). The same seed always produces the same data.
+
+Orders and history entries are spread out over region+item combos in about
+the same way as a full-universe snapshot, with a configurable fraction of
+rowsets having a null ``regionID``. Unified messages can be generated with
+their columns in the standard order, or shuffled.
+"""
+import random
+import datetime
+from emds.compat import json
+from emds.common_utils import UTC_TZINFO
+from emds.formats.unified import history, orders
+from emds.formats.unified.unified_utils import gen_iso_datetime_str
+
+# Roughly how many orders land in each region+item combo.
+ORDERS_PER_GROUP = 200
+# How many regions there are to spread data over.
+NUM_REGIONS = 67
+
+_BASE_DTIME = datetime.datetime(2012, 6, 1, tzinfo=UTC_TZINFO)
+_GENERATED_AT = _BASE_DTIME + datetime.timedelta(days=30)
+
+
+def iter_order_kwargs(num_orders, seed=0):
+    """
+    Generates MarketOrder kwargs for ``num_orders`` orders.
+
+    .. note:: This is a generator!
+
+    :param int num_orders: How many orders to generate.
+    :keyword int seed: The random seed.
+    :rtype: generator
+    :returns: Generates dicts of MarketOrder kwargs.
+    """
+    rand = random.Random(seed)
+    for order_id in xrange(num_orders):
+        group = order_id // ORDERS_PER_GROUP
+        volume_entered = rand.randint(1, 100000)
+        yield dict(
+            order_id=2000000000 + order_id,
+            is_bid=rand.random() < 0.4,
+            region_id=10000001 + (group % NUM_REGIONS),
+            solar_system_id=30000001 + rand.randint(0, 5000),
+            station_id=60000001 + rand.randint(0, 5000),
+            type_id=34 + (group // NUM_REGIONS),
+            price=round(rand.uniform(0.01, 1000000000.0), 2),
+            volume_entered=volume_entered,
+            volume_remaining=rand.randint(1, volume_entered),
+            minimum_volume=1,
+            order_issue_date=_BASE_DTIME + datetime.timedelta(
+                seconds=rand.randint(0, 30 * 86400)),
+            order_duration=90,
+            order_range=32767,
+            generated_at=_GENERATED_AT,
+        )
+
+def _gen_order_row(rand, order_id):
+    """
+    Returns a dict of Unified order column names to values.
+    """
+    volume_entered = rand.randint(1, 100000)
+    return {
+        'price': round(rand.uniform(0.01, 1000000000.0), 2),
+        'volRemaining': rand.randint(1, volume_entered),
+        'range': rand.choice((-1, 0, 5, 10, 32767)),
+        'orderID': order_id,
+        'volEntered': volume_entered,
+        'minVolume': 1,
+        'bid': rand.random() < 0.4,
+        'issueDate': gen_iso_datetime_str(_BASE_DTIME + datetime.timedelta(
+            seconds=rand.randint(0, 30 * 86400))),
+        'duration': 90,
+        'stationID': 60000001 + rand.randint(0, 5000),
+        # Some uploaders leave this out.
+        'solarSystemID': (
+            30000001 + rand.randint(0, 5000)
+            if rand.random() < 0.9 else None),
+    }
+
+def _gen_history_row(rand, day):
+    """
+    Returns a dict of Unified history column names to values.
+    """
+    average = round(rand.uniform(0.01, 1000000.0), 2)
+    return {
+        'date': gen_iso_datetime_str(
+            _BASE_DTIME - datetime.timedelta(days=day)),
+        'orders': rand.randint(1, 5000),
+        'quantity': rand.randint(1, 10000000),
+        'low': round(average * rand.uniform(0.5, 1.0), 2),
+        'high': round(average * rand.uniform(1.0, 1.5), 2),
+        'average': average,
+    }
+
+def generate_message(result_type='orders', num_rowsets=10,
+                     rows_per_rowset=200, seed=0, null_region_ratio=0.05,
+                     shuffle_columns=False):
+    """
+    Generates a Unified Uploader message.
+
+    :keyword str result_type: ``orders`` or ``history``.
+    :keyword int num_rowsets: How many region+item rowsets to include.
+    :keyword int rows_per_rowset: How many rows each rowset has.
+    :keyword int seed: The random seed.
+    :keyword float null_region_ratio: The fraction of rowsets with a null
+        ``regionID``.
+    :keyword bool shuffle_columns: If True, the columns are put in a random
+        (seeded) order, rather than the standard one.
+    :rtype: str
+    :returns: The message, as JSON.
+    """
+    rand = random.Random(seed)
+    if result_type == 'orders':
+        columns = list(orders.STANDARD_ENCODED_COLUMNS)
+    elif result_type == 'history':
+        columns = list(history.STANDARD_ENCODED_COLUMNS)
+    else:
+        raise ValueError('Unknown result type: %s' % result_type)
+    if shuffle_columns:
+        rand.shuffle(columns)
+
+    rowsets = []
+    order_id = 2000000000
+    for rowset_num in xrange(num_rowsets):
+        rows = []
+        for row_num in xrange(rows_per_rowset):
+            if result_type == 'orders':
+                row_dict = _gen_order_row(rand, order_id)
+                order_id += 1
+            else:
+                row_dict = _gen_history_row(rand, row_num)
+            rows.append([row_dict[column] for column in columns])
+
+        if rand.random() < null_region_ratio:
+            region_id = None
+        else:
+            region_id = 10000001 + (rowset_num % NUM_REGIONS)
+        rowsets.append({
+            'generatedAt': gen_iso_datetime_str(_GENERATED_AT),
+            'regionID': region_id,
+            # Unique per rowset, so that null regions don't collide.
+            'typeID': 34 + rowset_num,
+            'rows': rows,
+        })
+
+    return json.dumps({
+        'resultType': result_type,
+        'version': '0.1',
+        'uploadKeys': [{'name': 'emk', 'key': 'abc'}],
+        'generator': {'name': 'emds.benchmarks', 'version': '1.0'},
+        'currentTime': gen_iso_datetime_str(_GENERATED_AT),
+        'columns': columns,
+        'rowsets': rowsets,
+    })
@@ -0,0 +1,103 @@
+"""
+Measures how many bytes each :py:class:`emds.data_structures.MarketOrder`
+costs while held in a realistically sized
+:py:class:`emds.data_structures.MarketOrderList`.
+
+The "before" numbers come from a stand-in class that stores its attributes
+in a per-instance ``__dict__``, the way :py:class:`MarketOrder` did before it
+switched to ``__slots__``. Each variant is built in its own process so that
+the resident set size numbers don't bleed into one another.
+
+Usage::
+
+    python -m emds.benchmarks.memory [num_orders]
+
+Results are printed as JSON.
+"""
+import sys
+import resource
+import multiprocessing
+from emds.compat import json
+from emds.benchmarks.generator import iter_order_kwargs
+from emds.data_structures import MarketOrder, MarketOrderList
+
+# The number of orders to build if none is specified on the command line.
+DEFAULT_NUM_ORDERS = 1000000
+
+
+class DictMarketOrder(object):
+    """
+    Mimics the pre-``__slots__`` layout of :py:class:`MarketOrder`, where
+    every attribute lived in the instance's ``__dict__``.
+    """
+
+    def __init__(self, **kwargs):
+        for name in MarketOrder.__slots__:
+            setattr(self, name, kwargs[name])
+
+
+def _instance_bytes(obj):
+    """
+    Returns the size of the instance itself, plus its ``__dict__`` if it has
+    one. The attribute values are shared between both variants, so they are
+    left out here.
+    """
+    size = sys.getsizeof(obj)
+    obj_dict = getattr(obj, '__dict__', None)
+    if obj_dict is not None:
+        size += sys.getsizeof(obj_dict)
+    return size
+
+
+def _measure(order_class, num_orders, result_queue):
+    """
+    Builds a MarketOrderList out of ``num_orders`` instances of
+    ``order_class`` and reports the memory used. Meant to be ran in a child
+    process.
+    """
+    order_kwargs = list(iter_order_kwargs(num_orders))
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    order_list = MarketOrderList()
+    for kwargs in order_kwargs:
+        order_list.add_order(order_class(**kwargs))
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    instance_bytes = sum(
+        [_instance_bytes(order) for order in order_list.get_all_orders_ungrouped()])
+
+    result_queue.put({
+        'class': order_class.__name__,
+        'num_orders': num_orders,
+        'instance_bytes_per_order': instance_bytes / float(num_orders),
+        # ru_maxrss is in kilobytes on Linux.
+        'rss_bytes_per_order': (rss_after - rss_before) * 1024.0 / num_orders,
+    })
+
+
+def run(num_orders=DEFAULT_NUM_ORDERS):
+    """
+    Runs the benchmark for the dict-backed and slotted order classes.
+
+    :param int num_orders: The number of orders to put in each order list.
+    :rtype: dict
+    :returns: A dict with ``before`` and ``after`` measurements.
+    """
+    results = {}
+    for label, order_class in [('before', DictMarketOrder),
+                               ('after', MarketOrder)]:
+        result_queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(
+            target=_measure, args=(order_class, num_orders, result_queue))
+        proc.start()
+        results[label] = result_queue.get()
+        proc.join()
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        num_orders = int(sys.argv[1])
+    else:
+        num_orders = DEFAULT_NUM_ORDERS
+    print(json.dumps(run(num_orders)))
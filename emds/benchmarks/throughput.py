@@ -0,0 +1,187 @@
+"""
+Times the Unified serializers and the core MarketOrderList operations over
+generated data sets of various sizes.
+
+Each benchmark, at each size, runs in its own process, so that the peak
+memory numbers (``ru_maxrss``) are its own. Data is generated before the
+clock starts, but does count towards peak memory.
+
+Usage::
+
+    python -m emds.benchmarks.throughput [size [size ...]]
+
+Results are printed as a JSON list, with one entry per benchmark and size:
+
+* ``benchmark``: The benchmark's name.
+* ``rows``: How many orders or history entries were involved.
+* ``seconds``: How long a single pass over all of the rows took.
+* ``rows_per_sec``: ``rows / seconds``.
+* ``peak_rss_bytes``: The process's peak resident set size.
+
+If a benchmark fails (say, by running out of memory at the larger sizes),
+its entry has an ``error`` instead of the timings, and the rest carry on.
+"""
+import sys
+import resource
+import multiprocessing
+import traceback
+from Queue import Empty
+from timeit import default_timer
+from emds.compat import json
+from emds.benchmarks.generator import generate_message, iter_order_kwargs
+from emds.data_structures import MarketOrder, MarketOrderList
+from emds.formats import unified
+
+# The sizes to run each benchmark at, if none are given on the command line.
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+# How many rows go in each generated rowset.
+ROWS_PER_ROWSET = 200
+# len() is too quick to time once, so it's averaged over this many calls.
+LEN_CALLS = 1000
+# How often to check whether a benchmark's process is still alive, in
+# seconds.
+POLL_INTERVAL = 1.0
+
+
+def _gen_message(result_type, size, seed):
+    rows_per_rowset = min(size, ROWS_PER_ROWSET)
+    return generate_message(
+        result_type, num_rowsets=max(size // rows_per_rowset, 1),
+        rows_per_rowset=rows_per_rowset, seed=seed)
+
+def _gen_order_list(size, seed):
+    order_list = MarketOrderList()
+    for kwargs in iter_order_kwargs(size, seed):
+        order_list.add_order(MarketOrder(**kwargs))
+    return order_list
+
+def bench_parse_orders(size, seed):
+    message = _gen_message('orders', size, seed)
+    start = default_timer()
+    unified.parse_from_json(message)
+    return default_timer() - start
+
+def bench_parse_history(size, seed):
+    message = _gen_message('history', size, seed)
+    start = default_timer()
+    unified.parse_from_json(message)
+    return default_timer() - start
+
+def bench_encode_orders(size, seed):
+    order_list = _gen_order_list(size, seed)
+    start = default_timer()
+    unified.encode_to_json(order_list)
+    return default_timer() - start
+
+def bench_add_order(size, seed):
+    orders = [MarketOrder(**kwargs) for kwargs in iter_order_kwargs(size, seed)]
+    order_list = MarketOrderList()
+    start = default_timer()
+    for order in orders:
+        order_list.add_order(order)
+    return default_timer() - start
+
+def bench_contains(size, seed):
+    order_list = _gen_order_list(size, seed)
+    order_ids = [
+        order.order_id for order in order_list.get_all_orders_ungrouped()]
+    start = default_timer()
+    for order_id in order_ids:
+        order_id in order_list
+    return default_timer() - start
+
+def bench_len(size, seed):
+    order_list = _gen_order_list(size, seed)
+    start = default_timer()
+    for _ in xrange(LEN_CALLS):
+        len(order_list)
+    return (default_timer() - start) / LEN_CALLS
+
+#: Benchmark names, mapped to functions that take a size and a seed, and
+#: return the number of seconds a single pass took.
+BENCHMARKS = {
+    'parse_from_json:orders': bench_parse_orders,
+    'parse_from_json:history': bench_parse_history,
+    'encode_to_json:orders': bench_encode_orders,
+    'add_order': bench_add_order,
+    '__contains__': bench_contains,
+    '__len__': bench_len,
+}
+
+
+def _measure(name, size, seed, result_queue):
+    """
+    Runs a single benchmark, and reports the results. Meant to be ran in a
+    child process.
+    """
+    try:
+        seconds = BENCHMARKS[name](size, seed)
+    except Exception:
+        result_queue.put({
+            'benchmark': name,
+            'rows': size,
+            'error': traceback.format_exc(),
+        })
+        return
+    result_queue.put({
+        'benchmark': name,
+        'rows': size,
+        'seconds': seconds,
+        'rows_per_sec': size / seconds if seconds else None,
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_bytes':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+def _wait_for_result(name, size, proc, result_queue):
+    """
+    Waits for a benchmark's result. If its process dies without reporting
+    one (the OOM killer, for example), an error record is returned instead.
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            if not proc.is_alive():
+                break
+    # The result may have landed just before the process exited.
+    try:
+        return result_queue.get(timeout=POLL_INTERVAL)
+    except Empty:
+        return {
+            'benchmark': name,
+            'rows': size,
+            'error': 'Process exited with code %s.' % proc.exitcode,
+        }
+
+
+def run(sizes=DEFAULT_SIZES, names=None, seed=0):
+    """
+    Runs the benchmarks.
+
+    :keyword sizes: The numbers of rows to run each benchmark with.
+    :keyword names: The names of the benchmarks to run. Defaults to all of
+        :py:data:`BENCHMARKS`.
+    :keyword int seed: The random seed for the generated data.
+    :rtype: list
+    :returns: A list of result dicts.
+    """
+    results = []
+    for name in sorted(names or BENCHMARKS):
+        for size in sizes:
+            result_queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_measure, args=(name, size, seed, result_queue))
+            proc.start()
+            results.append(_wait_for_result(name, size, proc, result_queue))
+            proc.join()
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sizes = [int(size) for size in sys.argv[1:]]
+    else:
+        sizes = DEFAULT_SIZES
+    print(json.dumps(run(sizes)))
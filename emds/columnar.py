@@ -0,0 +1,414 @@
+"""
+Columnar (struct-of-arrays) counterparts to
+:py:class:`emds.data_structures.MarketItemsInRegionList` and
+:py:class:`emds.data_structures.HistoryItemsInRegionList`.
+
+Rather than holding a list of :py:class:`MarketOrder
+<emds.data_structures.MarketOrder>` or :py:class:`MarketHistoryEntry
+<emds.data_structures.MarketHistoryEntry>` objects, these store each field in
+its own contiguous :py:mod:`array`. Reductions over a column (``min()``,
+``max()``, ``sum()``) then run over machine values instead of attribute
+lookups, and order/history objects are only built when the container is
+iterated over.
+
+Datetime fields are stored as integer UNIX timestamps, and missing solar
+system IDs are stored as ``0``.
+"""
+import array
+import datetime
+from itertools import izip
+from emds.common_utils import check_for_naive_dtime, dtime_to_timestamp, \
+    timestamp_to_dtime
+from emds.data_structures import MarketOrder, MarketHistoryEntry
+
+def _get_int64_typecode():
+    """
+    Finds an array typecode that can hold 64-bit integers. Order IDs
+    overflow 32-bit ints, and Python 2's :py:mod:`array` lacks the ``q``
+    typecode, so use ``l`` where it is 64 bits wide.
+
+    :rtype: str
+    """
+    for typecode in ('q', 'l'):
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            # This typecode isn't supported on this version of Python.
+            pass
+    # Doubles represent integers exactly up to 2**53, which covers every ID
+    # and quantity that EVE hands out.
+    return 'd'
+
+# The typecode used for integer columns.
+INT64_TYPECODE = _get_int64_typecode()
+
+
+class _ColumnarItemsInRegionList(object):
+    """
+    Base class for the columnar region+item containers. Sub-classes define
+    the columns, and how to convert records to and from rows.
+    """
+
+    #: A tuple of (column name, array typecode) tuples. The column names
+    #: match the attribute names on the record class.
+    COLUMNS = ()
+
+    def __init__(self, region_id, type_id, generated_at):
+        """
+        :param int region_id: The region ID that the data set pertains to.
+        :param int type_id: The type ID of the item contained in the data
+            set.
+        :param datetime.datetime generated_at: When the data set was first
+            generated.
+        """
+        # This can be a None or an int.
+        self.region_id = int(region_id) if region_id else None
+        self.type_id = int(type_id)
+        if not isinstance(generated_at, datetime.datetime):
+            raise TypeError('generated_at should be a datetime.')
+        self.generated_at = check_for_naive_dtime(generated_at)
+        # The arrays, in the same order as COLUMNS.
+        self._column_arrays = [
+            array.array(typecode) for _, typecode in self.COLUMNS]
+        self._columns = dict(izip(
+            [name for name, _ in self.COLUMNS], self._column_arrays))
+        # Serialized copies of this region+item list, keyed by format name.
+        # Cleared whenever rows are added.
+        self._encoded_cache = {}
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of rows contained within the region list.
+        """
+        return len(self._column_arrays[0])
+
+    def __iter__(self):
+        """
+        Uses a generator to build and return a record object for each row.
+
+        .. note:: This is a generator!
+
+        :rtype: generator
+        """
+        row_to_record = self._row_to_record
+        for row in izip(*self._column_arrays):
+            yield row_to_record(row)
+
+    def _row_to_record(self, row):
+        """
+        Builds a record object from a tuple of column values.
+        """
+        raise NotImplementedError
+
+    def _record_to_row(self, record):
+        """
+        Returns a tuple of column values for the given record object.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def from_region_list(cls, region_list):
+        """
+        Builds a columnar copy of an existing region+item list.
+
+        :param region_list: The region+item list to copy.
+        :returns: A new instance of this class, containing the same records.
+        """
+        columnar = cls(
+            region_list.region_id, region_list.type_id,
+            region_list.generated_at)
+        columnar.extend(region_list)
+        return columnar
+
+    def get_column(self, name):
+        """
+        Returns the array backing a column. This is not a copy, so don't
+        modify it, or the columns will end up with different lengths.
+
+        :param str name: The column name. See :py:attr:`COLUMNS`.
+        :rtype: array.array
+        :raises: KeyError if there is no such column.
+        """
+        return self._columns[name]
+
+    def get_row(self, index):
+        """
+        Builds the record object for a single row.
+
+        :param int index: The row's index.
+        :raises: IndexError if the index is out of range.
+        """
+        return self._row_to_record(
+            tuple([column[index] for column in self._column_arrays]))
+
+    def extend(self, records):
+        """
+        Appends a number of record objects to the columns.
+
+        :param records: An iterable of record objects.
+        """
+        rows = [self._record_to_row(record) for record in records]
+        if rows:
+            self._extend_arrays(zip(*rows))
+
+    def extend_columns(self, columns):
+        """
+        Bulk-appends raw column values. This is the fastest way to fill the
+        container, particularly when the values are already in arrays of
+        the right typecode.
+
+        :param dict columns: A dict of column names to sequences of values.
+            Every column in :py:attr:`COLUMNS` must be present, and all
+            sequences must be the same length. Datetime columns take UNIX
+            timestamps.
+        :raises: ValueError if columns are missing or lengths differ.
+        """
+        try:
+            values = [columns[name] for name, _ in self.COLUMNS]
+        except KeyError as exc:
+            raise ValueError('Missing column: %s' % exc.args[0])
+        if len(set([len(column) for column in values])) > 1:
+            raise ValueError('All columns must be the same length.')
+        self._extend_arrays(values)
+
+    def _extend_arrays(self, values):
+        """
+        Extends each column array with the matching sequence in ``values``.
+        """
+        for column, column_values in izip(self._column_arrays, values):
+            if isinstance(column_values, array.array) and \
+               column_values.typecode != column.typecode:
+                # array.extend() only takes arrays of the same typecode.
+                column_values = column_values.tolist()
+            column.extend(column_values)
+        self._encoded_cache.clear()
+
+    def clear_encoded_cache(self):
+        """
+        Throws out any cached serialized copies of this region+item list.
+        This happens automatically when rows are added, but must be done by
+        hand after modifying a column in place.
+        """
+        self._encoded_cache.clear()
+
+    def __getstate__(self):
+        """
+        Cached serialized copies are left out of pickles. They are easily
+        rebuilt, and can be as large as the data itself.
+        """
+        state = self.__dict__.copy()
+        state['_encoded_cache'] = {}
+        return state
+
+
+class ColumnarItemsInRegionList(_ColumnarItemsInRegionList):
+    """
+    A columnar version of
+    :py:class:`emds.data_structures.MarketItemsInRegionList`. It may be added
+    to a :py:class:`MarketOrderList <emds.data_structures.MarketOrderList>`
+    via :py:meth:`add_group() <emds.data_structures.MarketOrderList.add_group>`.
+
+    Iterating yields newly built :py:class:`MarketOrder
+    <emds.data_structures.MarketOrder>` instances, so changes made to them
+    are not stored.
+    """
+
+    COLUMNS = (
+        ('order_id', INT64_TYPECODE),
+        ('is_bid', 'b'),
+        ('solar_system_id', INT64_TYPECODE),
+        ('station_id', INT64_TYPECODE),
+        ('price', 'd'),
+        ('volume_entered', INT64_TYPECODE),
+        ('volume_remaining', INT64_TYPECODE),
+        ('minimum_volume', INT64_TYPECODE),
+        ('order_issue_date', INT64_TYPECODE),
+        ('order_duration', INT64_TYPECODE),
+        ('order_range', INT64_TYPECODE),
+    )
+
+    def __init__(self, region_id, type_id, generated_at):
+        super(ColumnarItemsInRegionList, self).__init__(
+            region_id, type_id, generated_at)
+        # Maps order IDs to row indices. Built the first time it's needed.
+        self._row_index = None
+
+    def __contains__(self, item):
+        """
+        Used for checking whether an order ID is contained within the order list.
+
+        :param item: The MarketOrder or order ID to look for.
+        :type item: int or MarketOrder
+        :rtype: bool
+        :returns: True if the given order can be found, False if not.
+        """
+        if isinstance(item, MarketOrder):
+            order_id = item.order_id
+        else:
+            order_id = int(item)
+
+        return order_id in self._get_row_index()
+
+    @property
+    def orders(self):
+        """
+        A list of newly built :py:class:`MarketOrder
+        <emds.data_structures.MarketOrder>` instances, for compatibility
+        with :py:class:`MarketItemsInRegionList
+        <emds.data_structures.MarketItemsInRegionList>`.
+        """
+        return list(self)
+
+    def _get_row_index(self):
+        """
+        Returns the order ID to row index dict, building it if need be.
+        """
+        if self._row_index is None:
+            self._row_index = dict(izip(
+                self._columns['order_id'], xrange(len(self))))
+        return self._row_index
+
+    def _row_to_record(self, row):
+        (order_id, is_bid, solar_system_id, station_id, price,
+         volume_entered, volume_remaining, minimum_volume, order_issue_date,
+         order_duration, order_range) = row
+        return MarketOrder(
+            order_id=order_id,
+            is_bid=bool(is_bid),
+            region_id=self.region_id,
+            solar_system_id=solar_system_id,
+            station_id=station_id,
+            type_id=self.type_id,
+            price=price,
+            volume_entered=volume_entered,
+            volume_remaining=volume_remaining,
+            minimum_volume=minimum_volume,
+            order_issue_date=timestamp_to_dtime(order_issue_date),
+            order_duration=order_duration,
+            order_range=order_range,
+            generated_at=self.generated_at,
+        )
+
+    def _record_to_row(self, order):
+        return (
+            order.order_id,
+            order.is_bid,
+            order.solar_system_id or 0,
+            order.station_id,
+            order.price,
+            order.volume_entered,
+            order.volume_remaining,
+            order.minimum_volume,
+            dtime_to_timestamp(order.order_issue_date),
+            order.order_duration,
+            order.order_range,
+        )
+
+    def _extend_arrays(self, values):
+        start = len(self)
+        super(ColumnarItemsInRegionList, self)._extend_arrays(values)
+        if self._row_index is not None:
+            order_ids = self._columns['order_id']
+            for row in xrange(start, len(self)):
+                self._row_index[order_ids[row]] = row
+
+    def get_order(self, order_id):
+        """
+        Looks up an order by its order ID.
+
+        :param int order_id: The order ID to look for.
+        :rtype: MarketOrder or None
+        :returns: A newly built :py:class:`MarketOrder
+            <emds.data_structures.MarketOrder>`, or ``None`` if there is no
+            order with the given ID in this region+item list.
+        """
+        row = self._get_row_index().get(int(order_id))
+        if row is None:
+            return None
+        return self.get_row(row)
+
+    def get_order_ids(self):
+        """
+        :rtype: array.array
+        :returns: The order ID column.
+        """
+        return self._columns['order_id']
+
+    def add_order(self, order):
+        """
+        Adds a :py:class:`MarketOrder <emds.data_structures.MarketOrder>`
+        instance to this region+item list.
+
+        :param MarketOrder order: The order to add.
+        """
+        self.extend([order])
+
+
+class ColumnarHistoryItemsInRegionList(_ColumnarItemsInRegionList):
+    """
+    A columnar version of
+    :py:class:`emds.data_structures.HistoryItemsInRegionList`. It may be
+    added to a
+    :py:class:`MarketHistoryList <emds.data_structures.MarketHistoryList>`
+    via :py:meth:`add_group() <emds.data_structures.MarketHistoryList.add_group>`.
+
+    Iterating yields newly built :py:class:`MarketHistoryEntry
+    <emds.data_structures.MarketHistoryEntry>` instances, so changes made to
+    them are not stored.
+    """
+
+    COLUMNS = (
+        ('historical_date', INT64_TYPECODE),
+        ('num_orders', INT64_TYPECODE),
+        ('low_price', 'd'),
+        ('high_price', 'd'),
+        ('average_price', 'd'),
+        ('total_quantity', INT64_TYPECODE),
+    )
+
+    @property
+    def entries(self):
+        """
+        A list of newly built :py:class:`MarketHistoryEntry
+        <emds.data_structures.MarketHistoryEntry>` instances, for
+        compatibility with :py:class:`HistoryItemsInRegionList
+        <emds.data_structures.HistoryItemsInRegionList>`.
+        """
+        return list(self)
+
+    def _row_to_record(self, row):
+        (historical_date, num_orders, low_price, high_price, average_price,
+         total_quantity) = row
+        return MarketHistoryEntry(
+            type_id=self.type_id,
+            region_id=self.region_id,
+            historical_date=timestamp_to_dtime(historical_date),
+            num_orders=num_orders,
+            low_price=low_price,
+            high_price=high_price,
+            average_price=average_price,
+            total_quantity=total_quantity,
+            generated_at=self.generated_at,
+        )
+
+    def _record_to_row(self, entry):
+        return (
+            dtime_to_timestamp(entry.historical_date),
+            entry.num_orders,
+            entry.low_price,
+            entry.high_price,
+            entry.average_price,
+            entry.total_quantity,
+        )
+
+    def add_entry(self, entry):
+        """
+        Adds a :py:class:`MarketHistoryEntry
+        <emds.data_structures.MarketHistoryEntry>` instance to this
+        region+item list.
+
+        :param MarketHistoryEntry entry: The history entry to add.
+        """
+        self.extend([entry])
@@ -2,10 +2,13 @@
 Utilities that are generally useful throughout the whole package.
 """
 import pytz
+import calendar
 import datetime
 from emds.exceptions import NaiveDatetimeError
 
 UTC_TZINFO = pytz.timezone("UTC")
+# The UNIX epoch, used for converting to and from timestamps.
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC_TZINFO)
 
 def now_dtime_in_utc():
     """
@@ -47,4 +50,26 @@ def check_for_naive_dtime(dtime):
             "is required (replace tzinfo on the datetime)."
         )
     else:
-        return dtime
\ No newline at end of file
+        return dtime
+
+def dtime_to_timestamp(dtime):
+    """
+    Converts a timezone aware datetime.datetime instance to an integer UNIX
+    timestamp. Microseconds are dropped, since none of the market formats
+    use them.
+
+    :param datetime.datetime dtime: A timezone aware datetime instance.
+    :rtype: int
+    :returns: Seconds since the UNIX epoch.
+    """
+    return calendar.timegm(check_for_naive_dtime(dtime).utctimetuple())
+
+def timestamp_to_dtime(timestamp):
+    """
+    Converts an integer UNIX timestamp to a UTC datetime.datetime instance.
+
+    :param int timestamp: Seconds since the UNIX epoch.
+    :rtype: datetime.datetime
+    :returns: A timezone aware UTC datetime instance.
+    """
+    return _EPOCH + datetime.timedelta(seconds=int(timestamp))
@@ -7,6 +7,16 @@ from emds import __version__
 from emds.exceptions import ItemAlreadyPresentError
 from emds.common_utils import check_for_naive_dtime
 
+def _group_key(region_id, type_id):
+    """
+    Normalizes a region ID and type ID into the ``(region_id, type_id)`` key
+    used to group orders and history entries. Region IDs may be missing
+    (``None``), in which case the client lacked the data.
+
+    :rtype: tuple
+    """
+    return int(region_id) if region_id else None, int(type_id)
+
 class MarketOrderList(object):
     """
     A list of MarketOrder objects, with some added features for assisting
@@ -19,7 +29,19 @@ class MarketOrderList(object):
 
     def __init__(self, upload_keys=None, order_generator=None,
                  *args, **kwargs):
+        # Maps (region_id, type_id) tuples to MarketItemsInRegionList
+        # instances.
         self._orders = {}
+        # Secondary indexes of the above, for finding all of the regions for
+        # a type (or all of the types in a region) without a full scan.
+        self._groups_by_type = {}
+        self._groups_by_region = {}
+        # Maps order IDs to the MarketItemsInRegionList containing them, for
+        # quick membership checks and lookups.
+        self._order_index = {}
+        # Running total of orders across all region+item combos, so that
+        # __len__ doesn't have to visit each of them.
+        self._order_count = 0
 
         self.upload_keys = upload_keys or []
         if not isinstance(self.upload_keys, list):
@@ -56,16 +78,14 @@ class MarketOrderList(object):
 
     def __len__(self):
         """
-        Implements a somewhat inefficient length tracking method. Returns the
-        total number of orders contained within.
+        Returns the total number of orders contained within. This is a
+        running total kept up to date by :py:meth:`add_order` and
+        :py:meth:`set_empty_region`, so it's cheap to call often.
 
         :rtype: int
         :returns: The number of orders contained within the list.
         """
-        total = 0
-        for orders in self._orders.values():
-            total += len(orders)
-        return total
+        return self._order_count
 
     def __contains__(self, item):
         """
@@ -81,12 +101,22 @@ class MarketOrderList(object):
         else:
             order_id = int(item)
 
-        for order in self.get_all_orders_ungrouped():
-            if order.order_id == order_id:
-                return True
+        return order_id in self._order_index
 
-        # No matches.
-        return False
+    def get_order(self, order_id):
+        """
+        Looks up an order by its order ID.
+
+        :param int order_id: The order ID to look for.
+        :rtype: MarketOrder or None
+        :returns: The matching :py:class:`MarketOrder`, or ``None`` if there
+            is no order with the given ID in this list.
+        """
+        order_id = int(order_id)
+        olist = self._order_index.get(order_id)
+        if olist is None:
+            return None
+        return olist.get_order(order_id)
 
     def get_all_orders_ungrouped(self):
         """
@@ -118,6 +148,52 @@ class MarketOrderList(object):
         for olist in self._orders.values():
             yield olist
 
+    def get_group(self, region_id, type_id):
+        """
+        Returns the :py:class:`MarketItemsInRegionList` for the given
+        region+item combo.
+
+        :param int region_id: The region ID. May be ``None`` for orders
+            that lacked a region.
+        :param int type_id: The item's type ID.
+        :rtype: MarketItemsInRegionList or None
+        :returns: The matching region+item list, or ``None`` if there is
+            no such combo in this order list.
+        """
+        return self._orders.get(_group_key(region_id, type_id))
+
+    def iter_groups(self, type_id=None, region_id=None):
+        """
+        Uses a generator to return the :py:class:`MarketItemsInRegionList`
+        instances matching the given type and/or region. Omitting both
+        returns every group, like :py:meth:`get_all_order_groups`.
+
+        .. note:: This is a generator! Use :py:meth:`get_group` to fetch
+            groups lacking a region ID.
+
+        :keyword int type_id: If specified, only return groups for this type.
+        :keyword int region_id: If specified, only return groups for this
+            region.
+        :rtype: generator
+        :returns: Generates a list of :py:class:`MarketItemsInRegionList`
+            instances.
+        """
+        if type_id is not None and region_id is not None:
+            olist = self.get_group(region_id, type_id)
+            if olist is not None:
+                yield olist
+            return
+
+        if type_id is not None:
+            groups = self._groups_by_type.get(int(type_id), {})
+        elif region_id is not None:
+            groups = self._groups_by_region.get(int(region_id), {})
+        else:
+            groups = self._orders
+
+        for olist in groups.values():
+            yield olist
+
     def add_order(self, order):
         """
         Adds a MarketOrder instance to the list of market orders contained
@@ -126,13 +202,14 @@ class MarketOrderList(object):
 
         :param MarketOrder order: The order to add to this order list.
         """
-        # This key is used to group the orders based on region.
-        key = '%s_%s' % (order.region_id, order.type_id)
-        if not self._orders.has_key(key):
+        # This key is used to group the orders based on region. MarketOrder
+        # has already normalized both IDs.
+        olist = self._orders.get((order.region_id, order.type_id))
+        if olist is None:
             # We don't have any orders for this yet. Prep the region+item
             # combo by instantiating a new MarketItemsInRegionList for
             # the MarketOrders.
-            self.set_empty_region(
+            olist = self.set_empty_region(
                 order.region_id,
                 order.type_id,
                 order.generated_at
@@ -140,7 +217,9 @@ class MarketOrderList(object):
 
         # The MarketOrder gets stuffed into the MarketItemsInRegionList for this
         # item+region combo.
-        self._orders[key].add_order(order)
+        olist.add_order(order)
+        self._order_index[order.order_id] = olist
+        self._order_count += 1
 
     def set_empty_region(self, region_id, type_id, generated_at,
                          error_if_orders_present=True):
@@ -158,17 +237,51 @@ class MarketOrderList(object):
         :keyword bool error_if_orders_present: If True, raise an exception if
             an order already exists for this item+region combo when this is
             called. This failsafe may be disabled by passing False here.
+        :rtype: MarketItemsInRegionList
+        :returns: The newly created, empty region+item list.
         """
-        key = '%s_%s' % (region_id, type_id)
-        if error_if_orders_present and self._orders.has_key(key):
-            raise ItemAlreadyPresentError(
-                "Orders already exist for the given region and type ID. "
-                "Pass error_if_orders_present=False to disable this failsafe, "
-                "if desired."
-            )
+        return self.add_group(
+            MarketItemsInRegionList(region_id, type_id, generated_at),
+            error_if_orders_present=error_if_orders_present)
+
+    def add_group(self, olist, error_if_orders_present=True):
+        """
+        Adds an already populated region+item list to this order list. This
+        may be a :py:class:`MarketItemsInRegionList`, or anything with the
+        same interface, such as
+        :py:class:`emds.columnar.ColumnarItemsInRegionList`.
 
-        self._orders[key] = MarketItemsInRegionList(
-            region_id, type_id, generated_at)
+        :param MarketItemsInRegionList olist: The region+item list to add.
+        :keyword bool error_if_orders_present: If True, raise an exception if
+            an order already exists for this item+region combo when this is
+            called. This failsafe may be disabled by passing False here, in
+            which case the existing region+item list is replaced.
+        :rtype: MarketItemsInRegionList
+        :returns: The region+item list that was passed in.
+        """
+        key = (olist.region_id, olist.type_id)
+        if key in self._orders:
+            if error_if_orders_present:
+                raise ItemAlreadyPresentError(
+                    "Orders already exist for the given region and type ID. "
+                    "Pass error_if_orders_present=False to disable this "
+                    "failsafe, if desired."
+                )
+            # The old orders are being thrown out, so they shouldn't turn
+            # up in lookups any more.
+            old_olist = self._orders[key]
+            for order_id in old_olist.get_order_ids():
+                if self._order_index.get(order_id) is old_olist:
+                    del self._order_index[order_id]
+            self._order_count -= len(old_olist)
+
+        self._orders[key] = olist
+        self._groups_by_type.setdefault(key[1], {})[key[0]] = olist
+        self._groups_by_region.setdefault(key[0], {})[key[1]] = olist
+        for order_id in olist.get_order_ids():
+            self._order_index[order_id] = olist
+        self._order_count += len(olist)
+        return olist
 
 
 class MarketItemsInRegionList(object):
@@ -195,6 +308,11 @@ class MarketItemsInRegionList(object):
             raise TypeError('generated_at should be a datetime.')
         self.generated_at = check_for_naive_dtime(generated_at)
         self.orders = []
+        # Maps order IDs to MarketOrder instances.
+        self._order_index = {}
+        # Serialized copies of this region+item list, keyed by format name.
+        # Cleared whenever the orders change.
+        self._encoded_cache = {}
 
     def __len__(self):
         """
@@ -229,12 +347,25 @@ class MarketItemsInRegionList(object):
         else:
             order_id = int(item)
 
-        for order in self.orders:
-            if order.order_id == order_id:
-                return True
+        return order_id in self._order_index
 
-        # No matches.
-        return False
+    def get_order(self, order_id):
+        """
+        Looks up an order by its order ID.
+
+        :param int order_id: The order ID to look for.
+        :rtype: MarketOrder or None
+        :returns: The matching :py:class:`MarketOrder`, or ``None`` if there
+            is no order with the given ID in this region+item list.
+        """
+        return self._order_index.get(int(order_id))
+
+    def get_order_ids(self):
+        """
+        :rtype: list
+        :returns: The order IDs of all orders within this region+item list.
+        """
+        return self._order_index.keys()
 
     def add_order(self, order):
         """
@@ -243,13 +374,43 @@ class MarketItemsInRegionList(object):
         :param MarketOrder order: The order to add.
         """
         self.orders.append(order)
+        self._order_index[order.order_id] = order
+        self._encoded_cache.clear()
+
+    def clear_encoded_cache(self):
+        """
+        Throws out any cached serialized copies of this region+item list.
+        This happens automatically when orders are added, but must be done
+        by hand after modifying an order in place.
+        """
+        self._encoded_cache.clear()
+
+    def __getstate__(self):
+        """
+        Cached serialized copies are left out of pickles. They are easily
+        rebuilt, and can be as large as the data itself.
+        """
+        state = self.__dict__.copy()
+        state['_encoded_cache'] = {}
+        return state
 
 
 class MarketOrder(object):
     """
     Represents a market buy or sell order.
+
+    Instances use ``__slots__`` rather than a per-instance ``__dict__``, since
+    full-universe order lists keep millions of these alive at once. This means
+    that arbitrary attributes can't be tacked on to orders.
     """
 
+    __slots__ = (
+        'order_id', 'is_bid', 'region_id', 'solar_system_id', 'station_id',
+        'type_id', 'price', 'volume_entered', 'volume_remaining',
+        'minimum_volume', 'order_issue_date', 'order_duration', 'order_range',
+        'generated_at',
+    )
+
     def __init__(self, order_id, is_bid, region_id, solar_system_id,
                  station_id, type_id, price, volume_entered, volume_remaining,
                  minimum_volume, order_issue_date, order_duration, order_range,
@@ -302,6 +463,50 @@ class MarketOrder(object):
             raise TypeError('generated_at should be a datetime.')
         self.generated_at = check_for_naive_dtime(generated_at)
 
+    @classmethod
+    def from_trusted_row(cls, order_id, is_bid, region_id, solar_system_id,
+                         station_id, type_id, price, volume_entered,
+                         volume_remaining, minimum_volume, order_issue_date,
+                         order_duration, order_range, generated_at):
+        """
+        Builds a MarketOrder without any of the type coercion or validation
+        that the constructor does. Only use this for values that are known
+        to be good already, such as data that EMDS serialized itself. The
+        arguments are the same as the constructor's.
+
+        :rtype: MarketOrder
+        """
+        order = cls.__new__(cls)
+        order.order_id = order_id
+        order.is_bid = is_bid
+        order.region_id = region_id
+        order.solar_system_id = solar_system_id
+        order.station_id = station_id
+        order.type_id = type_id
+        order.price = price
+        order.volume_entered = volume_entered
+        order.volume_remaining = volume_remaining
+        order.minimum_volume = minimum_volume
+        order.order_issue_date = order_issue_date
+        order.order_duration = order_duration
+        order.order_range = order_range
+        order.generated_at = generated_at
+        return order
+
+    def __getstate__(self):
+        """
+        Slotted classes lack a ``__dict__``, so hand pickle a tuple of the
+        slot values instead.
+        """
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        """
+        Restores the slot values produced by :py:meth:`__getstate__`.
+        """
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
     def __repr__(self):
         """
         Basic string representation of the order.
@@ -349,8 +554,16 @@ class MarketHistoryList(object):
 
     def __init__(self, upload_keys=None, history_generator=None,
                  *args, **kwargs):
-        # Will hold an organized store of history items.
+        # Will hold an organized store of history items, keyed by
+        # (region_id, type_id) tuples.
         self._history = {}
+        # Secondary indexes of the above, for finding all of the regions for
+        # a type (or all of the types in a region) without a full scan.
+        self._groups_by_type = {}
+        self._groups_by_region = {}
+        # Running total of entries across all region+item combos, so that
+        # __len__ doesn't have to visit each of them.
+        self._entry_count = 0
 
         self.upload_keys = upload_keys or []
         if not isinstance(self.upload_keys, list):
@@ -362,13 +575,14 @@ class MarketHistoryList(object):
 
     def __len__(self):
         """
-        Implements a somewhat inefficient length tracking method. Returns the
-        total number of orders contained within.
+        Returns the total number of history entries contained within. This is
+        a running total kept up to date by :py:meth:`add_entry` and
+        :py:meth:`set_empty_region`, so it's cheap to call often.
+
+        :rtype: int
+        :returns: The number of entries contained within the list.
         """
-        total = 0
-        for orders in self._history.values():
-            total += len(orders)
-        return total
+        return self._entry_count
 
     def __iter__(self):
         """
@@ -397,8 +611,10 @@ class MarketHistoryList(object):
         else:
             type_id = int(item)
 
-        for entry in self.get_all_entries_ungrouped():
-            if entry.type_id == type_id:
+        # Region+item combos may be present without any entries, so those
+        # don't count.
+        for entry_list in self._groups_by_type.get(type_id, {}).values():
+            if len(entry_list):
                 return True
 
         # No matches.
@@ -446,6 +662,52 @@ class MarketHistoryList(object):
         for history_entry_list in self._history.values():
             yield history_entry_list
 
+    def get_group(self, region_id, type_id):
+        """
+        Returns the :py:class:`HistoryItemsInRegionList` for the given
+        region+item combo.
+
+        :param int region_id: The region ID. May be ``None`` for entries
+            that lacked a region.
+        :param int type_id: The item's type ID.
+        :rtype: HistoryItemsInRegionList or None
+        :returns: The matching region+item list, or ``None`` if there is
+            no such combo in this history list.
+        """
+        return self._history.get(_group_key(region_id, type_id))
+
+    def iter_groups(self, type_id=None, region_id=None):
+        """
+        Uses a generator to return the :py:class:`HistoryItemsInRegionList`
+        instances matching the given type and/or region. Omitting both
+        returns every group, like :py:meth:`get_all_entries_grouped`.
+
+        .. note:: This is a generator! Use :py:meth:`get_group` to fetch
+            groups lacking a region ID.
+
+        :keyword int type_id: If specified, only return groups for this type.
+        :keyword int region_id: If specified, only return groups for this
+            region.
+        :rtype: generator
+        :returns: Generates a list of :py:class:`HistoryItemsInRegionList`
+            instances.
+        """
+        if type_id is not None and region_id is not None:
+            entry_list = self.get_group(region_id, type_id)
+            if entry_list is not None:
+                yield entry_list
+            return
+
+        if type_id is not None:
+            groups = self._groups_by_type.get(int(type_id), {})
+        elif region_id is not None:
+            groups = self._groups_by_region.get(int(region_id), {})
+        else:
+            groups = self._history
+
+        for entry_list in groups.values():
+            yield entry_list
+
     def add_entry(self, entry):
         """
         Adds a MarketHistoryEntry instance to the list of market history entries
@@ -456,12 +718,13 @@ class MarketHistoryList(object):
             instance.
         """
         # This key is used to group the orders based on region.
-        key = '%s_%s' % (entry.region_id, entry.type_id)
-        if not self._history.has_key(key):
+        # MarketHistoryEntry has already normalized both IDs.
+        entry_list = self._history.get((entry.region_id, entry.type_id))
+        if entry_list is None:
             # We don't have any orders for this yet. Prep the region+item
             # combo by instantiating a new MarketItemsInRegionList for
             # the MarketOrders.
-            self.set_empty_region(
+            entry_list = self.set_empty_region(
                 entry.region_id,
                 entry.type_id,
                 entry.generated_at
@@ -469,7 +732,8 @@ class MarketHistoryList(object):
 
         # The MarketOrder gets stuffed into the MarketItemsInRegionList for this
         # item+region combo.
-        self._history[key].add_entry(entry)
+        entry_list.add_entry(entry)
+        self._entry_count += 1
 
     def set_empty_region(self, region_id, type_id, generated_at,
                          error_if_entries_present=True):
@@ -487,17 +751,45 @@ class MarketHistoryList(object):
         :keyword bool error_if_entries_present: If True, raise an exception if
             an entry already exists for this item+region combo when this is
             called. This failsafe may be disabled by passing False here.
+        :rtype: HistoryItemsInRegionList
+        :returns: The newly created, empty region+item list.
         """
-        key = '%s_%s' % (region_id, type_id)
-        if error_if_entries_present and self._history.has_key(key):
-            raise ItemAlreadyPresentError(
-                "Orders already exist for the given region and type ID. "
-                "Pass error_if_orders_present=False to disable this failsafe, "
-                "if desired."
-            )
+        return self.add_group(
+            HistoryItemsInRegionList(region_id, type_id, generated_at),
+            error_if_entries_present=error_if_entries_present)
+
+    def add_group(self, entry_list, error_if_entries_present=True):
+        """
+        Adds an already populated region+item list to this history list. This
+        may be a :py:class:`HistoryItemsInRegionList`, or anything with the
+        same interface, such as
+        :py:class:`emds.columnar.ColumnarHistoryItemsInRegionList`.
 
-        self._history[key] = HistoryItemsInRegionList(
-            region_id, type_id, generated_at)
+        :param HistoryItemsInRegionList entry_list: The region+item list to
+            add.
+        :keyword bool error_if_entries_present: If True, raise an exception if
+            an entry already exists for this item+region combo when this is
+            called. This failsafe may be disabled by passing False here, in
+            which case the existing region+item list is replaced.
+        :rtype: HistoryItemsInRegionList
+        :returns: The region+item list that was passed in.
+        """
+        key = (entry_list.region_id, entry_list.type_id)
+        if key in self._history:
+            if error_if_entries_present:
+                raise ItemAlreadyPresentError(
+                    "Orders already exist for the given region and type ID. "
+                    "Pass error_if_orders_present=False to disable this "
+                    "failsafe, if desired."
+                )
+            # The old entries are being thrown out.
+            self._entry_count -= len(self._history[key])
+
+        self._history[key] = entry_list
+        self._groups_by_type.setdefault(key[1], {})[key[0]] = entry_list
+        self._groups_by_region.setdefault(key[0], {})[key[1]] = entry_list
+        self._entry_count += len(entry_list)
+        return entry_list
 
 
 class HistoryItemsInRegionList(object):
@@ -524,6 +816,9 @@ class HistoryItemsInRegionList(object):
             raise TypeError('generated_at should be a datetime.')
         self.generated_at = check_for_naive_dtime(generated_at)
         self.entries = []
+        # Serialized copies of this region+item list, keyed by format name.
+        # Cleared whenever the entries change.
+        self._encoded_cache = {}
 
     def __iter__(self):
         """
@@ -552,13 +847,39 @@ class HistoryItemsInRegionList(object):
             instance.
         """
         self.entries.append(entry)
+        self._encoded_cache.clear()
+
+    def clear_encoded_cache(self):
+        """
+        Throws out any cached serialized copies of this region+item list.
+        This happens automatically when entries are added, but must be done
+        by hand after modifying an entry in place.
+        """
+        self._encoded_cache.clear()
+
+    def __getstate__(self):
+        """
+        Cached serialized copies are left out of pickles. They are easily
+        rebuilt, and can be as large as the data itself.
+        """
+        state = self.__dict__.copy()
+        state['_encoded_cache'] = {}
+        return state
 
 
 class MarketHistoryEntry(object):
     """
     Represents a single point of market history data.
+
+    Like :py:class:`MarketOrder`, instances use ``__slots__`` to keep large
+    history lists compact.
     """
 
+    __slots__ = (
+        'type_id', 'region_id', 'historical_date', 'num_orders', 'low_price',
+        'high_price', 'average_price', 'total_quantity', 'generated_at',
+    )
+
     def __init__(self, type_id, region_id, historical_date, num_orders,
                  low_price, high_price, average_price, total_quantity,
                  generated_at):
@@ -580,6 +901,44 @@ class MarketHistoryEntry(object):
             raise TypeError('generated_at should be a datetime.')
         self.generated_at = check_for_naive_dtime(generated_at)
 
+    @classmethod
+    def from_trusted_row(cls, type_id, region_id, historical_date, num_orders,
+                         low_price, high_price, average_price, total_quantity,
+                         generated_at):
+        """
+        Builds a MarketHistoryEntry without any of the type coercion or
+        validation that the constructor does. Only use this for values that
+        are known to be good already, such as data that EMDS serialized
+        itself. The arguments are the same as the constructor's.
+
+        :rtype: MarketHistoryEntry
+        """
+        entry = cls.__new__(cls)
+        entry.type_id = type_id
+        entry.region_id = region_id
+        entry.historical_date = historical_date
+        entry.num_orders = num_orders
+        entry.low_price = low_price
+        entry.high_price = high_price
+        entry.average_price = average_price
+        entry.total_quantity = total_quantity
+        entry.generated_at = generated_at
+        return entry
+
+    def __getstate__(self):
+        """
+        Slotted classes lack a ``__dict__``, so hand pickle a tuple of the
+        slot values instead.
+        """
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        """
+        Restores the slot values produced by :py:meth:`__getstate__`.
+        """
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
     def __repr__(self):
         """
         Basic string representation of the history entry.
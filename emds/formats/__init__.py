@@ -1,2 +1,2 @@
 #noinspection PyUnresolvedReferences
-from emds.formats import unified
\ No newline at end of file
+from emds.formats import binary, snapshot, unified
@@ -0,0 +1,255 @@
+"""
+A compact binary format, meant for passing order and history lists between
+processes that both run EMDS. Unlike the
+:py:mod:`Unified <emds.formats.unified>` format, nothing has to be formatted
+or parsed as text: each rowset is a run of fixed-width records, packed with
+:py:mod:`struct`.
+
+A message is laid out as follows (all integers are little-endian):
+
+* The magic string ``EMDB``, followed by a one byte format version and a
+  one byte result type (``0`` for orders, ``1`` for history).
+* A 4 byte length, followed by a JSON header holding the generator, upload
+  keys, and the names of the packed record's fields.
+* A 4 byte rowset count, followed by the rowsets. Each rowset starts with
+  its region ID, type ID, generatedAt timestamp, and a row count, followed
+  by that many packed records.
+
+Datetimes are stored as integer UNIX timestamps, and missing region and
+solar system IDs are stored as ``0``.
+"""
+import struct
+from emds.compat import json
+from emds.common_utils import dtime_to_timestamp, timestamp_to_dtime
+from emds.data_structures import MarketOrder, MarketOrderList, \
+    MarketItemsInRegionList, MarketHistoryEntry, MarketHistoryList, \
+    HistoryItemsInRegionList
+from emds.formats.exceptions import ParseError
+
+MAGIC = 'EMDB'
+FORMAT_VERSION = 1
+
+# The values of the result type byte.
+RESULT_TYPE_ORDERS = 0
+RESULT_TYPE_HISTORY = 1
+
+# The key that encoded rowsets are cached under on region+item lists.
+ENCODED_CACHE_KEY = 'binary'
+
+_PREAMBLE = struct.Struct('<4sBBI')
+_ROWSET_COUNT = struct.Struct('<I')
+# regionID, typeID, generatedAt, row count.
+_ROWSET_HEADER = struct.Struct('<qqqI')
+
+#: The fields of a packed order record, in order.
+ORDER_COLUMNS = [
+    'order_id', 'is_bid', 'solar_system_id', 'station_id', 'price',
+    'volume_entered', 'volume_remaining', 'minimum_volume',
+    'order_issue_date', 'order_duration', 'order_range',
+]
+_ORDER_RECORD = struct.Struct('<q?qqdqqqqqq')
+
+#: The fields of a packed history record, in order.
+HISTORY_COLUMNS = [
+    'historical_date', 'num_orders', 'low_price', 'high_price',
+    'average_price', 'total_quantity',
+]
+_HISTORY_RECORD = struct.Struct('<qqdddq')
+
+
+def _pack_order(order):
+    return _ORDER_RECORD.pack(
+        order.order_id,
+        order.is_bid,
+        order.solar_system_id or 0,
+        order.station_id,
+        order.price,
+        order.volume_entered,
+        order.volume_remaining,
+        order.minimum_volume,
+        dtime_to_timestamp(order.order_issue_date),
+        order.order_duration,
+        order.order_range,
+    )
+
+def _unpack_order(values, region_id, type_id, generated_at):
+    (order_id, is_bid, solar_system_id, station_id, price, volume_entered,
+     volume_remaining, minimum_volume, order_issue_date, order_duration,
+     order_range) = values
+    # Everything was type checked on the way in, so skip doing it again.
+    return MarketOrder.from_trusted_row(
+        order_id, is_bid, region_id, solar_system_id or None, station_id,
+        type_id, price, volume_entered, volume_remaining, minimum_volume,
+        timestamp_to_dtime(order_issue_date), order_duration, order_range,
+        generated_at)
+
+def _pack_entry(entry):
+    return _HISTORY_RECORD.pack(
+        dtime_to_timestamp(entry.historical_date),
+        entry.num_orders,
+        entry.low_price,
+        entry.high_price,
+        entry.average_price,
+        entry.total_quantity,
+    )
+
+def _unpack_entry(values, region_id, type_id, generated_at):
+    (historical_date, num_orders, low_price, high_price, average_price,
+     total_quantity) = values
+    return MarketHistoryEntry.from_trusted_row(
+        type_id, region_id, timestamp_to_dtime(historical_date), num_orders,
+        low_price, high_price, average_price, total_quantity, generated_at)
+
+# Result type -> (list class, group class, add method name, record struct,
+# column names, record unpacker).
+_DECODERS = {
+    RESULT_TYPE_ORDERS: (
+        MarketOrderList, MarketItemsInRegionList, 'add_order',
+        _ORDER_RECORD, ORDER_COLUMNS, _unpack_order),
+    RESULT_TYPE_HISTORY: (
+        MarketHistoryList, HistoryItemsInRegionList, 'add_entry',
+        _HISTORY_RECORD, HISTORY_COLUMNS, _unpack_entry),
+}
+
+
+def encode_rowset(items_in_region_list, pack_record, cache=False):
+    """
+    Packs a single region+item list. Cached copies are used, and made, the
+    same way the Unified encoders do it.
+
+    :param items_in_region_list: The region+item list to serialize.
+    :param callable pack_record: Packs a single order or history entry.
+    :keyword bool cache: If True, the result is cached on the region+item
+        list, until it is changed.
+    :rtype: str
+    """
+    encoded_cache = getattr(items_in_region_list, '_encoded_cache', None)
+    if encoded_cache is not None:
+        fragment = encoded_cache.get(ENCODED_CACHE_KEY)
+        if fragment is not None:
+            return fragment
+
+    records = [pack_record(record) for record in items_in_region_list]
+    fragment = _ROWSET_HEADER.pack(
+        items_in_region_list.region_id or 0,
+        items_in_region_list.type_id,
+        dtime_to_timestamp(items_in_region_list.generated_at),
+        len(records),
+    ) + ''.join(records)
+
+    if cache and encoded_cache is not None:
+        encoded_cache[ENCODED_CACHE_KEY] = fragment
+    return fragment
+
+def encode_to_bytes(order_or_history, cache=False):
+    """
+    Given an order or history list, pack it into a binary message.
+
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :param order_or_history: A MarketOrderList or MarketHistoryList instance to
+        encode.
+    :keyword bool cache: If True, each packed rowset is cached on its
+        region+item list, and re-used by later encodes until it changes.
+    :rtype: str
+    :return: The encoded message.
+    """
+    if isinstance(order_or_history, MarketOrderList):
+        result_type = RESULT_TYPE_ORDERS
+        generator = order_or_history.order_generator
+        columns = ORDER_COLUMNS
+        groups = order_or_history.get_all_order_groups()
+        pack_record = _pack_order
+    elif isinstance(order_or_history, MarketHistoryList):
+        result_type = RESULT_TYPE_HISTORY
+        generator = order_or_history.history_generator
+        columns = HISTORY_COLUMNS
+        groups = order_or_history.get_all_entries_grouped()
+        pack_record = _pack_entry
+    else:
+        raise Exception("Must be one of MarketOrderList or MarketHistoryList.")
+
+    header = json.dumps({
+        'generator': generator,
+        'uploadKeys': order_or_history.upload_keys,
+        'columns': columns,
+    })
+    if isinstance(header, unicode):
+        header = header.encode('utf-8')
+
+    rowsets = [
+        encode_rowset(group, pack_record, cache=cache) for group in groups]
+    return ''.join([
+        _PREAMBLE.pack(MAGIC, FORMAT_VERSION, result_type, len(header)),
+        header,
+        _ROWSET_COUNT.pack(len(rowsets)),
+    ] + rowsets)
+
+def _to_str(data):
+    """
+    Copies a (small) slice of a buffer to a str.
+    """
+    if hasattr(data, 'tobytes'):
+        return data.tobytes()
+    return str(data)
+
+def parse_from_bytes(data):
+    """
+    Given a binary message, unpack it and return a MarketOrderList or
+    MarketHistoryList instance. Records are unpacked in place, so ``data``
+    may be a ``memoryview`` or ``buffer`` over a larger chunk of memory
+    (a socket buffer or mmap, for example) without copying it first.
+
+    :param data: The encoded message, as a str, buffer or memoryview.
+    :rtype: MarketOrderList or MarketHistoryList
+    :raises: ParseError if the message is invalid or truncated.
+    """
+    try:
+        magic, version, result_type, header_len = \
+            _PREAMBLE.unpack_from(data, 0)
+    except struct.error:
+        raise ParseError("Message is too short to be a binary EMDS message.")
+    if magic != MAGIC:
+        raise ParseError("Not a binary EMDS message.")
+    if version != FORMAT_VERSION:
+        raise ParseError("Unsupported binary format version: %d" % version)
+    try:
+        (list_class, group_class, add_method, record_struct, columns,
+         unpack_record) = _DECODERS[result_type]
+    except KeyError:
+        raise ParseError("Unknown result type: %d" % result_type)
+
+    offset = _PREAMBLE.size
+    try:
+        header = json.loads(_to_str(data[offset:offset + header_len]))
+    except ValueError:
+        raise ParseError("Mal-formed header.")
+    if header.get('columns') != columns:
+        raise ParseError(
+            "Unexpected columns in header: %r" % header.get('columns'))
+    offset += header_len
+
+    market_list = list_class(header['uploadKeys'], header['generator'])
+    record_size = record_struct.size
+    unpack_from = record_struct.unpack_from
+    try:
+        num_rowsets, = _ROWSET_COUNT.unpack_from(data, offset)
+        offset += _ROWSET_COUNT.size
+        for _ in xrange(num_rowsets):
+            region_id, type_id, generated_at, num_rows = \
+                _ROWSET_HEADER.unpack_from(data, offset)
+            offset += _ROWSET_HEADER.size
+            region_id = region_id or None
+            generated_at = timestamp_to_dtime(generated_at)
+
+            group = group_class(region_id, type_id, generated_at)
+            add_record = getattr(group, add_method)
+            for _ in xrange(num_rows):
+                add_record(unpack_record(
+                    unpack_from(data, offset),
+                    region_id, type_id, generated_at))
+                offset += record_size
+            market_list.add_group(group)
+    except struct.error:
+        raise ParseError("Message is truncated.")
+
+    return market_list
@@ -0,0 +1,76 @@
+from emds.data_structures import MarketOrderList
+from emds.formats import binary
+from emds.formats.exceptions import ParseError
+from emds.formats.tests import BaseSerializationCase
+
+class BinarySerializationTests(BaseSerializationCase):
+    """
+    Tests for the binary format.
+    """
+
+    def test_order_round_trip(self):
+        """
+        Orders should come back out the same as they went in, apart from
+        their datetimes losing microseconds.
+        """
+        self.order2.solar_system_id = None
+        self.order_list.add_order(self.order2)
+        self.order_list.upload_keys = [{'name': 'emk', 'key': 'abc'}]
+
+        encoded = binary.encode_to_bytes(self.order_list)
+        decoded = binary.parse_from_bytes(encoded)
+        self.assertEqual(len(decoded), 2)
+        self.assertEqual(decoded.upload_keys, self.order_list.upload_keys)
+        self.assertEqual(
+            decoded.order_generator, self.order_list.order_generator)
+
+        for order in self.order_list.get_all_orders_ungrouped():
+            decoded_order = decoded.get_order(order.order_id)
+            for name in binary.ORDER_COLUMNS + ['region_id', 'type_id']:
+                value = getattr(order, name)
+                if hasattr(value, 'microsecond'):
+                    value = value.replace(microsecond=0)
+                self.assertEqual(getattr(decoded_order, name), value)
+        self.assertEqual(
+            decoded.get_order(self.order2.order_id).solar_system_id, None)
+
+    def test_history_round_trip(self):
+        """
+        History entries should come back out the same as they went in.
+        """
+        self.history.add_entry(self.history2)
+        decoded = binary.parse_from_bytes(
+            binary.encode_to_bytes(self.history))
+        self.assertEqual(len(decoded), 2)
+        for entry in self.history.get_all_entries_ungrouped():
+            group = decoded.get_group(entry.region_id, entry.type_id)
+            decoded_entry = group.entries[0]
+            self.assertEqual(decoded_entry.num_orders, entry.num_orders)
+            self.assertEqual(decoded_entry.average_price, entry.average_price)
+            self.assertEqual(
+                decoded_entry.historical_date,
+                entry.historical_date.replace(microsecond=0))
+
+    def test_memoryview(self):
+        """
+        Decoding should work over a memoryview of a larger buffer.
+        """
+        encoded = binary.encode_to_bytes(self.order_list)
+        view = memoryview('junk' + encoded + 'junk')[4:-4]
+        decoded = binary.parse_from_bytes(view)
+        self.assertTrue(self.order1.order_id in decoded)
+
+        # Empty lists are valid too.
+        decoded = binary.parse_from_bytes(
+            binary.encode_to_bytes(MarketOrderList()))
+        self.assertEqual(len(decoded), 0)
+
+    def test_parse_errors(self):
+        """
+        Mal-formed and truncated messages should raise ParseError.
+        """
+        encoded = binary.encode_to_bytes(self.order_list)
+        self.assertRaises(ParseError, binary.parse_from_bytes, 'EMD')
+        self.assertRaises(
+            ParseError, binary.parse_from_bytes, 'X' + encoded[1:])
+        self.assertRaises(ParseError, binary.parse_from_bytes, encoded[:-1])
@@ -0,0 +1,294 @@
+"""
+Columnar snapshot files, for persisting whole order or history lists and
+opening them again without re-parsing anything.
+
+Each region+item list is written as one block per column (the raw contents
+of a :py:mod:`columnar <emds.columnar>` container's arrays), one after the
+other. An index of each group's position follows the blocks, and a
+fixed-size footer at the very end of the file points at the index. Opening
+a snapshot only reads the footer and index out of a memory map; a group's
+column blocks aren't touched until it is asked for.
+
+Layout (integers little-endian):
+
+* The magic string ``EMDS``, followed by a one byte format version.
+* The column blocks of every group.
+* One index record per group: region ID, type ID, generatedAt timestamp,
+  offset of its first column block, and row count.
+* A JSON metadata document: result type, generator, upload keys, column
+  names, typecodes and item sizes, and the writer's byte order.
+* The footer: index offset, group count, metadata offset, metadata length,
+  and the magic string again.
+"""
+import array
+import mmap
+import struct
+import sys
+from emds.compat import json
+from emds.columnar import ColumnarItemsInRegionList, \
+    ColumnarHistoryItemsInRegionList
+from emds.common_utils import dtime_to_timestamp, timestamp_to_dtime
+from emds.data_structures import MarketOrderList, MarketHistoryList, \
+    _group_key
+from emds.formats.exceptions import ParseError
+
+MAGIC = 'EMDS'
+FORMAT_VERSION = 1
+
+_PREAMBLE = struct.Struct('<4sB')
+# regionID, typeID, generatedAt, offset, row count.
+_INDEX_RECORD = struct.Struct('<qqqQQ')
+# Index offset, group count, metadata offset, metadata length, magic.
+_FOOTER = struct.Struct('<QQQI4s')
+
+# Result type -> (list class, columnar group class).
+_RESULT_TYPES = {
+    'orders': (MarketOrderList, ColumnarItemsInRegionList),
+    'history': (MarketHistoryList, ColumnarHistoryItemsInRegionList),
+}
+
+
+def write_snapshot(order_or_history, fobj):
+    """
+    Writes an order or history list to a snapshot file. Groups are
+    converted to columnar form (and written) one at a time, so only one
+    extra group's worth of memory is needed.
+
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :param order_or_history: A MarketOrderList or MarketHistoryList instance to
+        write.
+    :param fobj: A file-like object, opened in binary mode.
+    """
+    if isinstance(order_or_history, MarketOrderList):
+        result_type = 'orders'
+        generator = order_or_history.order_generator
+        groups = order_or_history.get_all_order_groups()
+    elif isinstance(order_or_history, MarketHistoryList):
+        result_type = 'history'
+        generator = order_or_history.history_generator
+        groups = order_or_history.get_all_entries_grouped()
+    else:
+        raise Exception("Must be one of MarketOrderList or MarketHistoryList.")
+    columnar_class = _RESULT_TYPES[result_type][1]
+
+    fobj.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION))
+    offset = _PREAMBLE.size
+
+    index = []
+    for group in groups:
+        if not isinstance(group, columnar_class):
+            group = columnar_class.from_region_list(group)
+        index.append(_INDEX_RECORD.pack(
+            group.region_id or 0,
+            group.type_id,
+            dtime_to_timestamp(group.generated_at),
+            offset,
+            len(group),
+        ))
+        for name, _ in columnar_class.COLUMNS:
+            block = group.get_column(name).tostring()
+            fobj.write(block)
+            offset += len(block)
+
+    index_offset = offset
+    fobj.write(''.join(index))
+    offset += _INDEX_RECORD.size * len(index)
+
+    metadata = json.dumps({
+        'resultType': result_type,
+        'generator': generator,
+        'uploadKeys': order_or_history.upload_keys,
+        'columns': [
+            [name, typecode, array.array(typecode).itemsize]
+            for name, typecode in columnar_class.COLUMNS],
+        'byteOrder': sys.byteorder,
+    })
+    if isinstance(metadata, unicode):
+        metadata = metadata.encode('utf-8')
+    fobj.write(metadata)
+    fobj.write(_FOOTER.pack(
+        index_offset, len(index), offset, len(metadata), MAGIC))
+
+
+class SnapshotReader(object):
+    """
+    Provides random access to the groups in a snapshot file, which is
+    memory mapped rather than read in. Use :py:func:`open_snapshot` to get
+    one of these.
+    """
+
+    def __init__(self, fobj):
+        """
+        :param fobj: A file object, opened in binary mode. It must have a
+            real file descriptor, since it is memory mapped.
+        :raises: ParseError if the file isn't a valid snapshot.
+        """
+        self._fobj = fobj
+        try:
+            self._mmap = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # Empty files can't be mapped.
+            fobj.close()
+            raise ParseError("Not a snapshot file.")
+
+        try:
+            self._read_header()
+        except ParseError:
+            self.close()
+            raise
+        except (struct.error, ValueError, KeyError):
+            self.close()
+            raise ParseError("Snapshot file is truncated or corrupt.")
+
+    def _read_header(self):
+        """
+        Reads the metadata and group index. None of the column blocks are
+        touched.
+        """
+        data = self._mmap
+        magic, version = _PREAMBLE.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ParseError("Not a snapshot file.")
+        if version != FORMAT_VERSION:
+            raise ParseError(
+                "Unsupported snapshot format version: %d" % version)
+
+        (index_offset, num_groups, metadata_offset, metadata_len,
+         magic) = _FOOTER.unpack_from(data, len(data) - _FOOTER.size)
+        if magic != MAGIC:
+            raise ParseError("Snapshot file is truncated or corrupt.")
+
+        metadata = json.loads(
+            data[metadata_offset:metadata_offset + metadata_len])
+        self.result_type = metadata['resultType']
+        self.generator = metadata['generator']
+        self.upload_keys = metadata['uploadKeys']
+        self._list_class, self._group_class = \
+            _RESULT_TYPES[self.result_type]
+
+        expected_columns = [
+            [name, typecode, array.array(typecode).itemsize]
+            for name, typecode in self._group_class.COLUMNS]
+        # The typecodes are compared along with the item sizes, since an
+        # integer column and a double column are both 8 bytes wide.
+        stored_columns = [
+            [name, typecode, itemsize]
+            for name, typecode, itemsize in metadata['columns']]
+        if len(stored_columns) != len(expected_columns):
+            raise ParseError(
+                "Snapshot has %d columns, expected %d." % (
+                    len(stored_columns), len(expected_columns)))
+        if stored_columns != expected_columns:
+            raise ParseError(
+                "Snapshot columns don't match this version of EMDS.")
+        self._byteswap = metadata['byteOrder'] != sys.byteorder
+
+        # Maps (region_id, type_id) to (generated_at, offset, row count).
+        self._index = {}
+        for i in xrange(num_groups):
+            region_id, type_id, generated_at, offset, num_rows = \
+                _INDEX_RECORD.unpack_from(
+                    data, index_offset + i * _INDEX_RECORD.size)
+            self._index[_group_key(region_id, type_id)] = (
+                generated_at, offset, num_rows)
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of region+item groups in the snapshot.
+        """
+        return len(self._index)
+
+    def __contains__(self, key):
+        """
+        :param tuple key: A ``(region_id, type_id)`` tuple.
+        :rtype: bool
+        """
+        return _group_key(*key) in self._index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps and closes the file. Groups that have already been read are
+        unaffected.
+        """
+        self._mmap.close()
+        self._fobj.close()
+
+    def get_group_keys(self):
+        """
+        :rtype: list
+        :returns: A list of the ``(region_id, type_id)`` tuples of every
+            group in the snapshot.
+        """
+        return self._index.keys()
+
+    def get_group(self, region_id, type_id):
+        """
+        Reads a single region+item group out of the snapshot.
+
+        :param int region_id: The region ID to look for. May be None.
+        :param int type_id: The type ID to look for.
+        :rtype: ColumnarItemsInRegionList or ColumnarHistoryItemsInRegionList
+        :returns: The group, or None if it's not in the snapshot.
+        """
+        key = _group_key(region_id, type_id)
+        try:
+            generated_at, offset, num_rows = self._index[key]
+        except KeyError:
+            return None
+
+        columns = {}
+        for name, typecode in self._group_class.COLUMNS:
+            column = array.array(typecode)
+            end = offset + column.itemsize * num_rows
+            column.fromstring(self._mmap[offset:end])
+            if self._byteswap:
+                column.byteswap()
+            columns[name] = column
+            offset = end
+
+        group = self._group_class(
+            key[0], key[1], timestamp_to_dtime(generated_at))
+        group.extend_columns(columns)
+        return group
+
+    def iter_groups(self):
+        """
+        Reads each group out of the snapshot in turn.
+
+        .. note:: This is a generator!
+
+        :rtype: generator
+        """
+        for region_id, type_id in self._index:
+            yield self.get_group(region_id, type_id)
+
+    def load(self):
+        """
+        Reads the whole snapshot into a MarketOrderList or MarketHistoryList,
+        holding columnar groups.
+
+        :rtype: MarketOrderList or MarketHistoryList
+        """
+        market_list = self._list_class(self.upload_keys, self.generator)
+        for group in self.iter_groups():
+            market_list.add_group(group)
+        return market_list
+
+
+def open_snapshot(path):
+    """
+    Opens a snapshot file for random access. This is quick no matter how
+    big the file is, since only its index is read.
+
+    :param str path: Path to the snapshot file.
+    :rtype: SnapshotReader
+    :raises: ParseError if the file isn't a valid snapshot.
+    """
+    return SnapshotReader(open(path, 'rb'))
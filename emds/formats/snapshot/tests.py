@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+from emds.columnar import ColumnarItemsInRegionList, \
+    ColumnarHistoryItemsInRegionList, INT64_TYPECODE
+from emds.formats import snapshot
+from emds.formats.exceptions import ParseError
+from emds.formats.tests import BaseSerializationCase
+
+class SnapshotTests(BaseSerializationCase):
+    """
+    Tests for the columnar snapshot files.
+    """
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'snapshot.emds')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, market_list):
+        with open(self.path, 'wb') as fobj:
+            snapshot.write_snapshot(market_list, fobj)
+
+    def test_orders(self):
+        """
+        Write some orders, and read single groups back out.
+        """
+        self.order2.solar_system_id = None
+        self.order_list.add_order(self.order2)
+        self.order_list.upload_keys = [{'name': 'emk', 'key': 'abc'}]
+        self.write(self.order_list)
+
+        with snapshot.open_snapshot(self.path) as reader:
+            self.assertEqual(len(reader), 2)
+            self.assertEqual(reader.upload_keys, self.order_list.upload_keys)
+            self.assertTrue(
+                (self.order2.region_id, self.order2.type_id) in reader)
+            self.assertEqual(reader.get_group(1, 2), None)
+
+            group = reader.get_group(
+                self.order2.region_id, self.order2.type_id)
+            self.assertTrue(isinstance(group, ColumnarItemsInRegionList))
+            order = group.get_order(self.order2.order_id)
+            self.assertEqual(order.price, self.order2.price)
+            self.assertEqual(order.solar_system_id, None)
+            self.assertEqual(
+                order.order_issue_date,
+                self.order2.order_issue_date.replace(microsecond=0))
+
+            loaded = reader.load()
+        self.assertEqual(len(loaded), 2)
+        self.assertTrue(self.order1.order_id in loaded)
+
+    def test_history(self):
+        """
+        Columnar groups are written as-is, and history works the same.
+        """
+        self.history.add_entry(self.history2)
+        group = self.history.get_group(
+            self.history2.region_id, self.history2.type_id)
+        self.history.add_group(
+            ColumnarHistoryItemsInRegionList.from_region_list(group),
+            error_if_entries_present=False)
+        self.write(self.history)
+
+        with snapshot.open_snapshot(self.path) as reader:
+            loaded = reader.load()
+        self.assertEqual(len(loaded), 2)
+        entry = loaded.get_group(
+            self.history2.region_id, self.history2.type_id).entries[0]
+        self.assertEqual(entry.total_quantity, self.history2.total_quantity)
+
+    def test_invalid_files(self):
+        """
+        Truncated or non-snapshot files should raise ParseError.
+        """
+        self.write(self.order_list)
+        with open(self.path, 'rb') as fobj:
+            data = fobj.read()
+
+        for bad_data in ('', 'garbage', data[:-1], 'XXXX' + data[4:]):
+            with open(self.path, 'wb') as fobj:
+                fobj.write(bad_data)
+            self.assertRaises(ParseError, snapshot.open_snapshot, self.path)
+
+    def test_column_mismatch(self):
+        """
+        Files whose column names, typecodes or count differ from this
+        build's are rejected, even when the item sizes happen to match.
+        """
+        self.write(self.order_list)
+        with open(self.path, 'rb') as fobj:
+            data = fobj.read()
+
+        int_column = '["order_id", "%s", 8]' % INT64_TYPECODE
+        self.assertTrue(int_column in data)
+        for replacement in ('["order_id", "d", 8]', '["order_ix", "%s", 8]'
+                            % INT64_TYPECODE):
+            with open(self.path, 'wb') as fobj:
+                fobj.write(data.replace(int_column, replacement))
+            self.assertRaises(ParseError, snapshot.open_snapshot, self.path)
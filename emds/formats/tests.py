@@ -4,8 +4,10 @@ the submodules for each format for their own respective serialization and
 deserialization tests.
 """
 import unittest
+import datetime
 from emds.data_structures import MarketOrder, MarketOrderList, MarketHistoryList, MarketHistoryEntry
 from emds.common_utils import  UTC_TZINFO, now_dtime_in_utc
+from emds.formats.exceptions import ParseError
 from emds.formats.unified.unified_utils import parse_datetime
 
 class CommonUtilsCase(unittest.TestCase):
@@ -23,6 +25,22 @@ class CommonUtilsCase(unittest.TestCase):
         # Make sure it converted to UTC.
         self.assertEqual(pdtime.tzinfo, UTC_TZINFO)
 
+        # Negative offsets move the other way, and can cross days.
+        pdtime = parse_datetime("2012-06-19T22:41:52-05:30")
+        self.assertEqual(pdtime, datetime.datetime(
+            2012, 6, 20, 4, 11, 52, tzinfo=UTC_TZINFO))
+
+        # Repeated strings come back out of the memo cache.
+        self.assertIs(
+            parse_datetime("2012-06-19T22:41:52-05:30"), pdtime)
+
+        # Other shapes fall back to dateutil, and end up the same.
+        self.assertEqual(
+            parse_datetime("2012-06-20 04:11:52.123Z"), pdtime)
+
+        self.assertRaises(ParseError, parse_datetime, "not a datetime")
+        self.assertRaises(ParseError, parse_datetime, None)
+
 
 class BaseSerializationCase(unittest.TestCase):
     """
@@ -1,14 +1,60 @@
+import zlib
 from emds.compat import json
 from emds.data_structures import MarketHistoryList, MarketOrderList
 from emds.formats.exceptions import ParseError
-from emds.formats.unified import history, orders
+from emds.formats.unified import batch, history, orders, streaming
+from emds.formats.unified.dedupe import RowsetDeduplicator
 
-def parse_from_json(json_str):
+# The top-level fields that must be seen before rowsets can be parsed.
+_HEADER_KEYS = ('resultType', 'uploadKeys', 'generator', 'columns')
+
+def _get_format_module(message_dict):
+    """
+    Validates the basics of a decoded message, and figures out which module
+    handles its result type.
+
+    :param dict message_dict: A Unified Uploader message as a dict.
+    :returns: The :py:mod:`orders <emds.formats.unified.orders>` or
+        :py:mod:`history <emds.formats.unified.history>` module.
+    :raises: ParseError if the message is invalid.
+    """
+    upload_keys = message_dict.get('uploadKeys', False)
+    if upload_keys is False:
+        raise ParseError(
+            "uploadKeys does not exist. At minimum, an empty array is required."
+        )
+    elif not isinstance(upload_keys, list):
+        raise ParseError(
+            "uploadKeys must be an array object."
+        )
+
+    upload_type = message_dict.get('resultType')
+    if upload_type == 'orders':
+        return orders
+    elif upload_type == 'history':
+        return history
+    else:
+        raise ParseError(
+            'Unified message has unknown upload_type: %s' % upload_type)
+
+def parse_from_json(json_str, lazy=False, trusted=False, deduplicator=None,
+                    columnar=False):
     """
     Given a Unified Uploader message, parse the contents and return a
     MarketOrderList or MarketHistoryList instance.
 
     :param str json_str: A Unified Uploader message as a JSON string.
+    :keyword bool lazy: If True, orders and history entries aren't built
+        until their region+item list is accessed. See
+        :py:mod:`emds.formats.unified.lazy`.
+    :keyword bool trusted: If True, skip validating each order or history
+        entry. Only use this on data that EMDS encoded itself, since
+        invalid values will end up in the data structures as-is.
+    :keyword RowsetDeduplicator deduplicator: If given, rowsets that it has
+        already seen are left out. See :py:mod:`emds.formats.unified.dedupe`.
+    :keyword bool columnar: If True, rows are decoded straight into
+        :py:mod:`columnar <emds.columnar>` region+item lists, without
+        building any order or history objects.
     :rtype: MarketOrderList or MarketHistoryList
     :raises: MalformedUploadError when invalid JSON is passed in.
     """
@@ -17,44 +63,288 @@ def parse_from_json(json_str):
     except ValueError:
         raise ParseError("Mal-formed JSON input.")
 
-    upload_keys = message_dict.get('uploadKeys', False)
-    if upload_keys is False:
-        raise ParseError(
-            "uploadKeys does not exist. At minimum, an empty array is required."
-        )
-    elif not isinstance(upload_keys, list):
-        raise ParseError(
-            "uploadKeys must be an array object."
-        )
+    format_module = _get_format_module(message_dict)
 
-    upload_type = message_dict['resultType']
+    if deduplicator is not None and 'rowsets' in message_dict:
+        message_dict['rowsets'] = deduplicator.filter_rowsets(
+            message_dict['rowsets'], message_dict.get('columns'))
 
     try:
-        if upload_type == 'orders':
-            return orders.parse_from_dict(message_dict)
-        elif upload_type == 'history':
-            return history.parse_from_dict(message_dict)
-        else:
-            raise ParseError(
-                'Unified message has unknown upload_type: %s' % upload_type)
+        return format_module.parse_from_dict(
+            message_dict, lazy=lazy, trusted=trusted, columnar=columnar)
     except TypeError as exc:
         # MarketOrder and HistoryEntry both raise TypeError exceptions if
         # invalid input is encountered.
-        raise ParseError(exc.message)
+        raise ParseError(str(exc))
+
+def parse_from_stream(source, lazy=False, trusted=False,
+                      chunk_size=streaming.DEFAULT_CHUNK_SIZE,
+                      deduplicator=None, columnar=False):
+    """
+    Incrementally parses a Unified Uploader message from a file-like object
+    or an iterable of strings, one rowset at a time. Only one rowset needs
+    to be held in memory at once, which makes this suitable for very large
+    messages.
+
+    The first value generated is an empty MarketOrderList or
+    MarketHistoryList carrying the message's upload keys and generator.
+    Each rowset then follows as a MarketItemsInRegionList or
+    HistoryItemsInRegionList. These are *not* added to the list, but you
+    may do so with its ``add_group()`` method.
+
+    If the message's rowsets come before its other top-level fields, they
+    have to be held (undecoded) until the rest turns up.
+
+    .. note:: This is a generator!
+
+    :param source: A file-like object, or an iterable of strings.
+    :keyword bool lazy: If True, orders and history entries aren't built
+        until their region+item list is accessed.
+    :keyword bool trusted: If True, skip validating each order or history
+        entry. Only use this on data that EMDS encoded itself.
+    :keyword int chunk_size: How much to read from file-like objects at a
+        time.
+    :keyword RowsetDeduplicator deduplicator: If given, rowsets that it has
+        already seen are skipped.
+    :keyword bool columnar: If True, rows are decoded straight into
+        :py:mod:`columnar <emds.columnar>` region+item lists.
+    :rtype: generator
+    :raises: ParseError if the message is invalid.
+    """
+    header = {}
+    pending_rowsets = []
+    parse_rowset = None
+
+    try:
+        for key, value in streaming.iter_message_parts(source, chunk_size):
+            if key != 'rowsets':
+                header[key] = value
+                continue
+
+            if parse_rowset is None:
+                for header_key in _HEADER_KEYS:
+                    if header_key not in header:
+                        # Hang on to this until we've seen the whole header.
+                        pending_rowsets.append(value)
+                        break
+                else:
+                    format_module = _get_format_module(header)
+                    market_list, parse_rowset = format_module.parse_header(
+                        header, lazy=lazy, trusted=trusted,
+                        columnar=columnar)
+                    yield market_list
+                    pending_rowsets.append(value)
+            else:
+                pending_rowsets.append(value)
+
+            if parse_rowset is not None:
+                for rowset in pending_rowsets:
+                    if deduplicator is None or not deduplicator.is_duplicate(
+                            rowset, header['columns']):
+                        yield parse_rowset(rowset)
+                pending_rowsets = []
+
+        if parse_rowset is None:
+            for header_key in _HEADER_KEYS:
+                if header_key not in header:
+                    raise ParseError("%s does not exist." % header_key)
+            format_module = _get_format_module(header)
+            market_list, parse_rowset = format_module.parse_header(
+                header, lazy=lazy, trusted=trusted, columnar=columnar)
+            yield market_list
+            for rowset in pending_rowsets:
+                if deduplicator is None or not deduplicator.is_duplicate(
+                        rowset, header['columns']):
+                    yield parse_rowset(rowset)
+    except TypeError as exc:
+        # MarketOrder and HistoryEntry both raise TypeError exceptions if
+        # invalid input is encountered.
+        raise ParseError(str(exc))
+
+def _assemble_market_list(parts):
+    """
+    Adds the region+item lists generated by :py:func:`parse_from_stream` to
+    the order or history list that comes first.
+    """
+    market_list = next(parts)
+    for items_in_region_list in parts:
+        market_list.add_group(items_in_region_list)
+    return market_list
+
+def _iter_slices(data, chunk_size):
+    """
+    Splits a string into chunks, so that it can be fed through
+    :py:func:`streaming.iter_decompressed
+    <emds.formats.unified.streaming.iter_decompressed>` a bit at a time.
+    """
+    for start in xrange(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+def parse_from_compressed_stream(source, lazy=False, trusted=False,
+                                 chunk_size=streaming.DEFAULT_CHUNK_SIZE,
+                                 deduplicator=None, columnar=False):
+    """
+    Like :py:func:`parse_from_stream`, but for zlib-compressed messages
+    (such as those relayed by EMDR). Decompression happens a chunk at a time
+    as the message is parsed, so the decompressed message is never held in
+    memory all at once.
+
+    .. note:: This is a generator!
+
+    :param source: A file-like object, or an iterable of strings.
+    :keyword bool lazy: If True, orders and history entries aren't built
+        until their region+item list is accessed.
+    :keyword bool trusted: If True, skip validating each order or history
+        entry. Only use this on data that EMDS encoded itself.
+    :keyword int chunk_size: How much to read and decompress at a time.
+    :keyword RowsetDeduplicator deduplicator: If given, rowsets that it has
+        already seen are skipped.
+    :keyword bool columnar: If True, rows are decoded straight into
+        :py:mod:`columnar <emds.columnar>` region+item lists.
+    :rtype: generator
+    :raises: ParseError if the message is invalid.
+    """
+    return parse_from_stream(
+        streaming.iter_decompressed(source, chunk_size),
+        lazy=lazy, trusted=trusted, chunk_size=chunk_size,
+        deduplicator=deduplicator, columnar=columnar)
+
+def parse_from_compressed(data, lazy=False, trusted=False,
+                          deduplicator=None, columnar=False):
+    """
+    Given a zlib-compressed Unified Uploader message, parse the contents and
+    return a MarketOrderList or MarketHistoryList instance. This avoids
+    holding both the compressed and decompressed copies of the message, as
+    ``parse_from_json(zlib.decompress(data))`` does.
+
+    :param str data: A zlib-compressed Unified Uploader message.
+    :keyword bool lazy: If True, orders and history entries aren't built
+        until their region+item list is accessed.
+    :keyword bool trusted: If True, skip validating each order or history
+        entry. Only use this on data that EMDS encoded itself.
+    :keyword RowsetDeduplicator deduplicator: If given, rowsets that it has
+        already seen are left out.
+    :keyword bool columnar: If True, rows are decoded straight into
+        :py:mod:`columnar <emds.columnar>` region+item lists.
+    :rtype: MarketOrderList or MarketHistoryList
+    :raises: ParseError if the message is invalid.
+    """
+    chunk_size = streaming.DEFAULT_CHUNK_SIZE
+    return _assemble_market_list(parse_from_compressed_stream(
+        _iter_slices(data, chunk_size), lazy=lazy, trusted=trusted,
+        chunk_size=chunk_size, deduplicator=deduplicator, columnar=columnar))
+
+def parse_many(messages, workers=None, ordered=True, compressed=False,
+               trusted=False, skip_invalid=False, chunksize=1):
+    """
+    Parses a batch of Unified Uploader messages in a pool of worker
+    processes, for when a single process can't keep up. See
+    :py:func:`emds.formats.unified.batch.parse_many` for the details.
+
+    .. note:: This is a generator!
+
+    :param messages: An iterable of messages.
+    :rtype: generator
+    :returns: Generates a MarketOrderList or MarketHistoryList for each
+        message. Their region+item lists are columnar.
+    """
+    return batch.parse_many(
+        messages, workers=workers, ordered=ordered, compressed=compressed,
+        trusted=trusted, skip_invalid=skip_invalid, chunksize=chunksize)
+
+def _get_encoder_module(order_or_history):
+    """
+    Figures out which module encodes the given list.
 
-def encode_to_json(order_or_history):
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :returns: The :py:mod:`orders <emds.formats.unified.orders>` or
+        :py:mod:`history <emds.formats.unified.history>` module.
+    """
+    if isinstance(order_or_history, MarketOrderList):
+        return orders
+    elif isinstance(order_or_history, MarketHistoryList):
+        return history
+    else:
+        raise Exception("Must be one of MarketOrderList or MarketHistoryList.")
+
+def encode_to_json(order_or_history, cache=False):
     """
     Given an order or history entry, encode it to JSON and return.
 
     :type order_or_history: MarketOrderList or MarketHistoryList
     :param order_or_history: A MarketOrderList or MarketHistoryList instance to
         encode to JSON.
+    :keyword bool cache: If True, each encoded rowset is cached on its
+        region+item list, and re-used by later encodes until the list
+        changes. Handy for lists that are re-encoded often, at the cost of
+        keeping an encoded copy around.
     :rtype: str
     :return: The encoded JSON string.
     """
-    if isinstance(order_or_history, MarketOrderList):
-        return orders.encode_to_json(order_or_history)
-    elif isinstance(order_or_history, MarketHistoryList):
-        return history.encode_to_json(order_or_history)
-    else:
-        raise Exception("Must be one of MarketOrderList or MarketHistoryList.")
\ No newline at end of file
+    return _get_encoder_module(order_or_history).encode_to_json(
+        order_or_history, cache=cache)
+
+def iter_encode(order_or_history, cache=False):
+    """
+    Given an order or history entry, encode it to JSON one rowset at a time.
+    This is handy for writing to sockets, compressors, or chunked HTTP
+    responses without building the whole document in memory.
+
+    .. note:: This is a generator!
+
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :param order_or_history: A MarketOrderList or MarketHistoryList instance to
+        encode to JSON.
+    :keyword bool cache: If True, each encoded rowset is cached on its
+        region+item list. See :py:func:`encode_to_json`.
+    :rtype: generator
+    :return: Generates JSON string fragments, which add up to the same thing
+        :py:func:`encode_to_json` returns.
+    """
+    return _get_encoder_module(order_or_history).iter_encode(
+        order_or_history, cache=cache)
+
+def encode_to_stream(order_or_history, fobj):
+    """
+    Given an order or history entry, encode it to JSON and write it to a
+    file-like object, one rowset at a time.
+
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :param order_or_history: A MarketOrderList or MarketHistoryList instance to
+        encode to JSON.
+    :param fobj: A file-like object with a ``write()`` method.
+    """
+    for fragment in iter_encode(order_or_history):
+        fobj.write(fragment)
+
+def iter_encode_compressed(order_or_history,
+                           level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Given an order or history entry, encode it to JSON and zlib-compress it,
+    one rowset at a time.
+
+    .. note:: This is a generator!
+
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :param order_or_history: A MarketOrderList or MarketHistoryList instance to
+        encode.
+    :keyword int level: The zlib compression level.
+    :rtype: generator
+    :return: Generates compressed string fragments.
+    """
+    return streaming.iter_compressed(
+        iter_encode(order_or_history), level=level)
+
+def encode_to_compressed(order_or_history, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Given an order or history entry, encode it to a zlib-compressed JSON
+    message, as EMDR relays them.
+
+    :type order_or_history: MarketOrderList or MarketHistoryList
+    :param order_or_history: A MarketOrderList or MarketHistoryList instance to
+        encode.
+    :keyword int level: The zlib compression level.
+    :rtype: str
+    :return: The compressed message.
+    """
+    return ''.join(iter_encode_compressed(order_or_history, level=level))
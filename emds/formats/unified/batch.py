@@ -0,0 +1,115 @@
+"""
+Parses batches of Unified Uploader messages in a pool of worker processes.
+
+Pickling millions of :py:class:`MarketOrder <emds.data_structures.MarketOrder>`
+instances to get them back out of a worker would cost nearly as much as
+parsing them in the first place. Workers instead decode each message's rows
+straight into :py:mod:`columnar <emds.columnar>` region+item lists, which
+pickle as a handful of flat arrays. No order or history objects are built
+in the workers at all.
+
+See :py:func:`emds.formats.unified.parse_many` for the public interface.
+"""
+import logging
+import multiprocessing
+from emds.data_structures import MarketOrderList
+from emds.exceptions import EMDSError
+from emds.formats.exceptions import ParseError
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_to_columns(job):
+    """
+    Runs in the worker processes. Parses a single message, and boils it
+    down to something that is cheap to pickle.
+
+    :param tuple job: A ``(message, compressed, trusted)`` tuple.
+    :rtype: tuple
+    :returns: ``(list class, upload keys, generator, columnar groups)``, or
+        ``(None, error message)`` if the message couldn't be parsed.
+    """
+    # Imported here to avoid a circular import.
+    from emds.formats import unified
+
+    message, compressed, trusted = job
+    try:
+        if compressed:
+            market_list = unified.parse_from_compressed(
+                message, trusted=trusted, columnar=True)
+        else:
+            market_list = unified.parse_from_json(
+                message, trusted=trusted, columnar=True)
+    except ParseError as exc:
+        return None, str(exc)
+    except (EMDSError, KeyError, ValueError, TypeError) as exc:
+        # Well-formed JSON can still be nonsense, like a rowset that's
+        # missing a key or repeats another's region and type. These are
+        # reported the same way, rather than taking the whole batch down.
+        return None, '%s: %s' % (type(exc).__name__, exc)
+
+    if isinstance(market_list, MarketOrderList):
+        generator = market_list.order_generator
+        groups = list(market_list.get_all_order_groups())
+    else:
+        generator = market_list.history_generator
+        groups = list(market_list.get_all_entries_grouped())
+    return type(market_list), market_list.upload_keys, generator, groups
+
+def _build_market_list(result):
+    """
+    Turns a worker's result back into a MarketOrderList or
+    MarketHistoryList.
+    """
+    list_class, upload_keys, generator, groups = result
+    market_list = list_class(upload_keys, generator)
+    for group in groups:
+        market_list.add_group(group)
+    return market_list
+
+def parse_many(messages, workers=None, ordered=True, compressed=False,
+               trusted=False, skip_invalid=False, chunksize=1):
+    """
+    Parses Unified Uploader messages in a pool of worker processes.
+
+    .. note:: This is a generator!
+
+    :param messages: An iterable of messages (JSON strings, or
+        zlib-compressed JSON strings if ``compressed`` is True).
+    :keyword int workers: How many worker processes to start. Defaults to
+        the number of CPUs.
+    :keyword bool ordered: If True, results are generated in the same order
+        as ``messages``. If False, they're generated as soon as they're
+        ready.
+    :keyword bool compressed: If True, the messages are zlib-compressed, as
+        EMDR relays them.
+    :keyword bool trusted: If True, skip validating each order or history
+        entry. Only use this on data that EMDS encoded itself.
+    :keyword bool skip_invalid: If True, messages that fail to parse are
+        logged and skipped, rather than raising ParseError.
+    :keyword int chunksize: How many messages to send to a worker at a
+        time. Larger values help with lots of small messages.
+    :rtype: generator
+    :returns: Generates a MarketOrderList or MarketHistoryList for each
+        message. Their region+item lists are columnar.
+    :raises: ParseError if a message is invalid, and ``skip_invalid`` is
+        False.
+    """
+    pool = multiprocessing.Pool(workers)
+    try:
+        jobs = ((message, compressed, trusted) for message in messages)
+        if ordered:
+            results = pool.imap(_parse_to_columns, jobs, chunksize)
+        else:
+            results = pool.imap_unordered(_parse_to_columns, jobs, chunksize)
+
+        for result in results:
+            if result[0] is None:
+                if skip_invalid:
+                    logger.warning('Skipping invalid message: %s', result[1])
+                    continue
+                raise ParseError(result[1])
+            yield _build_market_list(result)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,114 @@
+"""
+Duplicate rowset detection. EMDR relays the same market data from several
+uploaders, so the same rowset tends to turn up a number of times. Passing a
+:py:class:`RowsetDeduplicator` to the Unified parsers skips rowsets that have
+already been seen, before any orders or history entries are built for them.
+"""
+import hashlib
+from collections import OrderedDict
+from emds.compat import json
+
+# How many rowset fingerprints to remember by default.
+DEFAULT_MAX_SIZE = 100000
+
+
+class RowsetDeduplicator(object):
+    """
+    Remembers the fingerprints of recently seen rowsets. Once full, the
+    least recently seen fingerprint is forgotten to make room for the next.
+
+    A rowset's fingerprint covers its regionID, typeID, generatedAt, and
+    rows, along with the message's column list.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        """
+        :keyword int max_size: The most fingerprints to remember.
+        """
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        #: How many rowsets have been checked.
+        self.rowset_count = 0
+        #: How many of those were duplicates.
+        self.duplicate_count = 0
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of fingerprints currently remembered.
+        """
+        return len(self._seen)
+
+    @property
+    def duplicate_ratio(self):
+        """
+        The fraction of checked rowsets that were duplicates.
+
+        :rtype: float
+        """
+        if not self.rowset_count:
+            return 0.0
+        return float(self.duplicate_count) / self.rowset_count
+
+    def fingerprint(self, rowset, columns=None):
+        """
+        :param dict rowset: A decoded rowset.
+        :keyword list columns: The message's column list.
+        :rtype: str
+        :returns: A digest of the rowset's contents.
+        """
+        encoded = json.dumps([
+            rowset.get('regionID'),
+            rowset.get('typeID'),
+            rowset.get('generatedAt'),
+            columns,
+            rowset.get('rows'),
+        ])
+        if isinstance(encoded, unicode):
+            encoded = encoded.encode('utf-8')
+        return hashlib.sha1(encoded).digest()
+
+    def is_duplicate(self, rowset, columns=None):
+        """
+        Checks whether a rowset has been seen recently, and remembers it if
+        not.
+
+        :param dict rowset: A decoded rowset.
+        :keyword list columns: The message's column list.
+        :rtype: bool
+        :returns: True if the rowset is a duplicate.
+        """
+        key = self.fingerprint(rowset, columns)
+        self.rowset_count += 1
+        seen = self._seen
+
+        if key in seen:
+            self.duplicate_count += 1
+            # Move it to the most recently seen end.
+            del seen[key]
+            seen[key] = True
+            return True
+
+        seen[key] = True
+        if len(seen) > self.max_size:
+            seen.popitem(last=False)
+        return False
+
+    def filter_rowsets(self, rowsets, columns=None):
+        """
+        :param list rowsets: A list of decoded rowsets.
+        :keyword list columns: The message's column list.
+        :rtype: list
+        :returns: The rowsets that aren't duplicates.
+        """
+        return [
+            rowset for rowset in rowsets
+            if not self.is_duplicate(rowset, columns)]
+
+    def reset_stats(self):
+        """
+        Zeroes the rowset and duplicate counts, leaving the remembered
+        fingerprints alone.
+        """
+        self.rowset_count = 0
+        self.duplicate_count = 0
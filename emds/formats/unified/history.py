@@ -2,10 +2,15 @@
 Parser for the Unified uploader format market history.
 """
 import logging
+from functools import partial
+from itertools import izip
 from emds.compat import json
-from emds.data_structures import MarketHistoryList, MarketHistoryEntry
+from emds.columnar import ColumnarHistoryItemsInRegionList
+from emds.data_structures import MarketHistoryList, MarketHistoryEntry, HistoryItemsInRegionList
+from emds.formats.exceptions import ParseError
+from emds.formats.unified.lazy import LazyHistoryItemsInRegionList
 from emds.common_utils import  now_dtime_in_utc
-from emds.formats.unified.unified_utils import _columns_to_kwargs, gen_iso_datetime_str, parse_datetime
+from emds.formats.unified.unified_utils import ENCODED_CACHE_KEY, compile_column_decoder, compile_row_decoder, gen_iso_datetime_str, iter_encoded_message, parse_datetime, parse_timestamp
 
 logger = logging.getLogger(__name__)
 
@@ -27,90 +32,227 @@ SPEC_TO_KWARG_CONVERSION = {
     'quantity': 'total_quantity',
 }
 
-def parse_from_dict(json_dict):
+# The conversions that MarketHistoryEntry's constructor would do, for
+# decoding rows straight into columnar containers.
+COLUMN_CONVERTERS = (
+    ('historical_date', parse_timestamp),
+    ('num_orders', int),
+    ('low_price', float),
+    ('high_price', float),
+    ('average_price', float),
+    ('total_quantity', int),
+)
+# Trusted values are used as-is, aside from the conversions that the
+# columnar format itself needs.
+TRUSTED_COLUMN_CONVERTERS = tuple([
+    (kwarg_name, converter if kwarg_name == 'historical_date' else None)
+    for kwarg_name, converter in COLUMN_CONVERTERS])
+
+def parse_header(json_dict, lazy=False, trusted=False, columnar=False):
     """
-    Given a Unified Uploader message, parse the contents and return a
-    MarketHistoryList instance.
+    Parses everything but the rowsets of a Unified Uploader message.
 
-    :param dict json_dict: A Unified Uploader message as a dict.
-    :rtype: MarketOrderList
-    :returns: An instance of MarketOrderList, containing the orders
-        within.
+    :param dict json_dict: A Unified Uploader message as a dict. The rowsets
+        don't need to be present.
+    :keyword bool lazy: If True, the rowset parser returns region+item lists
+        that hang on to the raw rows, and only build
+        :py:class:`MarketHistoryEntry` instances the first time that their
+        entries are accessed. Invalid rows won't be noticed until then.
+    :keyword bool trusted: If True, the rows are assumed to be valid, and
+        :py:meth:`MarketHistoryEntry.from_trusted_row` is used to skip the
+        usual validation. Only use this on data that EMDS encoded itself.
+    :keyword bool columnar: If True, the rowset parser decodes rows straight
+        into :py:class:`ColumnarHistoryItemsInRegionList
+        <emds.columnar.ColumnarHistoryItemsInRegionList>` instances, without
+        building any MarketHistoryEntry instances. Takes precedence over
+        ``lazy``.
+    :rtype: tuple
+    :returns: A tuple containing an empty MarketHistoryList, and a function
+        that parses a single rowset dict into a HistoryItemsInRegionList.
     """
-    history_columns = json_dict['columns']
+    if trusted:
+        record_factory = MarketHistoryEntry.from_trusted_row
+    else:
+        record_factory = MarketHistoryEntry
+    decode_row = compile_row_decoder(
+        record_factory, SPEC_TO_KWARG_CONVERSION, json_dict['columns'],
+        datetime_kwargs=('historical_date',))
+    if columnar:
+        decode_rows = compile_column_decoder(
+            SPEC_TO_KWARG_CONVERSION, json_dict['columns'],
+            TRUSTED_COLUMN_CONVERTERS if trusted else COLUMN_CONVERTERS)
+        column_names = [kwarg_name for kwarg_name, _ in COLUMN_CONVERTERS]
 
     history_list = MarketHistoryList(
         upload_keys=json_dict['uploadKeys'],
         history_generator=json_dict['generator'],
     )
 
-    for rowset in json_dict['rowsets']:
+    def parse_rowset(rowset):
         generated_at = parse_datetime(rowset['generatedAt'])
         region_id = rowset['regionID']
         type_id = rowset['typeID']
-        history_list.set_empty_region(region_id, type_id, generated_at)
 
-        for row in rowset['rows']:
-            history_kwargs = _columns_to_kwargs(
-                SPEC_TO_KWARG_CONVERSION, history_columns, row)
-            historical_date = parse_datetime(history_kwargs['historical_date'])
+        if columnar:
+            entry_list = ColumnarHistoryItemsInRegionList(
+                region_id, type_id, generated_at)
+            try:
+                values = decode_rows(rowset['rows'])
+            except IndexError:
+                raise ParseError(
+                    "Row has fewer values than there are columns.")
+            except (TypeError, ValueError) as exc:
+                raise ParseError(str(exc))
+            entry_list.extend_columns(dict(izip(column_names, values)))
+            return entry_list
+
+        if lazy:
+            row_to_entry = partial(
+                decode_row, region_id=region_id, type_id=type_id,
+                generated_at=generated_at)
+            return LazyHistoryItemsInRegionList(
+                region_id, type_id, generated_at, rowset['rows'],
+                row_to_entry)
 
-            history_kwargs.update({
-                'type_id': type_id,
-                'region_id': region_id,
-                'historical_date': historical_date,
-                'generated_at': generated_at,
-            })
+        entry_list = HistoryItemsInRegionList(
+            region_id, type_id, generated_at)
+        try:
+            for row in rowset['rows']:
+                entry_list.add_entry(
+                    decode_row(row, region_id, type_id, generated_at))
+        except IndexError:
+            raise ParseError("Row has fewer values than there are columns.")
+        return entry_list
 
-            history_list.add_entry(MarketHistoryEntry(**history_kwargs))
+    return history_list, parse_rowset
+
+def parse_from_dict(json_dict, lazy=False, trusted=False, columnar=False):
+    """
+    Given a Unified Uploader message, parse the contents and return a
+    MarketHistoryList instance.
+
+    :param dict json_dict: A Unified Uploader message as a dict.
+    :keyword bool lazy: If True, the region+item lists hang on to the raw
+        rows, and only build :py:class:`MarketHistoryEntry` instances the
+        first time that their entries are accessed. Invalid rows won't be
+        noticed until then.
+    :keyword bool trusted: If True, the rows are assumed to be valid, and
+        :py:meth:`MarketHistoryEntry.from_trusted_row` is used to skip the
+        usual validation. Only use this on data that EMDS encoded itself.
+    :keyword bool columnar: If True, the region+item lists are
+        :py:class:`ColumnarHistoryItemsInRegionList
+        <emds.columnar.ColumnarHistoryItemsInRegionList>` instances, filled
+        straight from the rows.
+    :rtype: MarketOrderList
+    :returns: An instance of MarketOrderList, containing the orders
+        within.
+    """
+    history_list, parse_rowset = parse_header(
+        json_dict, lazy=lazy, trusted=trusted, columnar=columnar)
+
+    for rowset in json_dict['rowsets']:
+        history_list.add_group(parse_rowset(rowset))
 
     return history_list
 
-def encode_to_json(history_list):
+def _encode_rowset(items_in_region_list):
     """
-    Encodes this MarketHistoryList instance to a JSON string.
+    Does the actual work for :py:func:`encode_rowset`.
 
-    :param MarketHistoryList history_list: The history instance to serialize.
+    :param HistoryItemsInRegionList items_in_region_list: The region+item
+        list to serialize.
     :rtype: str
     """
-    rowsets = []
-    for items_in_region_list in history_list._history.values():
-        region_id = items_in_region_list.region_id
-        type_id = items_in_region_list.type_id
-        generated_at = gen_iso_datetime_str(items_in_region_list.generated_at)
-
-        rows = []
-        for entry in items_in_region_list.entries:
-            historical_date = gen_iso_datetime_str(entry.historical_date)
-
-            # The order in which these values are added is crucial. It must
-            # match STANDARD_ENCODED_COLUMNS.
-            rows.append([
-                historical_date,
-                entry.num_orders,
-                entry.total_quantity,
-                entry.low_price,
-                entry.high_price,
-                entry.average_price,
-            ])
-
-        rowsets.append(dict(
-            generatedAt = generated_at,
-            regionID = region_id,
-            typeID = type_id,
-            rows = rows,
-        ))
-
-    json_dict = {
+    region_id = items_in_region_list.region_id
+    type_id = items_in_region_list.type_id
+    generated_at = gen_iso_datetime_str(items_in_region_list.generated_at)
+
+    rows = []
+    for entry in items_in_region_list.entries:
+        historical_date = gen_iso_datetime_str(entry.historical_date)
+
+        # The order in which these values are added is crucial. It must
+        # match STANDARD_ENCODED_COLUMNS.
+        rows.append([
+            historical_date,
+            entry.num_orders,
+            entry.total_quantity,
+            entry.low_price,
+            entry.high_price,
+            entry.average_price,
+        ])
+
+    return json.dumps(dict(
+        generatedAt = generated_at,
+        regionID = region_id,
+        typeID = type_id,
+        rows = rows,
+    ))
+
+def encode_rowset(items_in_region_list, cache=False):
+    """
+    Encodes a single region+item list to a JSON rowset object. A copy cached
+    on the region+item list is re-used if there is one, so re-encoding lists
+    that are mostly unchanged is cheap.
+
+    :param HistoryItemsInRegionList items_in_region_list: The region+item
+        list to serialize.
+    :keyword bool cache: If True, the result is cached on the region+item
+        list, until it is changed. This keeps a second copy of the data
+        around, in encoded form.
+    :rtype: str
+    """
+    encoded_cache = getattr(items_in_region_list, '_encoded_cache', None)
+    if encoded_cache is None:
+        # Not one of ours, so there's nowhere to cache the result.
+        return _encode_rowset(items_in_region_list)
+
+    fragment = encoded_cache.get(ENCODED_CACHE_KEY)
+    if fragment is None:
+        fragment = _encode_rowset(items_in_region_list)
+        if cache:
+            encoded_cache[ENCODED_CACHE_KEY] = fragment
+    return fragment
+
+def iter_encode(history_list, cache=False):
+    """
+    Encodes this MarketHistoryList instance to JSON, one rowset at a time.
+    Joining the fragments together results in the same document as
+    :py:func:`encode_to_json`, but only one rowset's worth is held in
+    memory at once.
+
+    .. note:: This is a generator!
+
+    :param MarketHistoryList history_list: The history instance to serialize.
+    :keyword bool cache: If True, each rowset is cached on its region+item
+        list. See :py:func:`encode_rowset`. Leaving this off keeps memory
+        use down to one rowset's worth.
+    :rtype: generator
+    :returns: Generates JSON string fragments.
+    """
+    header_dict = {
         'resultType': 'history',
         'version': '0.1',
         'uploadKeys': history_list.upload_keys,
         'generator': history_list.history_generator,
         'currentTime': gen_iso_datetime_str(now_dtime_in_utc()),
-        # This must match the order of the values in the row assembling portion
-        # above this.
+        # This must match the order of the values in the row assembling
+        # portion of encode_rowset().
         'columns': STANDARD_ENCODED_COLUMNS,
-        'rowsets': rowsets,
     }
+    rowset_fragments = (
+        encode_rowset(items_in_region_list, cache=cache)
+        for items_in_region_list in history_list.get_all_entries_grouped())
+
+    return iter_encoded_message(header_dict, rowset_fragments)
 
-    return json.dumps(json_dict)
\ No newline at end of file
+def encode_to_json(history_list, cache=False):
+    """
+    Encodes this MarketHistoryList instance to a JSON string.
+
+    :param MarketHistoryList history_list: The history instance to serialize.
+    :keyword bool cache: If True, each rowset is cached on its region+item
+        list. See :py:func:`encode_rowset`.
+    :rtype: str
+    """
+    return ''.join(iter_encode(history_list, cache=cache))
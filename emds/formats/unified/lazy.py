@@ -0,0 +1,177 @@
+"""
+Region+item lists that are backed by the raw rows of a decoded Unified
+message. These are what the parsers return when ``lazy=True`` is passed.
+:py:class:`MarketOrder <emds.data_structures.MarketOrder>` and
+:py:class:`MarketHistoryEntry <emds.data_structures.MarketHistoryEntry>`
+instances (and their datetimes) are only built the first time a region+item
+list's orders or entries are accessed. Consumers that only look at the
+message header, or a handful of rowsets, skip the rest of the work.
+"""
+from emds.data_structures import MarketItemsInRegionList, \
+    HistoryItemsInRegionList
+from emds.formats.exceptions import ParseError
+
+class LazyMarketItemsInRegionList(MarketItemsInRegionList):
+    """
+    A :py:class:`MarketItemsInRegionList
+    <emds.data_structures.MarketItemsInRegionList>` that builds its orders
+    from raw rows on first access. Its length and order IDs are available
+    without building anything.
+    """
+
+    def __init__(self, region_id, type_id, generated_at, rows, row_to_order,
+                 order_id_column):
+        """
+        :param int region_id: The region ID that the data set pertains to.
+        :param int type_id: The type ID of the item contained in the order set.
+        :param datetime.datetime generated_at: When the data set was first
+            generated.
+        :param list rows: The rowset's raw rows.
+        :param callable row_to_order: Builds a MarketOrder from a raw row.
+        :param int order_id_column: The position of the order ID within
+            each row.
+        """
+        super(LazyMarketItemsInRegionList, self).__init__(
+            region_id, type_id, generated_at)
+        self._raw_rows = rows
+        self._row_to_order = row_to_order
+        self._order_id_column = order_id_column
+
+    def _get_orders(self):
+        self._materialize()
+        return self._materialized_orders
+
+    def _set_orders(self, orders):
+        self._materialized_orders = orders
+
+    #: A list of MarketOrder objects, built on first access.
+    orders = property(_get_orders, _set_orders)
+
+    def _materialize(self):
+        """
+        Builds MarketOrder instances for the raw rows, if that hasn't
+        happened yet.
+        """
+        if self._raw_rows is None:
+            return
+
+        # Nothing is published until every row has converted, so that a bad
+        # row leaves the raw rows in place rather than a partial list.
+        try:
+            orders = [self._row_to_order(row) for row in self._raw_rows]
+        except IndexError:
+            raise ParseError("Row has fewer values than there are columns.")
+        except (TypeError, ValueError, KeyError) as exc:
+            # MarketOrder raises TypeError exceptions if invalid input is
+            # encountered, and the column conversions raise ValueError.
+            raise ParseError(str(exc))
+
+        self._raw_rows = None
+        add_order = super(LazyMarketItemsInRegionList, self).add_order
+        for order in orders:
+            add_order(order)
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of orders contained within the region list.
+        """
+        if self._raw_rows is not None:
+            return len(self._raw_rows)
+        return len(self._materialized_orders)
+
+    def __contains__(self, item):
+        self._materialize()
+        return super(LazyMarketItemsInRegionList, self).__contains__(item)
+
+    def get_order(self, order_id):
+        self._materialize()
+        return super(LazyMarketItemsInRegionList, self).get_order(order_id)
+
+    def get_order_ids(self):
+        """
+        :rtype: list
+        :returns: The order IDs of all orders within this region+item list.
+            These are read straight from the raw rows if the orders haven't
+            been built yet.
+        :raises: ParseError if a row is short, or has an invalid order ID.
+        """
+        if self._raw_rows is not None:
+            column = self._order_id_column
+            try:
+                return [int(row[column]) for row in self._raw_rows]
+            except IndexError:
+                raise ParseError(
+                    "Row has fewer values than there are columns.")
+            except (TypeError, ValueError, KeyError) as exc:
+                raise ParseError(str(exc))
+        return super(LazyMarketItemsInRegionList, self).get_order_ids()
+
+    def add_order(self, order):
+        self._materialize()
+        super(LazyMarketItemsInRegionList, self).add_order(order)
+
+
+class LazyHistoryItemsInRegionList(HistoryItemsInRegionList):
+    """
+    A :py:class:`HistoryItemsInRegionList
+    <emds.data_structures.HistoryItemsInRegionList>` that builds its entries
+    from raw rows on first access. Its length is available without building
+    anything.
+    """
+
+    def __init__(self, region_id, type_id, generated_at, rows, row_to_entry):
+        """
+        :param int region_id: The region ID that the data set pertains to.
+        :param int type_id: The type ID of the item contained in the order set.
+        :param datetime.datetime generated_at: When the data set was first
+            generated.
+        :param list rows: The rowset's raw rows.
+        :param callable row_to_entry: Builds a MarketHistoryEntry from a raw
+            row.
+        """
+        super(LazyHistoryItemsInRegionList, self).__init__(
+            region_id, type_id, generated_at)
+        self._raw_rows = rows
+        self._row_to_entry = row_to_entry
+
+    def _get_entries(self):
+        self._materialize()
+        return self._materialized_entries
+
+    def _set_entries(self, entries):
+        self._materialized_entries = entries
+
+    #: A list of MarketHistoryEntry objects, built on first access.
+    entries = property(_get_entries, _set_entries)
+
+    def _materialize(self):
+        """
+        Builds MarketHistoryEntry instances for the raw rows, if that hasn't
+        happened yet.
+        """
+        if self._raw_rows is None:
+            return
+
+        # Nothing is published until every row has converted, so that a bad
+        # row leaves the raw rows in place rather than a partial list.
+        try:
+            entries = [self._row_to_entry(row) for row in self._raw_rows]
+        except IndexError:
+            raise ParseError("Row has fewer values than there are columns.")
+        except (TypeError, ValueError, KeyError) as exc:
+            # MarketHistoryEntry raises TypeError exceptions if invalid input
+            # is encountered, and the column conversions raise ValueError.
+            raise ParseError(str(exc))
+
+        self._raw_rows = None
+        self._materialized_entries.extend(entries)
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of entries contained within the region list.
+        """
+        if self._raw_rows is not None:
+            return len(self._raw_rows)
+        return len(self._materialized_entries)
@@ -2,10 +2,15 @@
 Parser for the Unified uploader format orders.
 """
 import logging
+from functools import partial
+from itertools import izip
 from emds.compat import json
 from emds.common_utils import  now_dtime_in_utc
-from emds.formats.unified.unified_utils import _columns_to_kwargs, gen_iso_datetime_str, parse_datetime
-from emds.data_structures import MarketOrder, MarketOrderList
+from emds.formats.unified.unified_utils import ENCODED_CACHE_KEY, compile_column_decoder, compile_row_decoder, gen_iso_datetime_str, iter_encoded_message, parse_datetime, parse_timestamp
+from emds.columnar import ColumnarItemsInRegionList
+from emds.data_structures import MarketOrder, MarketOrderList, MarketItemsInRegionList
+from emds.formats.exceptions import ParseError
+from emds.formats.unified.lazy import LazyMarketItemsInRegionList
 
 logger = logging.getLogger(__name__)
 
@@ -34,94 +39,251 @@ SPEC_TO_KWARG_CONVERSION = {
     'solarSystemID': 'solar_system_id',
 }
 
-def parse_from_dict(json_dict):
+def _check_is_bid(value):
     """
-    Given a Unified Uploader message, parse the contents and return a
-    MarketOrderList.
+    MarketOrder insists on a real bool, so the columnar path does too.
+    """
+    if not isinstance(value, bool):
+        raise TypeError('is_bid should be a bool.')
+    return value
 
-    :param dict json_dict: A Unified Uploader message as a JSON dict.
-    :rtype: MarketOrderList
-    :returns: An instance of MarketOrderList, containing the orders
-        within.
+def _id_or_zero(value):
+    """
+    Columnar containers store missing solar system IDs as 0.
+    """
+    return int(value) if value else 0
+
+# The conversions that MarketOrder's constructor would do, for decoding rows
+# straight into columnar containers.
+COLUMN_CONVERTERS = (
+    ('order_id', int),
+    ('is_bid', _check_is_bid),
+    ('solar_system_id', _id_or_zero),
+    ('station_id', int),
+    ('price', float),
+    ('volume_entered', int),
+    ('volume_remaining', int),
+    ('minimum_volume', int),
+    ('order_issue_date', parse_timestamp),
+    ('order_duration', int),
+    ('order_range', int),
+)
+# Trusted values are used as-is, aside from the conversions that the
+# columnar format itself needs.
+TRUSTED_COLUMN_CONVERTERS = tuple([
+    (kwarg_name, converter if kwarg_name in (
+        'solar_system_id', 'order_issue_date') else None)
+    for kwarg_name, converter in COLUMN_CONVERTERS])
+
+def parse_header(json_dict, lazy=False, trusted=False, columnar=False):
+    """
+    Parses everything but the rowsets of a Unified Uploader message.
+
+    :param dict json_dict: A Unified Uploader message as a JSON dict. The
+        rowsets don't need to be present.
+    :keyword bool lazy: If True, the rowset parser returns region+item lists
+        that hang on to the raw rows, and only build :py:class:`MarketOrder`
+        instances the first time that their orders are accessed. Invalid
+        rows won't be noticed until then.
+    :keyword bool trusted: If True, the rows are assumed to be valid, and
+        :py:meth:`MarketOrder.from_trusted_row` is used to skip the usual
+        validation. Only use this on data that EMDS encoded itself.
+    :keyword bool columnar: If True, the rowset parser decodes rows straight
+        into :py:class:`ColumnarItemsInRegionList
+        <emds.columnar.ColumnarItemsInRegionList>` instances, without
+        building any MarketOrder instances. Takes precedence over ``lazy``.
+    :rtype: tuple
+    :returns: A tuple containing an empty MarketOrderList, and a function
+        that parses a single rowset dict into a MarketItemsInRegionList.
     """
     order_columns = json_dict['columns']
+    if trusted:
+        record_factory = MarketOrder.from_trusted_row
+    else:
+        record_factory = MarketOrder
+    decode_row = compile_row_decoder(
+        record_factory, SPEC_TO_KWARG_CONVERSION, order_columns,
+        datetime_kwargs=('order_issue_date',))
+    order_id_column = order_columns.index('orderID')
+    if columnar:
+        decode_rows = compile_column_decoder(
+            SPEC_TO_KWARG_CONVERSION, order_columns,
+            TRUSTED_COLUMN_CONVERTERS if trusted else COLUMN_CONVERTERS)
+        column_names = [kwarg_name for kwarg_name, _ in COLUMN_CONVERTERS]
 
     order_list = MarketOrderList(
         upload_keys=json_dict['uploadKeys'],
         order_generator=json_dict['generator'],
     )
 
-    for rowset in json_dict['rowsets']:
+    def parse_rowset(rowset):
         generated_at = parse_datetime(rowset['generatedAt'])
         region_id = rowset['regionID']
         type_id = rowset['typeID']
-        order_list.set_empty_region(region_id, type_id, generated_at)
 
-        for row in rowset['rows']:
-            order_kwargs = _columns_to_kwargs(
-                SPEC_TO_KWARG_CONVERSION, order_columns, row)
-            order_kwargs.update({
-                'region_id': region_id,
-                'type_id': type_id,
-                'generated_at': generated_at,
-            })
+        if columnar:
+            olist = ColumnarItemsInRegionList(region_id, type_id, generated_at)
+            try:
+                values = decode_rows(rowset['rows'])
+            except IndexError:
+                raise ParseError(
+                    "Row has fewer values than there are columns.")
+            except (TypeError, ValueError) as exc:
+                raise ParseError(str(exc))
+            olist.extend_columns(dict(izip(column_names, values)))
+            return olist
+
+        if lazy:
+            row_to_order = partial(
+                decode_row, region_id=region_id, type_id=type_id,
+                generated_at=generated_at)
+            return LazyMarketItemsInRegionList(
+                region_id, type_id, generated_at, rowset['rows'],
+                row_to_order, order_id_column)
 
-            order_kwargs['order_issue_date'] = parse_datetime(order_kwargs['order_issue_date'])
+        olist = MarketItemsInRegionList(region_id, type_id, generated_at)
+        try:
+            for row in rowset['rows']:
+                olist.add_order(
+                    decode_row(row, region_id, type_id, generated_at))
+        except IndexError:
+            raise ParseError("Row has fewer values than there are columns.")
+        return olist
 
-            order_list.add_order(MarketOrder(**order_kwargs))
+    return order_list, parse_rowset
+
+def parse_from_dict(json_dict, lazy=False, trusted=False, columnar=False):
+    """
+    Given a Unified Uploader message, parse the contents and return a
+    MarketOrderList.
+
+    :param dict json_dict: A Unified Uploader message as a JSON dict.
+    :keyword bool lazy: If True, the region+item lists hang on to the raw
+        rows, and only build :py:class:`MarketOrder` instances the first
+        time that their orders are accessed. Invalid rows won't be noticed
+        until then.
+    :keyword bool trusted: If True, the rows are assumed to be valid, and
+        :py:meth:`MarketOrder.from_trusted_row` is used to skip the usual
+        validation. Only use this on data that EMDS encoded itself.
+    :keyword bool columnar: If True, the region+item lists are
+        :py:class:`ColumnarItemsInRegionList
+        <emds.columnar.ColumnarItemsInRegionList>` instances, filled
+        straight from the rows.
+    :rtype: MarketOrderList
+    :returns: An instance of MarketOrderList, containing the orders
+        within.
+    """
+    order_list, parse_rowset = parse_header(
+        json_dict, lazy=lazy, trusted=trusted, columnar=columnar)
+
+    for rowset in json_dict['rowsets']:
+        order_list.add_group(parse_rowset(rowset))
 
     return order_list
 
-def encode_to_json(order_list):
+def _encode_rowset(items_in_region_list):
     """
-    Encodes this list of MarketOrder instances to a JSON string.
+    Does the actual work for :py:func:`encode_rowset`.
 
-    :param MarketOrderList order_list: The order list to serialize.
+    :param MarketItemsInRegionList items_in_region_list: The region+item
+        list to serialize.
     :rtype: str
     """
-    rowsets = []
-    for items_in_region_list in order_list._orders.values():
-        region_id = items_in_region_list.region_id
-        type_id = items_in_region_list.type_id
-        generated_at = gen_iso_datetime_str(items_in_region_list.generated_at)
-
-        rows = []
-        for order in items_in_region_list.orders:
-            issue_date = gen_iso_datetime_str(order.order_issue_date)
-
-            # The order in which these values are added is crucial. It must
-            # match STANDARD_ENCODED_COLUMNS.
-            rows.append([
-                order.price,
-                order.volume_remaining,
-                order.order_range,
-                order.order_id,
-                order.volume_entered,
-                order.minimum_volume,
-                order.is_bid,
-                issue_date,
-                order.order_duration,
-                order.station_id,
-                order.solar_system_id,
-            ])
-
-        rowsets.append(dict(
-            generatedAt = generated_at,
-            regionID = region_id,
-            typeID = type_id,
-            rows = rows,
-        ))
-
-    json_dict = {
+    region_id = items_in_region_list.region_id
+    type_id = items_in_region_list.type_id
+    generated_at = gen_iso_datetime_str(items_in_region_list.generated_at)
+
+    rows = []
+    for order in items_in_region_list.orders:
+        issue_date = gen_iso_datetime_str(order.order_issue_date)
+
+        # The order in which these values are added is crucial. It must
+        # match STANDARD_ENCODED_COLUMNS.
+        rows.append([
+            order.price,
+            order.volume_remaining,
+            order.order_range,
+            order.order_id,
+            order.volume_entered,
+            order.minimum_volume,
+            order.is_bid,
+            issue_date,
+            order.order_duration,
+            order.station_id,
+            order.solar_system_id,
+        ])
+
+    return json.dumps(dict(
+        generatedAt = generated_at,
+        regionID = region_id,
+        typeID = type_id,
+        rows = rows,
+    ))
+
+def encode_rowset(items_in_region_list, cache=False):
+    """
+    Encodes a single region+item list to a JSON rowset object. A copy cached
+    on the region+item list is re-used if there is one, so re-encoding lists
+    that are mostly unchanged is cheap.
+
+    :param MarketItemsInRegionList items_in_region_list: The region+item
+        list to serialize.
+    :keyword bool cache: If True, the result is cached on the region+item
+        list, until it is changed. This keeps a second copy of the data
+        around, in encoded form.
+    :rtype: str
+    """
+    encoded_cache = getattr(items_in_region_list, '_encoded_cache', None)
+    if encoded_cache is None:
+        # Not one of ours, so there's nowhere to cache the result.
+        return _encode_rowset(items_in_region_list)
+
+    fragment = encoded_cache.get(ENCODED_CACHE_KEY)
+    if fragment is None:
+        fragment = _encode_rowset(items_in_region_list)
+        if cache:
+            encoded_cache[ENCODED_CACHE_KEY] = fragment
+    return fragment
+
+def iter_encode(order_list, cache=False):
+    """
+    Encodes this list of MarketOrder instances to JSON, one rowset at a
+    time. Joining the fragments together results in the same document as
+    :py:func:`encode_to_json`, but only one rowset's worth is held in
+    memory at once.
+
+    .. note:: This is a generator!
+
+    :param MarketOrderList order_list: The order list to serialize.
+    :keyword bool cache: If True, each rowset is cached on its region+item
+        list. See :py:func:`encode_rowset`. Leaving this off keeps memory
+        use down to one rowset's worth.
+    :rtype: generator
+    :returns: Generates JSON string fragments.
+    """
+    header_dict = {
         'resultType': 'orders',
         'version': '0.1',
         'uploadKeys': order_list.upload_keys,
         'generator': order_list.order_generator,
         'currentTime': gen_iso_datetime_str(now_dtime_in_utc()),
-        # This must match the order of the values in the row assembling portion
-        # above this.
+        # This must match the order of the values in the row assembling
+        # portion of encode_rowset().
         'columns': STANDARD_ENCODED_COLUMNS,
-        'rowsets': rowsets,
     }
+    rowset_fragments = (
+        encode_rowset(items_in_region_list, cache=cache)
+        for items_in_region_list in order_list.get_all_order_groups())
+
+    return iter_encoded_message(header_dict, rowset_fragments)
 
-    return json.dumps(json_dict)
\ No newline at end of file
+def encode_to_json(order_list, cache=False):
+    """
+    Encodes this list of MarketOrder instances to a JSON string.
+
+    :param MarketOrderList order_list: The order list to serialize.
+    :keyword bool cache: If True, each rowset is cached on its region+item
+        list. See :py:func:`encode_rowset`.
+    :rtype: str
+    """
+    return ''.join(iter_encode(order_list, cache=cache))
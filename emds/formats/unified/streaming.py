@@ -0,0 +1,229 @@
+"""
+An incremental reader for Unified Uploader messages. Rather than decoding a
+whole message with one ``json.loads()`` call, the top-level object is
+scanned as data comes in, and each rowset is decoded on its own. Peak memory
+use is then bounded by the largest rowset, rather than the whole message.
+
+See :py:func:`emds.formats.unified.parse_from_stream` for the higher level
+interface that most people will want.
+"""
+import re
+import zlib
+# ujson lacks raw_decode(), which this module depends on, so go straight to
+# the standard library here.
+import json as stdlib_json
+from emds.formats.exceptions import ParseError
+
+# How many bytes to read from file-like objects at a time.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Pristine compressors, keyed by compression level. Setting one of these up
+# allocates and initializes zlib's state, which is more expensive than
+# copying an unused one.
+_COMPRESSOR_TEMPLATES = {}
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = stdlib_json.JSONDecoder()
+
+
+def _iter_chunks(source, chunk_size):
+    """
+    Normalizes a file-like object or an iterable of strings to a generator of
+    strings.
+    """
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+def iter_decompressed(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Incrementally decompresses zlib-compressed data. At most ``chunk_size``
+    bytes are decompressed at a time, so the whole decompressed document
+    never has to be held in memory.
+
+    .. note:: This is a generator!
+
+    :param source: A file-like object, or an iterable of strings.
+    :keyword int chunk_size: How much to read from file-like objects, and
+        to decompress, at a time.
+    :rtype: generator
+    :returns: Generates decompressed strings.
+    :raises: ParseError if the data isn't valid zlib data.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        for chunk in _iter_chunks(source, chunk_size):
+            while chunk:
+                data = decompressor.decompress(chunk, chunk_size)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        data = decompressor.flush()
+        if data:
+            yield data
+    except zlib.error as exc:
+        raise ParseError("Invalid compressed data: %s" % exc)
+
+def iter_compressed(fragments, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    zlib-compresses a series of strings, as they come in.
+
+    .. note:: This is a generator!
+
+    :param fragments: An iterable of strings.
+    :keyword int level: The zlib compression level.
+    :rtype: generator
+    :returns: Generates compressed strings, which add up to the same thing
+        ``zlib.compress()`` would return for the joined fragments.
+    """
+    template = _COMPRESSOR_TEMPLATES.get(level)
+    if template is None:
+        template = zlib.compressobj(level)
+        _COMPRESSOR_TEMPLATES[level] = template
+    # Never used directly, so copies of it start from a clean slate.
+    compressor = template.copy()
+
+    for fragment in fragments:
+        data = compressor.compress(fragment)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _StreamScanner(object):
+    """
+    Holds a buffer of not yet consumed data, and pulls more out of the
+    source as needed.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Reads another chunk into the buffer, throwing out the consumed data
+        in the process.
+
+        :rtype: bool
+        :returns: False if the source has been exhausted.
+        """
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace, and returns the next character without consuming
+        it.
+
+        :raises: ParseError if the source runs out.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ParseError("Unexpected end of message.")
+
+    def expect(self, chars):
+        """
+        Consumes the next non-whitespace character, which must be one of
+        ``chars``.
+
+        :rtype: str
+        :returns: The character that was consumed.
+        """
+        char = self.peek()
+        if char not in chars:
+            raise ParseError(
+                "Mal-formed JSON input: expected one of %r, got %r." % (
+                    chars, char))
+        self.pos += 1
+        return char
+
+    def decode_value(self):
+        """
+        Decodes the next complete JSON value, reading more data until there
+        is enough of it.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise ParseError("Mal-formed JSON input.")
+            else:
+                # A number that runs up against the end of the buffer may
+                # just be cut off, so that needs more data as well.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+
+            # Read until the pending data has at least doubled, so that big
+            # values aren't decoded over and over as each chunk comes in.
+            pending = len(self.buffer) - self.pos
+            while len(self.buffer) - self.pos < pending * 2:
+                if not self.fill():
+                    break
+
+
+def iter_message_parts(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Incrementally reads a Unified Uploader message, yielding its top-level
+    fields as they are found. ``rowsets`` is yielded once per rowset, instead
+    of once for the whole list.
+
+    .. note:: This is a generator!
+
+    :param source: A file-like object, or an iterable of strings (such as
+        chunks of a HTTP response).
+    :keyword int chunk_size: How much to read from file-like objects at a
+        time.
+    :rtype: generator
+    :returns: Generates ``(key, value)`` tuples. For ``rowsets``, the value
+        is a single rowset dict.
+    :raises: ParseError if the message is mal-formed.
+    """
+    scanner = _StreamScanner(_iter_chunks(source, chunk_size))
+    scanner.expect('{')
+    if scanner.peek() == '}':
+        return
+    while True:
+        key = scanner.decode_value()
+        if not isinstance(key, basestring):
+            raise ParseError("Mal-formed JSON input: expected a key.")
+        scanner.expect(':')
+
+        if key == 'rowsets':
+            scanner.expect('[')
+            if scanner.peek() == ']':
+                scanner.pos += 1
+            else:
+                while True:
+                    yield key, scanner.decode_value()
+                    if scanner.expect(',]') == ']':
+                        break
+        else:
+            yield key, scanner.decode_value()
+
+        if scanner.expect(',}') == '}':
+            return
@@ -1,8 +1,14 @@
 import datetime
+import pickle
+import zlib
 import pytz
+from StringIO import StringIO
 from emds.compat import json
-from emds.data_structures import MarketOrderList, MarketHistoryList
+from emds.columnar import ColumnarItemsInRegionList, \
+    ColumnarHistoryItemsInRegionList
+from emds.data_structures import MarketOrder, MarketOrderList, MarketHistoryList
 from emds.formats import unified
+from emds.formats.exceptions import ParseError
 from emds.common_utils import enlighten_dtime, UTC_TZINFO
 from emds.formats.tests import BaseSerializationCase
 from emds.formats.unified.unified_utils import gen_iso_datetime_str, parse_datetime
@@ -179,11 +185,15 @@ class UnifiedSerializationTests(BaseSerializationCase):
         self.assertEqual(len(decoded_list._orders.keys()), 2)
         # Now make sure there are three.
         self.assertEqual(len(decoded_list), 3)
-        # These are regionID_itemID. Make sure the keys are set correctly.
+        # These are (regionID, itemID). Make sure the keys are set correctly.
         self.assertItemsEqual(
-            ['10000065_11134', '10000066_11135'],
+            [(10000065, 11134), (10000066, 11135)],
             decoded_list._orders.keys()
         )
+        # Groups can be fetched directly, including the order-less one.
+        self.assertEqual(len(decoded_list.get_group(10000065, 11134)), 3)
+        self.assertEqual(len(decoded_list.get_group(10000066, 11135)), 0)
+        self.assertIsNone(decoded_list.get_group(10000066, 11134))
 
         # Re-encode for JSON and do some basic checks for sanity.
         re_encoded_list = unified.encode_to_json(decoded_list)
@@ -273,4 +283,451 @@ class UnifiedSerializationTests(BaseSerializationCase):
         self.assertListEqual(first_rowset['rows'], [])
         self.assertTrue(first_rowset.has_key('generatedAt'))
         self.assertTrue(first_rowset.has_key('regionID'))
-        self.assertTrue(first_rowset.has_key('typeID'))
\ No newline at end of file
+        self.assertTrue(first_rowset.has_key('typeID'))
+
+    def test_lazy_parsing(self):
+        """
+        Parses order and history lists lazily, and makes sure that they
+        end up matching the eagerly parsed versions once accessed.
+        """
+        encoded_orderlist = unified.encode_to_json(self.order_list)
+        lazy_list = unified.parse_from_json(encoded_orderlist, lazy=True)
+        self.assertIsInstance(lazy_list, MarketOrderList)
+        olist = lazy_list.get_group(
+            self.order1.region_id, self.order1.type_id)
+        # Nothing has been built yet, but counts and order IDs are known.
+        self.assertIsNotNone(olist._raw_rows)
+        self.assertEqual(len(lazy_list), 1)
+        self.assertTrue(self.order1.order_id in lazy_list)
+        self.assertIsNotNone(olist._raw_rows)
+        # Accessing the orders builds them.
+        order = list(olist)[0]
+        self.assertIsNone(olist._raw_rows)
+        self.assertEqual(order.order_id, self.order1.order_id)
+        self.assertEqual(order.price, self.order1.price)
+        self.assertEqual(
+            encoded_orderlist, unified.encode_to_json(lazy_list))
+
+        encoded_history = unified.encode_to_json(self.history)
+        lazy_history = unified.parse_from_json(encoded_history, lazy=True)
+        self.assertIsInstance(lazy_history, MarketHistoryList)
+        self.assertEqual(len(lazy_history), 1)
+        self.assertEqual(
+            encoded_history, unified.encode_to_json(lazy_history))
+        # Adding an entry to a lazy region+item list builds the rest first.
+        entry_list = lazy_history.get_group(
+            self.history1.region_id, self.history1.type_id)
+        entry_list.add_entry(self.history1)
+        self.assertEqual(len(entry_list), 2)
+
+    def test_lazy_bad_row(self):
+        """
+        A bad row raises ParseError every time the lazy region+item list is
+        touched, rather than leaving it half-built.
+        """
+        row = [8999, 1, 32767, 1, 1, 1, False, "2011-12-03T08:10:59+00:00",
+               90, 60008692, 30005038]
+        bad_row = list(row)
+        bad_row[0:4] = [8999, 1, 32767, 2]
+        bad_row[8] = 'abc'
+        last_row = list(row)
+        last_row[3] = 3
+        message = {
+            "resultType": "orders",
+            "version": "0.1alpha",
+            "uploadKeys": [],
+            "generator": {"name": "Yapeal", "version": "11.335.1737"},
+            "currentTime": "2011-10-22T15:46:00+00:00",
+            "columns": ["price", "volRemaining", "range", "orderID",
+                        "volEntered", "minVolume", "bid", "issueDate",
+                        "duration", "stationID", "solarSystemID"],
+            "rowsets": [
+                {
+                    "generatedAt": "2011-10-22T15:43:00+00:00",
+                    "regionID": 10000065,
+                    "typeID": 11134,
+                    "rows": [row, bad_row, last_row],
+                }
+            ]
+        }
+        order_list = unified.parse_from_json(json.dumps(message), lazy=True)
+        olist = order_list.get_group(10000065, 11134)
+        self.assertEqual(len(olist), 3)
+        for _ in range(2):
+            self.assertRaises(ParseError, lambda: olist.orders)
+            self.assertEqual(len(olist), 3)
+
+        # Order IDs are read as the groups are added to the order list, so
+        # short rows and bad order IDs turn up right away.
+        message['rowsets'][0]['rows'] = [row, [1.0, 1, 1]]
+        self.assertRaises(ParseError, unified.parse_from_json,
+                          json.dumps(message), lazy=True)
+        bad_row[8] = 90
+        bad_row[3] = 'abc'
+        message['rowsets'][0]['rows'] = [row, bad_row]
+        self.assertRaises(ParseError, unified.parse_from_json,
+                          json.dumps(message), lazy=True)
+
+    def test_column_errors(self):
+        """
+        Unknown or missing columns, and short rows, result in a ParseError.
+        """
+        message = {
+            "resultType" : "history",
+            "version" : "0.1alpha",
+            "uploadKeys" : [],
+            "generator" : { "name" : "Yapeal", "version" : "11.335.1737" },
+            "currentTime" : "2011-10-22T15:46:00+00:00",
+            "columns" : ["date","orders","quantity","low","high","average"],
+            "rowsets" : [
+                {
+                    "generatedAt" : "2011-10-22T15:42:00+00:00",
+                    "regionID" : 10000065,
+                    "typeID" : 11134,
+                    "rows" : [
+                        ["2011-12-03T00:00:00+00:00",40,40,1999,499999.99,35223.50]
+                    ]
+                }
+            ]
+        }
+        # The message is fine as-is.
+        self.assertEqual(len(unified.parse_from_json(json.dumps(message))), 1)
+
+        message['columns'] = ["date","orders","quantity","low","high","bogus"]
+        self.assertRaises(
+            ParseError, unified.parse_from_json, json.dumps(message))
+
+        message['columns'] = ["date","orders","quantity","low","high"]
+        self.assertRaises(
+            ParseError, unified.parse_from_json, json.dumps(message))
+
+        message['columns'] = ["date","orders","quantity","low","high","average"]
+        message['rowsets'][0]['rows'][0].pop()
+        self.assertRaises(
+            ParseError, unified.parse_from_json, json.dumps(message))
+
+    def test_column_order(self):
+        """
+        Columns may come in any order, and map to the same values.
+        """
+        row_values = {
+            "price": 8999, "volRemaining": 1, "range": 32767,
+            "orderID": 2363806077, "volEntered": 1, "minVolume": 1,
+            "bid": False, "issueDate": "2011-12-03T08:10:59+00:00",
+            "duration": 90, "stationID": 60008692, "solarSystemID": 30005038,
+        }
+        columns = sorted(row_values.keys())
+        message = {
+            "resultType" : "orders",
+            "version" : "0.1alpha",
+            "uploadKeys" : [],
+            "generator" : { "name" : "Yapeal", "version" : "11.335.1737" },
+            "currentTime" : "2011-10-22T15:46:00+00:00",
+            "columns" : columns,
+            "rowsets" : [
+                {
+                    "generatedAt" : "2011-10-22T15:42:00+00:00",
+                    "regionID" : 10000065,
+                    "typeID" : 11134,
+                    "rows" : [[row_values[column] for column in columns]]
+                }
+            ]
+        }
+        order = list(unified.parse_from_json(
+            json.dumps(message)).get_all_orders_ungrouped())[0]
+        self.assertEqual(order.order_id, 2363806077)
+        self.assertEqual(order.price, 8999)
+        self.assertEqual(order.station_id, 60008692)
+        self.assertEqual(order.solar_system_id, 30005038)
+        self.assertEqual(order.order_issue_date.hour, 8)
+
+    def test_stream_parsing(self):
+        """
+        Parses messages a few bytes at a time, and makes sure the results
+        match up with parse_from_json().
+        """
+        self.order_list.add_order(self.order2)
+        data = unified.encode_to_json(self.order_list)
+        expected = unified.parse_from_json(data)
+
+        for chunk_size in (1, 7, 4096):
+            chunks = [data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size)]
+            parsed = list(unified.parse_from_stream(chunks))
+            order_list = parsed[0]
+            self.assertIsInstance(order_list, MarketOrderList)
+            self.assertEqual(len(order_list), 0)
+            self.assertEqual(order_list.upload_keys, expected.upload_keys)
+            self.assertEqual(len(parsed), 3)
+            for olist in parsed[1:]:
+                order_list.add_group(olist)
+            self.assertEqual(len(order_list), 2)
+            self.assertEqual(
+                unified.encode_to_json(order_list),
+                unified.encode_to_json(expected))
+
+        # File-like objects work too.
+        parsed = list(unified.parse_from_stream(StringIO(data), chunk_size=5))
+        self.assertEqual(len(parsed), 3)
+
+    def test_stream_parsing_rowsets_first(self):
+        """
+        The rowsets may come before the rest of the header, in which case
+        they are held until the header is complete.
+        """
+        message = json.loads(unified.encode_to_json(self.history))
+        rowsets = message.pop('rowsets')
+        data = '{"rowsets": %s, %s' % (
+            json.dumps(rowsets), json.dumps(message)[1:])
+        parsed = list(unified.parse_from_stream([data]))
+        self.assertIsInstance(parsed[0], MarketHistoryList)
+        self.assertEqual(len(parsed), 2)
+        self.assertEqual(
+            parsed[1].entries[0].total_quantity,
+            self.history1.total_quantity)
+
+    def test_stream_parsing_errors(self):
+        """
+        Truncated and mal-formed messages result in a ParseError.
+        """
+        data = unified.encode_to_json(self.order_list)
+        self.assertRaises(
+            ParseError, list, unified.parse_from_stream([data[:-10]]))
+        self.assertRaises(
+            ParseError, list, unified.parse_from_stream(['[1, 2]']))
+        self.assertRaises(
+            ParseError, list,
+            unified.parse_from_stream(['{"rowsets": []}']))
+
+    def test_trusted_parsing(self):
+        """
+        Parsing with trusted=True skips validation, but should otherwise
+        produce the same data for messages that we encoded.
+        """
+        self.order_list.add_order(self.order2)
+        for market_list in (self.order_list, self.history):
+            encoded = unified.encode_to_json(market_list)
+            trusted_list = unified.parse_from_json(encoded, trusted=True)
+            self.assertEqual(
+                encoded, unified.encode_to_json(trusted_list))
+
+        trusted_list = unified.parse_from_json(
+            unified.encode_to_json(self.order_list), trusted=True)
+        order = trusted_list.get_order(self.order2.order_id)
+        self.assertIsInstance(order, MarketOrder)
+        self.assertEqual(order.volume_remaining, self.order2.volume_remaining)
+        self.assertEqual(
+            order.order_issue_date,
+            self.order2.order_issue_date.replace(microsecond=0))
+
+    def test_columnar_parsing(self):
+        """
+        Parsing with columnar=True should fill columnar region+item lists
+        straight from the rows, with the same values as the regular parser,
+        and the same validation.
+        """
+        self.order2.solar_system_id = None
+        self.order_list.add_order(self.order2)
+        for market_list in (self.order_list, self.history):
+            encoded = unified.encode_to_json(market_list)
+            for trusted in (False, True):
+                columnar_list = unified.parse_from_json(
+                    encoded, trusted=trusted, columnar=True)
+                self.assertEqual(
+                    encoded, unified.encode_to_json(columnar_list))
+
+        columnar_list = unified.parse_from_json(
+            unified.encode_to_json(self.order_list), columnar=True)
+        group = columnar_list.get_group(
+            self.order2.region_id, self.order2.type_id)
+        self.assertIsInstance(group, ColumnarItemsInRegionList)
+        order = group.get_order(self.order2.order_id)
+        self.assertEqual(order.solar_system_id, None)
+        self.assertEqual(order.price, self.order2.price)
+
+        encoded = json.loads(unified.encode_to_json(self.order_list))
+        encoded['rowsets'][0]['rows'][0][8] = 'abc'
+        self.assertRaises(
+            ParseError, unified.parse_from_json, json.dumps(encoded),
+            columnar=True)
+        encoded['rowsets'][0]['rows'][0] = [1]
+        self.assertRaises(
+            ParseError, unified.parse_from_json, json.dumps(encoded),
+            columnar=True)
+
+    def test_stream_encoding(self):
+        """
+        Encoding to a stream should produce a valid message, which round
+        trips to the same data as encode_to_json().
+        """
+        self.order_list.add_order(self.order2)
+        for market_list in (self.order_list, self.history, MarketOrderList()):
+            fobj = StringIO()
+            unified.encode_to_stream(market_list, fobj)
+            encoded = fobj.getvalue()
+            self.assertEqual(
+                json.loads(encoded)['rowsets'],
+                json.loads(unified.encode_to_json(market_list))['rowsets'])
+            self.assertEqual(
+                len(unified.parse_from_json(encoded)), len(market_list))
+
+        fragments = list(unified.iter_encode(self.order_list))
+        # Header, one fragment per rowset, then the closing brackets.
+        self.assertEqual(len(fragments), 4)
+
+    def test_encoded_cache(self):
+        """
+        Re-encoding an unchanged region+item list should re-use its cached
+        rowset, and adding to it should throw the cached copy out. Nothing
+        is cached unless asked for, and caches aren't pickled.
+        """
+        group = self.order_list.get_group(
+            self.order1.region_id, self.order1.type_id)
+        unified.encode_to_json(self.order_list)
+        list(unified.iter_encode(self.order_list))
+        unified.encode_to_stream(self.order_list, StringIO())
+        self.assertEqual(group._encoded_cache, {})
+
+        first = unified.encode_to_json(self.order_list, cache=True)
+        cached = group._encoded_cache['unified']
+        self.assertTrue(cached in first)
+        unified.encode_to_json(self.order_list, cache=True)
+        self.assertTrue(group._encoded_cache['unified'] is cached)
+        unpickled = pickle.loads(pickle.dumps(self.order_list))
+        self.assertEqual(
+            unpickled.get_group(
+                self.order1.region_id, self.order1.type_id)._encoded_cache,
+            {})
+        self.assertEqual(unified.encode_to_json(unpickled), first)
+
+        self.order2.region_id = self.order1.region_id
+        self.order2.type_id = self.order1.type_id
+        self.order_list.add_order(self.order2)
+        self.assertFalse('unified' in group._encoded_cache)
+        rows = json.loads(
+            unified.encode_to_json(self.order_list, cache=True))['rowsets']
+        self.assertEqual(len(rows[0]['rows']), 2)
+
+        # In-place edits have to be announced by hand.
+        self.order1.price = 1.5
+        group.clear_encoded_cache()
+        rows = json.loads(unified.encode_to_json(self.order_list))['rowsets']
+        self.assertEqual(rows[0]['rows'][0][0], 1.5)
+
+    def test_compressed(self):
+        """
+        Compressed messages should round trip, both whole and streamed, and
+        match what zlib makes of the uncompressed message.
+        """
+        self.order_list.add_order(self.order2)
+        compressed = unified.encode_to_compressed(self.order_list)
+        self.assertEqual(
+            json.loads(zlib.decompress(compressed))['rowsets'],
+            json.loads(unified.encode_to_json(self.order_list))['rowsets'])
+
+        decoded = unified.parse_from_compressed(compressed)
+        self.assertEqual(len(decoded), 2)
+        self.assertTrue(self.order2.order_id in decoded)
+
+        # Tiny chunks exercise the partial decompression handling.
+        parts = unified.parse_from_compressed_stream(
+            StringIO(unified.encode_to_compressed(self.history)),
+            chunk_size=7)
+        history = next(parts)
+        self.assertEqual(len(history), 0)
+        self.assertEqual(sum([len(group) for group in parts]), 1)
+
+        self.assertRaises(
+            ParseError, unified.parse_from_compressed, 'not compressed')
+        self.assertRaises(
+            ParseError, unified.parse_from_compressed, compressed[:-10])
+
+    def test_parse_many(self):
+        """
+        Parse a batch of messages in worker processes.
+        """
+        self.order_list.add_order(self.order2)
+        messages = [
+            unified.encode_to_json(self.order_list),
+            unified.encode_to_json(self.history),
+        ]
+        results = list(unified.parse_many(messages, workers=2))
+        self.assertEqual(len(results[0]), 2)
+        self.assertTrue(self.order2.order_id in results[0])
+        group = results[1].get_group(
+            self.history1.region_id, self.history1.type_id)
+        self.assertTrue(isinstance(group, ColumnarHistoryItemsInRegionList))
+
+        compressed = [unified.encode_to_compressed(self.order_list)] * 3
+        results = list(unified.parse_many(
+            compressed, workers=2, ordered=False, compressed=True))
+        self.assertEqual([len(result) for result in results], [2, 2, 2])
+
+        messages.append('garbage')
+        self.assertRaises(
+            ParseError, list, unified.parse_many(messages, workers=2))
+        results = list(unified.parse_many(
+            messages, workers=2, skip_invalid=True))
+        self.assertEqual(len(results), 2)
+
+        # Valid JSON, but with a repeated region+type rowset, and a rowset
+        # with no generatedAt.
+        duplicated = json.loads(messages[0])
+        duplicated['rowsets'].append(duplicated['rowsets'][0])
+        undated = json.loads(messages[0])
+        del undated['rowsets'][0]['generatedAt']
+        messages = [json.dumps(duplicated), messages[0], json.dumps(undated)]
+        self.assertRaises(
+            ParseError, list, unified.parse_many(messages, workers=2))
+        results = list(unified.parse_many(
+            messages, workers=2, skip_invalid=True))
+        self.assertEqual([len(result) for result in results], [2])
+
+    def test_deduplication(self):
+        """
+        Rowsets that have already been seen should be skipped, both when
+        parsing whole messages and streams.
+        """
+        self.order_list.add_order(self.order2)
+        encoded = unified.encode_to_json(self.order_list)
+        deduplicator = unified.RowsetDeduplicator()
+
+        self.assertEqual(
+            len(unified.parse_from_json(encoded, deduplicator=deduplicator)),
+            2)
+        self.assertEqual(
+            len(unified.parse_from_json(encoded, deduplicator=deduplicator)),
+            0)
+        parts = list(unified.parse_from_stream(
+            StringIO(encoded), deduplicator=deduplicator))
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(deduplicator.rowset_count, 6)
+        self.assertEqual(deduplicator.duplicate_count, 4)
+        self.assertEqual(deduplicator.duplicate_ratio, 4 / 6.0)
+
+        # A changed rowset isn't a duplicate.
+        self.order1.price = 1.5
+        self.order_list.get_group(
+            self.order1.region_id, self.order1.type_id).clear_encoded_cache()
+        order_list = unified.parse_from_compressed(
+            unified.encode_to_compressed(self.order_list),
+            deduplicator=deduplicator)
+        self.assertEqual(len(order_list), 1)
+        self.assertTrue(self.order1.order_id in order_list)
+
+    def test_deduplicator_size(self):
+        """
+        The least recently seen fingerprints should be forgotten first.
+        """
+        deduplicator = unified.RowsetDeduplicator(max_size=2)
+        rowsets = [{'typeID': type_id, 'rows': []} for type_id in range(3)]
+        self.assertEqual(deduplicator.filter_rowsets(rowsets[:2]), rowsets[:2])
+        # Refresh the first, so the second is the oldest.
+        self.assertTrue(deduplicator.is_duplicate(rowsets[0]))
+        self.assertFalse(deduplicator.is_duplicate(rowsets[2]))
+        self.assertEqual(len(deduplicator), 2)
+        self.assertTrue(deduplicator.is_duplicate(rowsets[0]))
+        self.assertFalse(deduplicator.is_duplicate(rowsets[1]))
+
+        deduplicator.reset_stats()
+        self.assertEqual(deduplicator.duplicate_ratio, 0.0)
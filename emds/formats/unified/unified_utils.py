@@ -2,33 +2,174 @@
 Assorted utility functions for order and history serializing and
 de-serializing.
 """
-from exceptions import ValueError
+import datetime
+from operator import itemgetter
 import dateutil.parser
-from emds.common_utils import UTC_TZINFO
+from emds.compat import json
+from emds.common_utils import UTC_TZINFO, dtime_to_timestamp
 from emds.formats.exceptions import ParseError
 
-def _columns_to_kwargs(conversion_table, columns, row):
+# Memoizes parse_datetime(). History dates and generatedAt values repeat a
+# lot within (and across) messages.
+_DATETIME_CACHE = {}
+# Once the cache holds this many datetimes, it is cleared out.
+DATETIME_CACHE_MAX_SIZE = 10000
+
+# The key that encoded rowsets are cached under on region+item lists.
+ENCODED_CACHE_KEY = 'unified'
+
+# Compiled row decoders, keyed by record factory and column list.
+_ROW_DECODER_CACHE = {}
+# Uploaders may send columns in any order, so cap the number of decoders.
+ROW_DECODER_CACHE_MAX_SIZE = 100
+
+def compile_row_decoder(record_factory, conversion_table, columns,
+                        datetime_kwargs=()):
     """
-    Given a list of column names, and a list of values (a row), return a dict
-    of kwargs that may be used to instantiate a MarketHistoryEntry
-    or MarketOrder object.
+    Compiles a message's column list into a function that turns a row (a
+    list of values) straight into a MarketOrder or MarketHistoryEntry. The
+    columns are only looked up once per message, instead of once per row,
+    and decoders are cached by column list, since nearly every message
+    uses the same one.
 
+    The returned function has the signature
+    ``decode_row(row, region_id, type_id, generated_at)``.
+
+    :param callable record_factory: Called with keyword arguments to build
+        each record, typically MarketOrder or MarketHistoryEntry.
     :param dict conversion_table: The conversion table to use for mapping
-        spec names to kwargs.
-    :param list columns: A list of column names.
-    :param list row: A list of values.
+        spec names to kwargs. Every kwarg in it is required.
+    :param list columns: The message's list of column names.
+    :param tuple datetime_kwargs: kwargs whose values need to be ran
+        through :py:func:`parse_datetime`.
+    :rtype: callable
+    :raises: :py:exc:`emds.formats.exceptions.ParseError` if there are
+        unknown or missing columns.
     """
-    kwdict = {}
+    try:
+        cache_key = (record_factory, tuple(columns), tuple(datetime_kwargs))
+        return _ROW_DECODER_CACHE[cache_key]
+    except TypeError:
+        raise ParseError("columns must be an array of column names.")
+    except KeyError:
+        pass
+
+    arg_exprs = []
+    for kwarg_name, counter in _get_column_positions(
+            conversion_table, columns).iteritems():
+        if kwarg_name in datetime_kwargs:
+            value_expr = 'parse_datetime(row[%d])' % counter
+        else:
+            value_expr = 'row[%d]' % counter
+        arg_exprs.append('%s=%s' % (kwarg_name, value_expr))
 
-    counter = 0
-    for column in columns:
-        # Map the column name to the correct MarketHistoryEntry kwarg.
-        kwarg_name = conversion_table[column]
-        # Set the kwarg to the correct value from the row.
-        kwdict[kwarg_name] = row[counter]
-        counter += 1
+    # Generating the source for the decoder lets Python do the column
+    # shuffling, with no per-row dict building or table lookups.
+    source = (
+        'def decode_row(row, region_id, type_id, generated_at):\n'
+        '    return record_factory(%s, region_id=region_id, '
+        'type_id=type_id, generated_at=generated_at)\n' % ', '.join(arg_exprs)
+    )
+    namespace = {
+        'record_factory': record_factory,
+        'parse_datetime': parse_datetime,
+    }
+    exec(compile(source, '<row decoder>', 'exec'), namespace)
+    decode_row = namespace['decode_row']
 
-    return kwdict
+    if len(_ROW_DECODER_CACHE) >= ROW_DECODER_CACHE_MAX_SIZE:
+        _ROW_DECODER_CACHE.clear()
+    _ROW_DECODER_CACHE[cache_key] = decode_row
+    return decode_row
+
+def _get_column_positions(conversion_table, columns):
+    """
+    Works out where each kwarg's value sits within a message's rows.
+
+    :param dict conversion_table: The conversion table to use for mapping
+        spec names to kwargs. Every kwarg in it is required.
+    :param list columns: The message's list of column names.
+    :rtype: dict
+    :returns: A dict of kwarg names to column positions.
+    :raises: :py:exc:`emds.formats.exceptions.ParseError` if there are
+        unknown or missing columns.
+    """
+    positions = {}
+    try:
+        for counter, column in enumerate(columns):
+            try:
+                positions[conversion_table[column]] = counter
+            except (KeyError, TypeError):
+                raise ParseError("Unknown column: %s" % (column,))
+    except TypeError:
+        raise ParseError("columns must be an array of column names.")
+
+    missing = set(conversion_table.keys()) - set(columns)
+    if missing:
+        raise ParseError(
+            "Missing columns: %s" % ', '.join(sorted(missing)))
+    return positions
+
+def compile_column_decoder(conversion_table, columns, converters):
+    """
+    The columnar counterpart to :py:func:`compile_row_decoder`. Compiles a
+    message's column list into a function that splits a rowset's rows up
+    into one list of values per field, ready to be handed to
+    :py:meth:`extend_columns()
+    <emds.columnar._ColumnarItemsInRegionList.extend_columns>`. No
+    MarketOrder or MarketHistoryEntry instances are built along the way.
+
+    The returned function has the signature ``decode_rows(rows)``, and
+    returns a list of value lists, in the same order as ``converters``.
+    It raises IndexError for short rows, and TypeError or ValueError for
+    values that don't convert.
+
+    :param dict conversion_table: The conversion table to use for mapping
+        spec names to kwargs. Every kwarg in it is required.
+    :param list columns: The message's list of column names.
+    :param tuple converters: A tuple of ``(kwarg name, converter)`` tuples.
+        Each converter is called on every one of the kwarg's values, unless
+        it is None, in which case the values are used as-is.
+    :rtype: callable
+    :raises: :py:exc:`emds.formats.exceptions.ParseError` if there are
+        unknown or missing columns.
+    """
+    positions = _get_column_positions(conversion_table, columns)
+    getters = [
+        (itemgetter(positions[kwarg_name]), converter)
+        for kwarg_name, converter in converters]
+
+    def decode_rows(rows):
+        decoded = []
+        for getter, converter in getters:
+            values = map(getter, rows)
+            if converter is not None:
+                values = map(converter, values)
+            decoded.append(values)
+        return decoded
+
+    return decode_rows
+
+def iter_encoded_message(header_dict, rowset_fragments):
+    """
+    Assembles a Unified Uploader message out of its header and already
+    encoded rowsets, generating it one piece at a time.
+
+    .. note:: This is a generator!
+
+    :param dict header_dict: All of the message's top-level fields, minus
+        ``rowsets``.
+    :param rowset_fragments: An iterable of JSON-encoded rowset objects.
+    :rtype: generator
+    :returns: Generates JSON fragments, which add up to the whole message.
+    """
+    # Chop the closing brace off, so the rowsets can go in.
+    yield json.dumps(header_dict)[:-1] + ',"rowsets":['
+    separator = ''
+    for fragment in rowset_fragments:
+        yield separator + fragment
+        separator = ','
+    yield ']}'
 
 def gen_iso_datetime_str(dtime):
     """
@@ -43,20 +184,83 @@ def gen_iso_datetime_str(dtime):
     """
     return dtime.replace(microsecond=0).astimezone(UTC_TZINFO).isoformat()
 
+def _parse_fixed_format_datetime(time_str):
+    """
+    Parses the ``YYYY-MM-DDTHH:MM:SS+HH:MM`` shape that Unified Uploader
+    messages use, without going through dateutil.
+
+    :param str time_str: The date/time str to parse.
+    :rtype: datetime.datetime or None
+    :returns: A parsed, UTC datetime, or ``None`` if the string isn't in
+        the expected shape.
+    """
+    if len(time_str) != 25 or time_str[10] != 'T' or \
+       time_str[4] != '-' or time_str[7] != '-' or \
+       time_str[13] != ':' or time_str[16] != ':' or \
+       time_str[22] != ':' or time_str[19] not in '+-':
+        return None
+
+    try:
+        dtime = datetime.datetime(
+            int(time_str[0:4]), int(time_str[5:7]), int(time_str[8:10]),
+            int(time_str[11:13]), int(time_str[14:16]), int(time_str[17:19]),
+            tzinfo=UTC_TZINFO)
+        offset = int(time_str[20:22]) * 60 + int(time_str[23:25])
+    except ValueError:
+        # Let dateutil have a go at it, and raise the error if need be.
+        return None
+
+    if offset:
+        # Local time minus the offset gets us to UTC.
+        if time_str[19] == '-':
+            offset = -offset
+        dtime -= datetime.timedelta(minutes=offset)
+    return dtime
+
 def parse_datetime(time_str):
     """
-    Wraps dateutil's parser function to set an explicit UTC timezone, and
-    to make sure microseconds are 0. Unified Uploader format and EMK format
+    Parses a date/time string to a UTC datetime, making sure that
+    microseconds are 0. Unified Uploader format and EMK format
     bother don't use microseconds at all.
 
+    The strict ``YYYY-MM-DDTHH:MM:SS+HH:MM`` shape that Unified uses is
+    handled directly. Anything else is handed to dateutil's parser. Results
+    are memoized, since the same strings tend to come up over and over.
+
     :param str time_str: The date/time str to parse.
     :rtype: datetime.datetime
     :returns: A parsed, UTC datetime.
     """
     try:
-        return dateutil.parser.parse(
-            time_str
-        ).replace(microsecond=0).astimezone(UTC_TZINFO)
-    except ValueError:
-        # This was some kind of unrecognizable time string.
-        raise ParseError("Invalid time string: %s" % time_str)
\ No newline at end of file
+        return _DATETIME_CACHE[time_str]
+    except (KeyError, TypeError):
+        # Not parsed yet, or unhashable (and therefore invalid).
+        pass
+
+    if not isinstance(time_str, basestring):
+        raise ParseError("Invalid time string: %s" % (time_str,))
+
+    dtime = _parse_fixed_format_datetime(time_str)
+    if dtime is None:
+        try:
+            dtime = dateutil.parser.parse(
+                time_str
+            ).replace(microsecond=0).astimezone(UTC_TZINFO)
+        except ValueError:
+            # This was some kind of unrecognizable time string.
+            raise ParseError("Invalid time string: %s" % time_str)
+
+    if len(_DATETIME_CACHE) >= DATETIME_CACHE_MAX_SIZE:
+        _DATETIME_CACHE.clear()
+    _DATETIME_CACHE[time_str] = dtime
+    return dtime
+
+def parse_timestamp(time_str):
+    """
+    Like :py:func:`parse_datetime`, but returns a UNIX timestamp, which is
+    how :py:mod:`columnar <emds.columnar>` containers store datetimes.
+
+    :param str time_str: The date/time str to parse.
+    :rtype: int
+    """
+    return dtime_to_timestamp(parse_datetime(time_str))
\ No newline at end of file
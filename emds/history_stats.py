@@ -0,0 +1,284 @@
+"""
+Rolling statistics over daily market history, computed in bulk.
+
+:py:func:`compute_rolling_stats` takes the :py:class:`HistorySeries
+<emds.history_store.HistorySeries>` of a :py:class:`HistoryStore
+<emds.history_store.HistoryStore>` (or any other iterable of them), and
+works out, for every day of every series:
+
+* The moving average of the daily average price.
+* The volume-weighted average price (VWAP) over the window.
+* Volatility: the standard deviation of day-over-day average price changes
+  over the window.
+* The N-day low and high.
+
+If NumPy is installed, every series is concatenated and handled in a single
+vectorized pass. Otherwise, each series is handled with running sums in
+plain Python, which is much slower but gives the same results.
+
+Days that don't have a full window of history behind them get ``nan``.
+"""
+import array
+import math
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional. Without it, the pure Python version is used.
+    numpy = None
+
+# The default window size, in days.
+DEFAULT_WINDOW = 7
+
+NAN = float('nan')
+
+
+class SeriesStats(object):
+    """
+    The rolling statistics for a single region+item series. Each statistic
+    is an ``array.array('d')``, lined up with :py:attr:`dates`.
+    """
+
+    #: The statistics computed for each day.
+    STATS = (
+        'moving_average', 'vwap', 'volatility', 'range_low', 'range_high',
+    )
+
+    def __init__(self, region_id, type_id, window, dates, **stats):
+        """
+        :param int region_id: The region ID that the stats pertain to.
+        :param int type_id: The type ID that the stats pertain to.
+        :param int window: The window size, in days.
+        :param array.array dates: The days, as UNIX timestamps.
+        :param stats: An ``array.array('d')`` for each of :py:attr:`STATS`.
+        """
+        self.region_id = region_id
+        self.type_id = type_id
+        self.window = window
+        self.dates = dates
+        for name in self.STATS:
+            setattr(self, name, stats[name])
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of days covered.
+        """
+        return len(self.dates)
+
+    def __repr__(self):
+        return "<SeriesStats: %s/%s %d days>" % (
+            self.region_id, self.type_id, len(self))
+
+
+def _rolling_python(series, window):
+    """
+    Computes the stats for a single series, with running sums.
+
+    :rtype: dict
+    """
+    prices = series.get_column('average_price')
+    quantities = series.get_column('total_quantity')
+    lows = series.get_column('low_price')
+    highs = series.get_column('high_price')
+    stats = dict([(name, array.array('d')) for name in SeriesStats.STATS])
+
+    price_sum = value_sum = quantity_sum = 0.0
+    return_sum = return_square_sum = 0.0
+    # Day-over-day changes within the window. Changes from a zero price are
+    # undefined, and stored as None.
+    returns = deque()
+    undefined_returns = 0
+    # Indices of candidate lows and highs, for O(1) window minimums and
+    # maximums.
+    low_indices = deque()
+    high_indices = deque()
+
+    for i in xrange(len(prices)):
+        price = prices[i]
+        price_sum += price
+        value_sum += price * quantities[i]
+        quantity_sum += quantities[i]
+        if i >= window:
+            old = i - window
+            price_sum -= prices[old]
+            value_sum -= prices[old] * quantities[old]
+            quantity_sum -= quantities[old]
+
+        if i:
+            previous = prices[i - 1]
+            if previous:
+                change = price / previous - 1
+                return_sum += change
+                return_square_sum += change * change
+            else:
+                change = None
+                undefined_returns += 1
+            returns.append(change)
+            if len(returns) > window:
+                change = returns.popleft()
+                if change is None:
+                    undefined_returns -= 1
+                else:
+                    return_sum -= change
+                    return_square_sum -= change * change
+
+        while low_indices and lows[low_indices[-1]] >= lows[i]:
+            low_indices.pop()
+        low_indices.append(i)
+        while high_indices and highs[high_indices[-1]] <= highs[i]:
+            high_indices.pop()
+        high_indices.append(i)
+        if low_indices[0] <= i - window:
+            low_indices.popleft()
+        if high_indices[0] <= i - window:
+            high_indices.popleft()
+
+        if i < window - 1:
+            for name in SeriesStats.STATS:
+                stats[name].append(NAN)
+            continue
+
+        stats['moving_average'].append(price_sum / window)
+        stats['vwap'].append(
+            value_sum / quantity_sum if quantity_sum else NAN)
+        if i >= window and not undefined_returns:
+            mean = return_sum / window
+            variance = max(return_square_sum / window - mean * mean, 0.0)
+            stats['volatility'].append(math.sqrt(variance))
+        else:
+            stats['volatility'].append(NAN)
+        stats['range_low'].append(lows[low_indices[0]])
+        stats['range_high'].append(highs[high_indices[0]])
+
+    return stats
+
+def _rolling_numpy(series_list, window):
+    """
+    Computes the stats for every series at once, by concatenating them and
+    masking out windows that straddle two series. Sums are still taken per
+    series, so that one series' magnitude can't swamp another's.
+
+    :rtype: list
+    :returns: A dict of stats for each series.
+    """
+    lengths = numpy.array([len(series) for series in series_list])
+    total = int(lengths.sum())
+    if not total:
+        return [
+            dict([(name, array.array('d')) for name in SeriesStats.STATS])
+            for _ in series_list]
+
+    def column(name):
+        return numpy.concatenate([
+            numpy.asarray(series.get_column(name), dtype=numpy.float64)
+            for series in series_list])
+
+    prices = column('average_price')
+    quantities = column('total_quantity')
+    lows = column('low_price')
+    highs = column('high_price')
+
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    # Each day's position within its own series.
+    positions = numpy.arange(total) - numpy.repeat(starts, lengths)
+
+    # Days whose window starts after the first day of their series. Their
+    # window sums have the prefix sum from before the window taken off.
+    shifted = numpy.nonzero(positions >= window)[0]
+
+    def rolling(values, reduce_func=None):
+        # Result i covers values[i - window + 1:i + 1].
+        out = numpy.empty(total)
+        out.fill(numpy.nan)
+        if reduce_func is None:
+            # The prefix sums start over with each series. Running them
+            # across the whole concatenation would leave cheap items that
+            # follow expensive ones with the difference of two huge sums.
+            sums = numpy.empty(total)
+            for start, length in zip(starts, lengths):
+                numpy.cumsum(values[start:start + length],
+                             out=sums[start:start + length])
+            out[:] = sums
+            out[shifted] -= sums[shifted - window]
+        elif total >= window:
+            windows = numpy.lib.stride_tricks.as_strided(
+                values, shape=(total - window + 1, window),
+                strides=(values.strides[0], values.strides[0]))
+            out[window - 1:] = reduce_func(windows, axis=1)
+        return out
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        returns = numpy.zeros(total)
+        returns[1:] = prices[1:] / prices[:-1] - 1
+        # Flags changes from a zero price, which are undefined.
+        undefined = numpy.zeros(total)
+        undefined[1:] = prices[:-1] == 0
+        # The first day of a series has nothing to compare to.
+        undefined[positions == 0] = 0.0
+        returns[positions == 0] = 0.0
+        returns[undefined > 0] = 0.0
+
+        results = {
+            'moving_average': rolling(prices) / window,
+            'vwap': rolling(prices * quantities) / rolling(quantities),
+            'range_low': rolling(lows, numpy.min),
+            'range_high': rolling(highs, numpy.max),
+        }
+        mean = rolling(returns) / window
+        variance = numpy.maximum(
+            rolling(returns * returns) / window - mean * mean, 0.0)
+        volatility = numpy.sqrt(variance)
+        volatility[rolling(undefined) > 0] = numpy.nan
+        volatility[positions < window] = numpy.nan
+        results['volatility'] = volatility
+
+    incomplete = positions < window - 1
+    for values in results.itervalues():
+        values[incomplete] = numpy.nan
+
+    stats_list = []
+    for start, length in zip(starts, lengths):
+        stats = {}
+        for name, values in results.iteritems():
+            stats[name] = array.array('d')
+            stats[name].fromstring(values[start:start + length].tostring())
+        stats_list.append(stats)
+    return stats_list
+
+def compute_rolling_stats(series_list, window=DEFAULT_WINDOW,
+                          use_numpy=None):
+    """
+    Computes rolling statistics for a number of history series.
+
+    :param series_list: An iterable of :py:class:`HistorySeries
+        <emds.history_store.HistorySeries>`, such as a :py:class:`HistoryStore
+        <emds.history_store.HistoryStore>`.
+    :keyword int window: The window size, in days.
+    :keyword bool use_numpy: Whether to use NumPy. Defaults to using it if
+        it is installed.
+    :rtype: dict
+    :returns: A dict of ``(region_id, type_id)`` tuples to
+        :py:class:`SeriesStats` instances.
+    """
+    if window < 1:
+        raise ValueError('window must be at least 1.')
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ImportError('NumPy is not installed.')
+
+    series_list = list(series_list)
+    if use_numpy:
+        stats_list = _rolling_numpy(series_list, window)
+    else:
+        stats_list = [
+            _rolling_python(series, window) for series in series_list]
+
+    results = {}
+    for series, stats in zip(series_list, stats_list):
+        results[(series.region_id, series.type_id)] = SeriesStats(
+            series.region_id, series.type_id, window,
+            series.get_column('historical_date'), **stats)
+    return results
@@ -0,0 +1,366 @@
+"""
+A long-lived store of daily market history, with one date-sorted,
+array-backed series per region+item combo.
+
+History uploads overlap a great deal (each one carries the last year or so
+of days), so rather than piling up :py:class:`MarketHistoryEntry
+<emds.data_structures.MarketHistoryEntry>` instances,
+:py:meth:`HistoryStore.upsert` merges each upload into its series. Where an
+upload and the series both have a given day, whichever was generated more
+recently wins.
+
+Stores can be written to and read back from a compact binary file with
+:py:meth:`HistoryStore.save` and :py:meth:`HistoryStore.load`.
+"""
+import array
+import struct
+import sys
+from bisect import bisect_left, bisect_right
+from itertools import izip
+from emds.columnar import ColumnarHistoryItemsInRegionList, INT64_TYPECODE
+from emds.common_utils import dtime_to_timestamp, timestamp_to_dtime
+from emds.data_structures import MarketHistoryEntry, _group_key
+from emds.formats.exceptions import ParseError
+
+MAGIC = 'EMDH'
+FORMAT_VERSION = 2
+
+# Magic, format version, series count, column count.
+_FILE_HEADER = struct.Struct('<4sBQB')
+# Name length, typecode, item size. Followed by the name itself.
+_COLUMN_HEADER = struct.Struct('<BcB')
+# regionID, typeID, row count.
+_SERIES_HEADER = struct.Struct('<qqQ')
+
+
+def _get_column_layout():
+    """
+    :rtype: list
+    :returns: A ``(name, typecode, item size)`` tuple for each of
+        :py:attr:`HistorySeries.COLUMNS`, as they're laid out on disk.
+    """
+    return [
+        (name, typecode, array.array(typecode).itemsize)
+        for name, typecode in HistorySeries.COLUMNS]
+
+
+class HistorySeries(object):
+    """
+    The daily history of a single region+item combo, sorted by date. Each
+    field is held in its own :py:mod:`array`, with datetimes as UNIX
+    timestamps.
+    """
+
+    #: The history columns, plus when each day's data was generated.
+    COLUMNS = ColumnarHistoryItemsInRegionList.COLUMNS + (
+        ('generated_at', INT64_TYPECODE),
+    )
+
+    def __init__(self, region_id, type_id):
+        """
+        :param int region_id: The region ID that the series pertains to.
+        :param int type_id: The type ID that the series pertains to.
+        """
+        self.region_id = region_id
+        self.type_id = type_id
+        self._set_columns(
+            [array.array(typecode) for _, typecode in self.COLUMNS])
+
+    def _set_columns(self, column_arrays):
+        """
+        Replaces all of the column arrays at once.
+        """
+        self._column_arrays = column_arrays
+        self._columns = dict(izip(
+            [name for name, _ in self.COLUMNS], column_arrays))
+        self._dates = self._columns['historical_date']
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of days in the series.
+        """
+        return len(self._dates)
+
+    def __iter__(self):
+        """
+        Builds a MarketHistoryEntry for each day, oldest first.
+
+        .. note:: This is a generator!
+
+        :rtype: generator
+        """
+        for row in izip(*self._column_arrays):
+            yield self._row_to_entry(row)
+
+    def _row_to_entry(self, row):
+        (historical_date, num_orders, low_price, high_price, average_price,
+         total_quantity, generated_at) = row
+        return MarketHistoryEntry(
+            type_id=self.type_id,
+            region_id=self.region_id,
+            historical_date=timestamp_to_dtime(historical_date),
+            num_orders=num_orders,
+            low_price=low_price,
+            high_price=high_price,
+            average_price=average_price,
+            total_quantity=total_quantity,
+            generated_at=timestamp_to_dtime(generated_at),
+        )
+
+    def get_column(self, name):
+        """
+        Returns the array backing a column. This is not a copy, so don't
+        modify it.
+
+        :param str name: The column name. See :py:attr:`COLUMNS`.
+        :rtype: array.array
+        :raises: KeyError if there is no such column.
+        """
+        return self._columns[name]
+
+    def get_entry(self, historical_date):
+        """
+        :param datetime.datetime historical_date: The day to look for.
+        :rtype: MarketHistoryEntry or None
+        """
+        timestamp = dtime_to_timestamp(historical_date)
+        index = bisect_left(self._dates, timestamp)
+        if index == len(self._dates) or self._dates[index] != timestamp:
+            return None
+        return self._row_to_entry(
+            tuple([column[index] for column in self._column_arrays]))
+
+    def get_range(self, start=None, end=None):
+        """
+        Slices out the days within a date range.
+
+        :keyword datetime.datetime start: The first day to include. Defaults
+            to the start of the series.
+        :keyword datetime.datetime end: The last day to include. Defaults to
+            the end of the series.
+        :rtype: HistorySeries
+        :returns: A new series, holding copies of the matching days.
+        """
+        low = 0
+        high = len(self._dates)
+        if start is not None:
+            low = bisect_left(self._dates, dtime_to_timestamp(start))
+        if end is not None:
+            high = bisect_right(self._dates, dtime_to_timestamp(end))
+
+        series = HistorySeries(self.region_id, self.type_id)
+        series._set_columns(
+            [column[low:high] for column in self._column_arrays])
+        return series
+
+    def upsert(self, entries, generated_at):
+        """
+        Merges history entries into the series. Days that the series
+        doesn't have are added. Days that it has are replaced, unless the
+        stored day was generated more recently than ``generated_at``.
+
+        :param entries: An iterable of MarketHistoryEntry instances, such as
+            a HistoryItemsInRegionList.
+        :param datetime.datetime generated_at: When the entries were
+            generated.
+        :rtype: int
+        :returns: The number of days that were added or replaced.
+        """
+        generated_at = dtime_to_timestamp(generated_at)
+        incoming = {}
+        for entry in entries:
+            row = (
+                dtime_to_timestamp(entry.historical_date),
+                entry.num_orders,
+                entry.low_price,
+                entry.high_price,
+                entry.average_price,
+                entry.total_quantity,
+                generated_at,
+            )
+            incoming[row[0]] = row
+        if not incoming:
+            return 0
+
+        # Merge the two sorted runs into new arrays, which is linear rather
+        # than an O(n) array.insert() per new day.
+        new_rows = [incoming[date] for date in sorted(incoming)]
+        old_columns = self._column_arrays
+        merged = [array.array(typecode) for _, typecode in self.COLUMNS]
+        appends = [column.append for column in merged]
+        generated_at_index = len(self.COLUMNS) - 1
+        old_dates = self._dates
+        old_count = len(old_dates)
+        old_index = 0
+        changed = 0
+
+        def copy_old(stop):
+            # Bulk-copies the stored days from old_index up to stop.
+            for column, old_column in izip(merged, old_columns):
+                column.extend(old_column[old_index:stop])
+
+        for row in new_rows:
+            date = row[0]
+            position = bisect_left(old_dates, date, old_index)
+            if position > old_index:
+                copy_old(position)
+                old_index = position
+            if old_index < old_count and old_dates[old_index] == date:
+                if old_columns[generated_at_index][old_index] > generated_at:
+                    # What's stored is newer.
+                    copy_old(old_index + 1)
+                    old_index += 1
+                    continue
+                old_index += 1
+            for append, value in izip(appends, row):
+                append(value)
+            changed += 1
+
+        copy_old(old_count)
+        self._set_columns(merged)
+        return changed
+
+
+class HistoryStore(object):
+    """
+    Holds a :py:class:`HistorySeries` for each region+item combo.
+    """
+
+    def __init__(self):
+        # Maps (region_id, type_id) tuples to HistorySeries instances.
+        self._series = {}
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of series in the store.
+        """
+        return len(self._series)
+
+    def __iter__(self):
+        """
+        .. note:: This is a generator!
+
+        :rtype: generator
+        :returns: Generates the HistorySeries instances.
+        """
+        return self._series.itervalues()
+
+    def get_series(self, region_id, type_id):
+        """
+        :param int region_id: The region ID to look for. May be None.
+        :param int type_id: The type ID to look for.
+        :rtype: HistorySeries or None
+        """
+        return self._series.get(_group_key(region_id, type_id))
+
+    def _get_or_create_series(self, region_id, type_id):
+        key = _group_key(region_id, type_id)
+        series = self._series.get(key)
+        if series is None:
+            series = HistorySeries(*key)
+            self._series[key] = series
+        return series
+
+    def upsert(self, items_in_region_list):
+        """
+        Merges a region+item list into the matching series.
+
+        :param items_in_region_list: A HistoryItemsInRegionList (or one of
+            its lazy or columnar counterparts).
+        :rtype: int
+        :returns: The number of days that were added or replaced.
+        """
+        series = self._get_or_create_series(
+            items_in_region_list.region_id, items_in_region_list.type_id)
+        return series.upsert(
+            items_in_region_list, items_in_region_list.generated_at)
+
+    def upsert_history_list(self, history_list):
+        """
+        Merges every region+item list in a history list.
+
+        :param MarketHistoryList history_list: The history to merge.
+        :rtype: int
+        :returns: The number of days that were added or replaced.
+        """
+        groups = history_list.get_all_entries_grouped()
+        return sum([self.upsert(group) for group in groups])
+
+    def save(self, fobj):
+        """
+        Writes the store to a file, as little-endian column blocks. The
+        name, typecode and item size of each column are written up front,
+        so that :py:meth:`load` can tell whether they match its own.
+
+        :param fobj: A file-like object, opened in binary mode.
+        """
+        columns = _get_column_layout()
+        fobj.write(_FILE_HEADER.pack(
+            MAGIC, FORMAT_VERSION, len(self._series), len(columns)))
+        for name, typecode, itemsize in columns:
+            fobj.write(_COLUMN_HEADER.pack(len(name), typecode, itemsize))
+            fobj.write(name)
+        for series in self._series.itervalues():
+            fobj.write(_SERIES_HEADER.pack(
+                series.region_id or 0, series.type_id, len(series)))
+            for column in series._column_arrays:
+                if sys.byteorder != 'little':
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                fobj.write(column.tostring())
+
+    @classmethod
+    def load(cls, fobj):
+        """
+        Reads a store written by :py:meth:`save`.
+
+        :param fobj: A file-like object, opened in binary mode.
+        :rtype: HistoryStore
+        :raises: ParseError if the file is invalid or truncated.
+        """
+        def read(size):
+            data = fobj.read(size)
+            if len(data) != size:
+                raise ParseError("History store file is truncated.")
+            return data
+
+        magic, version, num_series, num_columns = _FILE_HEADER.unpack(
+            read(_FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ParseError("Not a history store file.")
+        if version != FORMAT_VERSION:
+            raise ParseError(
+                "Unsupported history store format version: %d" % version)
+
+        # The typecodes are compared along with the item sizes, since an
+        # integer column and a double column are both 8 bytes wide.
+        expected_columns = _get_column_layout()
+        if num_columns != len(expected_columns):
+            raise ParseError(
+                "History store has %d columns, expected %d." % (
+                    num_columns, len(expected_columns)))
+        stored_columns = []
+        for _ in xrange(num_columns):
+            name_length, typecode, itemsize = _COLUMN_HEADER.unpack(
+                read(_COLUMN_HEADER.size))
+            stored_columns.append((read(name_length), typecode, itemsize))
+        if stored_columns != expected_columns:
+            raise ParseError(
+                "History store columns don't match this version of EMDS.")
+
+        store = cls()
+        for _ in xrange(num_series):
+            region_id, type_id, num_rows = _SERIES_HEADER.unpack(
+                read(_SERIES_HEADER.size))
+            series = store._get_or_create_series(region_id, type_id)
+            columns = []
+            for _, typecode in series.COLUMNS:
+                column = array.array(typecode)
+                column.fromstring(read(column.itemsize * num_rows))
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                columns.append(column)
+            series._set_columns(columns)
+        return store
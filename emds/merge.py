@@ -0,0 +1,206 @@
+"""
+Keeps a running copy of the market by merging in region+item snapshots as
+they arrive, and reports what changed at the order level.
+
+Each :py:class:`MarketItemsInRegionList
+<emds.data_structures.MarketItemsInRegionList>` that comes in is a full
+snapshot of one region+item combo. Rather than throwing the old one away,
+:py:meth:`OrderState.merge` compares it with what's stored (by order ID) and
+returns an :py:class:`OrderDiff` of the added, removed, and changed orders.
+Snapshots that are older than the stored one are ignored, since relays
+don't always deliver messages in order.
+"""
+from emds.data_structures import _group_key
+
+
+class OrderDiff(object):
+    """
+    The differences between two snapshots of a region+item combo.
+    """
+
+    __slots__ = (
+        'region_id', 'type_id', 'generated_at', 'added', 'removed',
+        'changed',
+    )
+
+    def __init__(self, region_id, type_id, generated_at):
+        """
+        :param int region_id: The region ID that the diff pertains to.
+        :param int type_id: The type ID that the diff pertains to.
+        :param datetime.datetime generated_at: When the newer snapshot was
+            generated.
+        """
+        self.region_id = region_id
+        self.type_id = type_id
+        self.generated_at = generated_at
+        #: Orders that are new in this snapshot.
+        self.added = []
+        #: Orders that are no longer present.
+        self.removed = []
+        #: ``(old order, new order)`` tuples for orders whose price or
+        #: remaining volume changed.
+        self.changed = []
+
+    def __repr__(self):
+        return "<OrderDiff: %s/%s +%d -%d ~%d>" % (
+            self.region_id, self.type_id, len(self.added), len(self.removed),
+            len(self.changed))
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The total number of added, removed, and changed orders.
+        """
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+
+class RegionOrderState(object):
+    """
+    The current orders for a single region+item combo, keyed by order ID.
+    """
+
+    def __init__(self, region_id, type_id):
+        """
+        :param int region_id: The region ID that the state pertains to.
+        :param int type_id: The type ID that the state pertains to.
+        """
+        self.region_id = region_id
+        self.type_id = type_id
+        #: When the most recently merged snapshot was generated. None until
+        #: something has been merged.
+        self.generated_at = None
+        # Maps order IDs to MarketOrder instances.
+        self._orders = {}
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of orders currently stored.
+        """
+        return len(self._orders)
+
+    def __iter__(self):
+        """
+        .. note:: This is a generator!
+
+        :rtype: generator
+        :returns: Generates the stored MarketOrder instances.
+        """
+        return self._orders.itervalues()
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def get_order(self, order_id):
+        """
+        :param int order_id: The order ID to look for.
+        :rtype: MarketOrder or None
+        """
+        return self._orders.get(order_id)
+
+    def merge(self, items_in_region_list):
+        """
+        Replaces the stored orders with those in a newer snapshot. Runs in
+        time linear in the size of the old and new snapshots.
+
+        :param items_in_region_list: A MarketItemsInRegionList (or one of
+            its lazy or columnar counterparts) for this region+item combo.
+        :rtype: OrderDiff or None
+        :returns: What changed, or None if the snapshot is older than the
+            stored one, and was ignored.
+        """
+        generated_at = items_in_region_list.generated_at
+        if self.generated_at is not None and generated_at < self.generated_at:
+            return None
+
+        # The new index is built up on the side, and only swapped in once
+        # the whole snapshot has been read, so a snapshot that blows up
+        # part way through leaves the stored orders as they were. If an
+        # order ID turns up more than once, the last one wins.
+        new_orders = {}
+        order_ids = []
+        for order in items_in_region_list:
+            order_id = order.order_id
+            if order_id not in new_orders:
+                order_ids.append(order_id)
+            new_orders[order_id] = order
+
+        diff = OrderDiff(self.region_id, self.type_id, generated_at)
+        old_orders = self._orders
+        for order_id in order_ids:
+            order = new_orders[order_id]
+            old_order = old_orders.get(order_id)
+            if old_order is None:
+                diff.added.append(order)
+            elif old_order.price != order.price or \
+                 old_order.volume_remaining != order.volume_remaining:
+                diff.changed.append((old_order, order))
+        # Anything the snapshot lacks has been filled or cancelled.
+        diff.removed = [
+            order for order_id, order in old_orders.iteritems()
+            if order_id not in new_orders]
+
+        self._orders = new_orders
+        self.generated_at = generated_at
+        return diff
+
+
+class OrderState(object):
+    """
+    The current orders for any number of region+item combos, which are kept
+    up to date by merging in snapshots.
+    """
+
+    def __init__(self):
+        # Maps (region_id, type_id) tuples to RegionOrderState instances.
+        self._groups = {}
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of orders currently stored, across all
+            region+item combos.
+        """
+        return sum([len(group) for group in self._groups.itervalues()])
+
+    def get_group(self, region_id, type_id):
+        """
+        :param int region_id: The region ID to look for. May be None.
+        :param int type_id: The type ID to look for.
+        :rtype: RegionOrderState or None
+        """
+        return self._groups.get(_group_key(region_id, type_id))
+
+    def merge(self, items_in_region_list):
+        """
+        Merges a region+item snapshot into the state.
+
+        :param items_in_region_list: A MarketItemsInRegionList (or one of
+            its lazy or columnar counterparts).
+        :rtype: OrderDiff or None
+        :returns: What changed, or None if the snapshot is older than the
+            stored one, and was ignored.
+        """
+        key = _group_key(
+            items_in_region_list.region_id, items_in_region_list.type_id)
+        group = self._groups.get(key)
+        if group is None:
+            group = RegionOrderState(*key)
+            self._groups[key] = group
+        return group.merge(items_in_region_list)
+
+    def merge_order_list(self, order_list):
+        """
+        Merges every region+item snapshot in an order list.
+
+        :param MarketOrderList order_list: The snapshots to merge.
+        :rtype: list
+        :returns: A list of :py:class:`OrderDiff` instances, one for each
+            snapshot that wasn't ignored.
+        """
+        diffs = []
+        for items_in_region_list in order_list.get_all_order_groups():
+            diff = self.merge(items_in_region_list)
+            if diff is not None:
+                diffs.append(diff)
+        return diffs
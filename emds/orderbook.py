@@ -0,0 +1,373 @@
+"""
+Price-sorted order books, built from the orders in a region+item list.
+
+An :py:class:`OrderBook` aggregates a region+item list's orders into price
+levels, once, so that best prices, spreads, depth, and the average price of
+filling a given quantity can be answered without re-sorting anything. Each
+side keeps running totals of volume and ISK per level, which makes depth
+lookups O(1) and price/quantity lookups O(log n) (via :py:mod:`bisect`).
+
+Order range and location aren't taken into account: every order in the
+region+item list counts towards the book.
+
+:py:func:`compute_reference_prices` builds on the books to work out the
+manipulation-resistant reference prices that market sites tend to quote: the
+volume-weighted average of the cheapest few percent of sell volume, and the
+most expensive few percent of buy volume.
+"""
+import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
+from emds.columnar import ColumnarItemsInRegionList
+
+# The default percentage of volume that reference prices are averaged over.
+DEFAULT_PERCENTILE = 5
+
+
+class OrderBookSide(object):
+    """
+    One side (bids or asks) of an :py:class:`OrderBook`. Price levels are
+    stored best first: highest first for bids, lowest first for asks.
+    """
+
+    def __init__(self, is_bid, volume_by_price, order_count=0):
+        """
+        :param bool is_bid: True for the bid (buy order) side.
+        :param dict volume_by_price: Maps prices to the total volume
+            remaining at that price.
+        :keyword int order_count: How many orders went into the levels.
+        """
+        self.is_bid = is_bid
+        #: The number of orders on this side.
+        self.order_count = order_count
+        prices = sorted(volume_by_price, reverse=is_bid)
+
+        #: Level prices, best first.
+        self.prices = array.array('d', prices)
+        #: Total volume remaining at each level.
+        self.volumes = array.array('d')
+        #: Total volume at each level, and all better ones.
+        self.cumulative_volumes = array.array('d')
+        # Total ISK value at each level, and all better ones.
+        self._cumulative_values = array.array('d')
+        # Prices in ascending "worseness", for bisecting. Bid prices are
+        # negated, since the best bid is the highest.
+        self._sort_keys = array.array(
+            'd', [-price for price in prices] if is_bid else prices)
+
+        total_volume = 0.0
+        total_value = 0.0
+        for price in prices:
+            volume = volume_by_price[price]
+            total_volume += volume
+            total_value += volume * price
+            self.volumes.append(volume)
+            self.cumulative_volumes.append(total_volume)
+            self._cumulative_values.append(total_value)
+
+    def __len__(self):
+        """
+        :rtype: int
+        :returns: The number of price levels on this side.
+        """
+        return len(self.prices)
+
+    @property
+    def best_price(self):
+        """
+        The best price on this side, or None if there are no orders.
+
+        :rtype: float or None
+        """
+        if not self.prices:
+            return None
+        return self.prices[0]
+
+    @property
+    def total_volume(self):
+        """
+        The volume remaining across every order on this side.
+
+        :rtype: float
+        """
+        if not self.cumulative_volumes:
+            return 0.0
+        return self.cumulative_volumes[-1]
+
+    def get_levels(self, levels=None):
+        """
+        :keyword int levels: How many of the best price levels to return.
+            Defaults to all of them.
+        :rtype: list
+        :returns: A list of ``(price, volume)`` tuples, best first.
+        """
+        return zip(self.prices[:levels], self.volumes[:levels])
+
+    def get_depth(self, levels):
+        """
+        :param int levels: How many of the best price levels to count.
+        :rtype: float
+        :returns: The volume available within the best ``levels`` price
+            levels.
+        """
+        levels = min(levels, len(self.prices))
+        if levels <= 0:
+            return 0.0
+        return self.cumulative_volumes[levels - 1]
+
+    def get_volume_at_price(self, price):
+        """
+        :param float price: A limit price.
+        :rtype: float
+        :returns: The volume available at the given price or better.
+        """
+        key = -price if self.is_bid else price
+        levels = bisect_right(self._sort_keys, key)
+        return self.get_depth(levels)
+
+    def get_weighted_price(self, quantity):
+        """
+        Works out the average price per unit of filling ``quantity`` units
+        from the best orders on this side.
+
+        :param float quantity: How many units to fill.
+        :rtype: float or None
+        :returns: The volume-weighted average price, or None if there isn't
+            enough volume on this side.
+        """
+        if quantity <= 0:
+            raise ValueError('quantity must be greater than zero.')
+        # The first level at which the cumulative volume covers quantity.
+        level = bisect_left(self.cumulative_volumes, quantity)
+        if level >= len(self.prices):
+            return None
+
+        if level:
+            filled_volume = self.cumulative_volumes[level - 1]
+            filled_value = self._cumulative_values[level - 1]
+        else:
+            filled_volume = filled_value = 0.0
+        value = filled_value + (quantity - filled_volume) * self.prices[level]
+        return value / quantity
+
+
+class OrderBook(object):
+    """
+    The bids and asks for a single region+item combo.
+    """
+
+    def __init__(self, region_id, type_id, generated_at, bids, asks):
+        """
+        :param int region_id: The region ID that the book pertains to.
+        :param int type_id: The type ID of the item the book pertains to.
+        :param datetime.datetime generated_at: When the underlying data was
+            generated.
+        :param OrderBookSide bids: The bid side.
+        :param OrderBookSide asks: The ask side.
+        """
+        self.region_id = region_id
+        self.type_id = type_id
+        self.generated_at = generated_at
+        self.bids = bids
+        self.asks = asks
+
+    def __repr__(self):
+        return "<OrderBook: %s/%s bid: %s ask: %s>" % (
+            self.region_id, self.type_id, self.best_bid, self.best_ask)
+
+    @classmethod
+    def from_region_list(cls, items_in_region_list):
+        """
+        Builds an order book from a region+item list.
+
+        :param items_in_region_list: A MarketItemsInRegionList (or one of
+            its lazy or columnar counterparts).
+        :rtype: OrderBook
+        """
+        if isinstance(items_in_region_list, ColumnarItemsInRegionList):
+            # Skip building MarketOrder instances.
+            rows = izip(
+                items_in_region_list.get_column('is_bid'),
+                items_in_region_list.get_column('price'),
+                items_in_region_list.get_column('volume_remaining'))
+        else:
+            rows = (
+                (order.is_bid, order.price, order.volume_remaining)
+                for order in items_in_region_list)
+
+        bid_volumes = {}
+        ask_volumes = {}
+        bid_count = 0
+        for is_bid, price, volume_remaining in rows:
+            if is_bid:
+                volumes = bid_volumes
+                bid_count += 1
+            else:
+                volumes = ask_volumes
+            volumes[price] = volumes.get(price, 0.0) + volume_remaining
+
+        return cls(
+            items_in_region_list.region_id, items_in_region_list.type_id,
+            items_in_region_list.generated_at,
+            OrderBookSide(True, bid_volumes, bid_count),
+            OrderBookSide(
+                False, ask_volumes, len(items_in_region_list) - bid_count))
+
+    def get_side(self, is_bid):
+        """
+        :param bool is_bid: True for the bid side, False for asks.
+        :rtype: OrderBookSide
+        """
+        return self.bids if is_bid else self.asks
+
+    @property
+    def best_bid(self):
+        """
+        The highest bid price, or None if there are no bids.
+
+        :rtype: float or None
+        """
+        return self.bids.best_price
+
+    @property
+    def best_ask(self):
+        """
+        The lowest ask price, or None if there are no asks.
+
+        :rtype: float or None
+        """
+        return self.asks.best_price
+
+    @property
+    def spread(self):
+        """
+        The lowest ask minus the highest bid, or None if either side is
+        empty.
+
+        :rtype: float or None
+        """
+        if self.best_bid is None or self.best_ask is None:
+            return None
+        return self.best_ask - self.best_bid
+
+    def get_depth(self, is_bid, levels):
+        """
+        :param bool is_bid: True for the bid side, False for asks.
+        :param int levels: How many of the best price levels to count.
+        :rtype: float
+        :returns: The volume available within the best ``levels`` levels.
+        """
+        return self.get_side(is_bid).get_depth(levels)
+
+    def get_weighted_price(self, is_bid, quantity):
+        """
+        Works out the average price per unit of filling ``quantity`` units
+        against one side of the book. Selling walks the bids, and buying
+        walks the asks.
+
+        :param bool is_bid: True to fill against the bids, False for asks.
+        :param float quantity: How many units to fill.
+        :rtype: float or None
+        :returns: The volume-weighted average price, or None if there isn't
+            enough volume.
+        """
+        return self.get_side(is_bid).get_weighted_price(quantity)
+
+    def get_reference_prices(self, percentile=DEFAULT_PERCENTILE):
+        """
+        :keyword float percentile: The percentage of each side's volume to
+            average over, starting from the best price.
+        :rtype: ReferencePrices
+        """
+        return ReferencePrices(self, percentile)
+
+
+class ReferencePrices(object):
+    """
+    Percentile-based reference prices, and totals, for a region+item combo.
+    The buy price is the volume-weighted average of the highest priced
+    ``percentile`` percent of bid volume, and the sell price is the same
+    for the lowest priced asks.
+    """
+
+    __slots__ = (
+        'region_id', 'type_id', 'percentile', 'buy_price', 'sell_price',
+        'buy_volume', 'sell_volume', 'buy_orders', 'sell_orders',
+        'max_buy_price', 'min_sell_price',
+    )
+
+    def __init__(self, order_book, percentile=DEFAULT_PERCENTILE):
+        """
+        :param OrderBook order_book: The book to work the prices out from.
+        :keyword float percentile: The percentage of each side's volume to
+            average over.
+        """
+        if not 0 < percentile <= 100:
+            raise ValueError('percentile must be between 0 and 100.')
+        self.region_id = order_book.region_id
+        self.type_id = order_book.type_id
+        self.percentile = percentile
+        #: Volume-weighted buy and sell prices. None if a side is empty.
+        self.buy_price = self._get_percentile_price(order_book.bids)
+        self.sell_price = self._get_percentile_price(order_book.asks)
+        #: The total volume remaining on each side.
+        self.buy_volume = order_book.bids.total_volume
+        self.sell_volume = order_book.asks.total_volume
+        #: How many orders are on each side.
+        self.buy_orders = order_book.bids.order_count
+        self.sell_orders = order_book.asks.order_count
+        #: The best (raw) price on each side.
+        self.max_buy_price = order_book.best_bid
+        self.min_sell_price = order_book.best_ask
+
+    def __repr__(self):
+        return "<ReferencePrices: %s/%s buy: %s sell: %s>" % (
+            self.region_id, self.type_id, self.buy_price, self.sell_price)
+
+    def _get_percentile_price(self, side):
+        total_volume = side.total_volume
+        if not total_volume:
+            return None
+        return side.get_weighted_price(total_volume * self.percentile / 100.0)
+
+
+def build_order_books(order_list, type_id=None, region_id=None):
+    """
+    Builds order books for the region+item lists in an order list.
+
+    :param MarketOrderList order_list: The orders to build books from.
+    :keyword int type_id: Only build books for this type ID.
+    :keyword int region_id: Only build books for this region ID.
+    :rtype: dict
+    :returns: A dict of ``(region_id, type_id)`` tuples to
+        :py:class:`OrderBook` instances.
+    """
+    books = {}
+    for group in order_list.iter_groups(type_id=type_id, region_id=region_id):
+        books[(group.region_id, group.type_id)] = \
+            OrderBook.from_region_list(group)
+    return books
+
+def compute_reference_prices(order_list, percentile=DEFAULT_PERCENTILE,
+                             type_id=None, region_id=None):
+    """
+    Works out the reference prices for every region+item list in an order
+    list. Each one's orders are aggregated into price levels (straight from
+    the columns, for columnar region+item lists) rather than sorted as
+    :py:class:`MarketOrder <emds.data_structures.MarketOrder>` instances.
+
+    :param MarketOrderList order_list: The orders to price.
+    :keyword float percentile: The percentage of each side's volume to
+        average over, starting from the best price.
+    :keyword int type_id: Only price this type ID.
+    :keyword int region_id: Only price this region ID.
+    :rtype: dict
+    :returns: A dict of ``(region_id, type_id)`` tuples to
+        :py:class:`ReferencePrices` instances.
+    """
+    books = build_order_books(
+        order_list, type_id=type_id, region_id=region_id)
+    prices = {}
+    for key, book in books.iteritems():
+        prices[key] = book.get_reference_prices(percentile)
+    return prices
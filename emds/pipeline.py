@@ -0,0 +1,421 @@
+"""
+A staged ingestion pipeline for market messages: receive, decompress and
+parse, then hand off to a sink.
+
+Each stage runs in its own thread, and the stages are joined by bounded
+queues. When a later stage falls behind, the queue in front of it fills up
+and the stage before it waits, rather than memory use growing without
+bound. Decompression and parsing are CPU-heavy, so they're done together in
+a pool of worker processes (see :py:mod:`emds.formats.unified.batch`),
+which also means the compressed payload is all that has to be sent over to
+the workers.
+
+Messages come from a :py:class:`Transport`. :py:class:`ReplayTransport`
+replays messages from memory or a recording on disk, which is handy for
+tests and benchmarks. :py:class:`ZmqTransport` subscribes to an EMDR relay,
+and needs pyzmq.
+
+A minimal consumer looks like::
+
+    def sink(market_list):
+        # Do something with the MarketOrderList or MarketHistoryList.
+        pass
+
+    transport = ZmqTransport('tcp://relay-us-central-1.eve-emdr.com:8050')
+    Pipeline(transport, sink).run()
+"""
+import logging
+import struct
+import threading
+from multiprocessing import TimeoutError
+from Queue import Queue, Empty, Full
+from emds.exceptions import EMDSError
+from emds.formats.unified import batch
+
+logger = logging.getLogger(__name__)
+
+# How long blocking calls wait before checking whether the pipeline has
+# been stopped, in seconds.
+POLL_INTERVAL = 0.1
+
+# Replay files are a series of length-prefixed messages.
+_REPLAY_LENGTH = struct.Struct('<I')
+
+# Passed down the queues to tell the next stage that there's nothing more.
+_END = object()
+
+
+class WorkerError(Exception):
+    """
+    Raised when one of the pipeline's parsing worker processes dies, taking
+    the message it was working on with it.
+    """
+    pass
+
+
+class Transport(object):
+    """
+    Base class for message sources. Sub-classes must implement
+    :py:meth:`recv`.
+    """
+
+    def open(self):
+        """
+        Called once, from the receiving thread, before the first
+        :py:meth:`recv`.
+        """
+        pass
+
+    def recv(self, timeout):
+        """
+        Waits for the next raw message.
+
+        :param float timeout: How long to wait, in seconds.
+        :rtype: str or None
+        :returns: The raw message, or None if nothing turned up in time.
+        :raises: EOFError when there are no more messages.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Called once, from the receiving thread, after the last
+        :py:meth:`recv`.
+        """
+        pass
+
+
+class ReplayTransport(Transport):
+    """
+    Replays messages from an iterable, such as a list or a replay file read
+    with :py:meth:`from_file`.
+    """
+
+    def __init__(self, messages):
+        """
+        :param messages: An iterable of raw messages.
+        """
+        self._messages = iter(messages)
+
+    @classmethod
+    def from_file(cls, fobj):
+        """
+        Replays a file written by :py:func:`write_replay_file`, reading one
+        message at a time.
+
+        :param fobj: A file-like object, opened in binary mode.
+        :rtype: ReplayTransport
+        """
+        return cls(iter_replay_file(fobj))
+
+    def recv(self, timeout):
+        try:
+            return next(self._messages)
+        except StopIteration:
+            raise EOFError()
+
+
+class ZmqTransport(Transport):
+    """
+    Subscribes to a ZeroMQ publisher, such as an EMDR relay. Requires pyzmq.
+    """
+
+    def __init__(self, uri, context=None):
+        """
+        :param str uri: The relay to connect to.
+        :keyword context: A ``zmq.Context`` to use. Defaults to the global
+            instance.
+        """
+        self.uri = uri
+        self._context = context
+        self._socket = None
+        self._poller = None
+
+    def open(self):
+        # pyzmq is only needed for this transport.
+        import zmq
+        context = self._context or zmq.Context.instance()
+        self._socket = context.socket(zmq.SUB)
+        self._socket.connect(self.uri)
+        # Disable filtering.
+        self._socket.setsockopt(zmq.SUBSCRIBE, '')
+        self._poller = zmq.Poller()
+        self._poller.register(self._socket, zmq.POLLIN)
+
+    def recv(self, timeout):
+        if not self._poller.poll(timeout * 1000):
+            return None
+        return self._socket.recv()
+
+    def close(self):
+        self._socket.close()
+
+
+def write_replay_file(messages, fobj):
+    """
+    Records raw messages to a file, for :py:meth:`ReplayTransport.from_file`.
+
+    :param messages: An iterable of raw messages.
+    :param fobj: A file-like object, opened in binary mode.
+    """
+    for message in messages:
+        fobj.write(_REPLAY_LENGTH.pack(len(message)))
+        fobj.write(message)
+
+def iter_replay_file(fobj):
+    """
+    Reads the messages back out of a replay file.
+
+    .. note:: This is a generator!
+
+    :param fobj: A file-like object, opened in binary mode.
+    :rtype: generator
+    :raises: EOFError if the file is truncated.
+    """
+    while True:
+        length = fobj.read(_REPLAY_LENGTH.size)
+        if not length:
+            return
+        if len(length) != _REPLAY_LENGTH.size:
+            raise EOFError("Replay file is truncated.")
+        length, = _REPLAY_LENGTH.unpack(length)
+        message = fobj.read(length)
+        if len(message) != length:
+            raise EOFError("Replay file is truncated.")
+        yield message
+
+
+class Pipeline(object):
+    """
+    Receives messages from a transport, parses them in worker processes,
+    and passes the resulting order and history lists to a sink, in the
+    order they were received.
+    """
+
+    def __init__(self, transport, sink, compressed=True, workers=None,
+                 queue_size=100, trusted=False):
+        """
+        :param Transport transport: Where the messages come from.
+        :param callable sink: Called with each parsed MarketOrderList or
+            MarketHistoryList. Their region+item lists are columnar.
+        :keyword bool compressed: True if the messages are zlib-compressed,
+            as EMDR relays them.
+        :keyword int workers: How many worker processes to parse with.
+            Defaults to the number of CPUs. With ``0``, messages are parsed
+            in a thread of this process instead.
+        :keyword int queue_size: How many messages may wait between each
+            pair of stages, including those being parsed.
+        :keyword bool trusted: If True, skip validating each order or
+            history entry. Only use this on data that EMDS encoded itself.
+        """
+        self.transport = transport
+        self.sink = sink
+        self.compressed = compressed
+        self.workers = workers
+        self.trusted = trusted
+        self._received = Queue(queue_size)
+        self._parsing = Queue(queue_size)
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pool = None
+        self._pool_processes = []
+        self._error = None
+
+        #: How many messages have been received.
+        self.received_count = 0
+        #: How many messages have been passed to the sink.
+        self.parsed_count = 0
+        #: How many messages couldn't be parsed, and were skipped.
+        self.invalid_count = 0
+
+    def start(self):
+        """
+        Starts the pipeline's threads (and worker processes), and returns
+        right away.
+        """
+        if self.workers != 0:
+            # Imported here, since this module is otherwise thread-only.
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.workers)
+            # The pool quietly replaces workers that die, so hang on to the
+            # originals to find out about it. They never exit otherwise.
+            self._pool_processes = list(self._pool._pool)
+        for target in (self._receive, self._parse, self._deliver):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the pipeline without waiting for queued messages to be
+        handled.
+        """
+        self._stopping.set()
+
+    def join(self):
+        """
+        Waits for the pipeline to finish, which happens once the transport
+        runs out of messages (or :py:meth:`stop` is called), and everything
+        received has been handed to the sink.
+
+        :raises: Whatever the sink or transport raised, if they failed, or
+            WorkerError if a worker process died.
+        """
+        for thread in self._threads:
+            # Joining with a timeout keeps KeyboardInterrupt working.
+            while thread.is_alive():
+                thread.join(POLL_INTERVAL)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+        if self._error is not None:
+            raise self._error
+
+    def run(self):
+        """
+        Starts the pipeline, and waits for it to finish.
+        """
+        self.start()
+        try:
+            self.join()
+        except KeyboardInterrupt:
+            self.stop()
+            self.join()
+
+    def _fail(self, exc):
+        """
+        Records an error from one of the stages, and shuts everything down.
+        """
+        logger.exception('Pipeline stage failed.')
+        if self._error is None:
+            self._error = exc
+        self._stopping.set()
+
+    def _put(self, queue, item):
+        """
+        Waits for room in a queue. This is where backpressure comes from.
+
+        :rtype: bool
+        :returns: False if the pipeline was stopped while waiting.
+        """
+        while not self._stopping.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue):
+        """
+        Waits for an item from a queue.
+
+        :returns: The item, or _END if the pipeline was stopped.
+        """
+        while not self._stopping.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+        return _END
+
+    def _wait_for(self, async_result):
+        """
+        Waits for a result from the worker pool, keeping an eye on the
+        workers while doing so. A worker that dies mid-message never
+        reports back, so a plain ``get()`` would wait forever.
+
+        :returns: The result, or _END if the pipeline was stopped.
+        :raises: WorkerError if a worker process has died.
+        """
+        while not self._stopping.is_set():
+            try:
+                return async_result.get(POLL_INTERVAL)
+            except TimeoutError:
+                dead = [process for process in self._pool_processes
+                        if process.exitcode is not None]
+                if dead:
+                    raise WorkerError('; '.join([
+                        'worker %d exited with code %s' % (
+                            process.pid, process.exitcode)
+                        for process in dead]))
+        return _END
+
+    def _receive(self):
+        """
+        Stage one: pulls raw messages off of the transport.
+        """
+        try:
+            self.transport.open()
+            try:
+                while not self._stopping.is_set():
+                    try:
+                        message = self.transport.recv(POLL_INTERVAL)
+                    except EOFError:
+                        break
+                    if message is None:
+                        continue
+                    self.received_count += 1
+                    if not self._put(self._received, message):
+                        break
+            finally:
+                self.transport.close()
+        except Exception as exc:
+            self._fail(exc)
+        self._put(self._received, _END)
+
+    def _parse(self):
+        """
+        Stage two: decompresses and parses messages, in the worker pool if
+        there is one.
+        """
+        try:
+            while True:
+                message = self._get(self._received)
+                if message is _END:
+                    break
+                job = (message, self.compressed, self.trusted)
+                if self._pool is None:
+                    result = batch._parse_to_columns(job)
+                else:
+                    # Handed over without waiting, so that the workers stay
+                    # busy. The queue's size limits how many are in flight.
+                    result = self._pool.apply_async(
+                        batch._parse_to_columns, (job,))
+                if not self._put(self._parsing, result):
+                    break
+        except Exception as exc:
+            self._fail(exc)
+        self._put(self._parsing, _END)
+
+    def _deliver(self):
+        """
+        Stage three: waits for each parsed message in turn, and hands it to
+        the sink.
+        """
+        try:
+            while True:
+                result = self._get(self._parsing)
+                if result is _END:
+                    break
+                if self._pool is not None:
+                    result = self._wait_for(result)
+                    if result is _END:
+                        break
+                if result[0] is None:
+                    self.invalid_count += 1
+                    logger.warning('Skipping invalid message: %s', result[1])
+                    continue
+                # Bad messages are skipped, but anything the sink raises
+                # stops the pipeline.
+                try:
+                    market_list = batch._build_market_list(result)
+                except (EMDSError, KeyError, ValueError, TypeError) as exc:
+                    self.invalid_count += 1
+                    logger.warning('Skipping invalid message: %s', exc)
+                    continue
+                self.sink(market_list)
+                self.parsed_count += 1
+        except Exception as exc:
+            self._fail(exc)
@@ -0,0 +1,300 @@
+"""
+A pool of worker processes that each own a slice (shard) of some per
+region+item state, such as an :py:class:`OrderState
+<emds.merge.OrderState>` or :py:class:`HistoryStore
+<emds.history_store.HistoryStore>`.
+
+Every region+item list submitted to the pool is routed to the shard
+``hash((region_id, type_id)) % N``, so all updates for a given combo land on
+the same worker, in the order they were submitted. Region+item lists are
+sent over in :py:mod:`columnar <emds.columnar>` form, which is cheap to
+pickle. Queries can be sent to every shard (and the answers gathered up), or
+routed to the one shard that owns a combo.
+
+For example::
+
+    with ShardedWorkerPool(OrderState, workers=4) as pool:
+        for market_list in unified.parse_many(messages):
+            pool.submit_list(market_list)
+        total_orders = sum(pool.query('__len__'))
+        region_state = pool.query_group(10000002, 34, 'get_group',
+                                        10000002, 34)
+"""
+import logging
+import multiprocessing
+import pickle
+from Queue import Empty, Full
+from emds.columnar import ColumnarItemsInRegionList, \
+    ColumnarHistoryItemsInRegionList
+from emds.data_structures import HistoryItemsInRegionList, _group_key
+
+logger = logging.getLogger(__name__)
+
+# How long blocking calls wait before checking whether the workers they are
+# waiting on are still alive, in seconds.
+POLL_INTERVAL = 0.5
+
+# Message types sent to the workers.
+_UPDATE = 'update'
+_QUERY = 'query'
+_FAILURES = 'failures'
+_STOP = 'stop'
+
+
+class ShardError(Exception):
+    """
+    Raised in the parent process when a query fails in a worker, or a
+    worker has died.
+    """
+    pass
+
+
+def _to_columnar(items_in_region_list):
+    """
+    Converts a region+item list to its columnar counterpart, unless it
+    already is one.
+    """
+    if isinstance(items_in_region_list, (
+            ColumnarItemsInRegionList, ColumnarHistoryItemsInRegionList)):
+        return items_in_region_list
+    if isinstance(items_in_region_list, HistoryItemsInRegionList):
+        return ColumnarHistoryItemsInRegionList.from_region_list(
+            items_in_region_list)
+    return ColumnarItemsInRegionList.from_region_list(items_in_region_list)
+
+def _run_shard(shard, state_factory, update_method, inbox, outbox):
+    """
+    The main loop of each worker process.
+
+    :param int shard: This worker's shard number.
+    :param callable state_factory: Builds this shard's state.
+    :param str update_method: The name of the state's method that takes
+        each region+item list.
+    :param multiprocessing.Queue inbox: Where work comes from.
+    :param multiprocessing.Queue outbox: Where this shard's query results
+        go.
+    """
+    state = state_factory()
+    update = getattr(state, update_method)
+    failed_updates = 0
+    while True:
+        message = inbox.get()
+        kind = message[0]
+        if kind == _UPDATE:
+            try:
+                update(message[1])
+            except Exception:
+                failed_updates += 1
+                logger.exception('Shard %d failed to apply an update.', shard)
+        elif kind == _QUERY:
+            request_id, method, args, kwargs = message[1:]
+            try:
+                result = getattr(state, method)(*args, **kwargs)
+                # Pickled here, rather than by the queue's feeder thread,
+                # so that unpicklable results are reported instead of lost.
+                result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            except Exception as exc:
+                outbox.put((request_id, False, repr(exc)))
+            else:
+                outbox.put((request_id, True, result))
+        elif kind == _FAILURES:
+            outbox.put((message[1], True, pickle.dumps(
+                failed_updates, pickle.HIGHEST_PROTOCOL)))
+        elif kind == _STOP:
+            return
+
+
+class ShardedWorkerPool(object):
+    """
+    Routes region+item lists to a fixed set of worker processes, each of
+    which keeps its own state.
+    """
+
+    def __init__(self, state_factory, workers=None, update_method='merge',
+                 queue_size=1000):
+        """
+        :param callable state_factory: Builds the state that each shard
+            keeps, for example :py:class:`OrderState <emds.merge.OrderState>`.
+            Must be picklable.
+        :keyword int workers: How many shards (and processes) to run.
+            Defaults to the number of CPUs.
+        :keyword str update_method: The name of the state's method that is
+            called with each region+item list. ``merge`` suits OrderState,
+            and ``upsert`` suits HistoryStore.
+        :keyword int queue_size: How many updates may be waiting for each
+            shard before :py:meth:`submit` blocks.
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        self._inboxes = []
+        # Each shard answers on its own queue. Queues are guarded by a lock
+        # shared between their writers, which a worker that dies at the
+        # wrong moment would never release.
+        self._outboxes = []
+        self._processes = []
+        self._request_id = 0
+        for shard in xrange(self.workers):
+            inbox = multiprocessing.Queue(queue_size)
+            outbox = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_run_shard,
+                args=(shard, state_factory, update_method, inbox, outbox))
+            process.daemon = True
+            process.start()
+            self._inboxes.append(inbox)
+            self._outboxes.append(outbox)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_shard(self, region_id, type_id):
+        """
+        :param int region_id: The region ID. May be None.
+        :param int type_id: The type ID.
+        :rtype: int
+        :returns: The number of the shard that owns the region+item combo.
+        """
+        return hash(_group_key(region_id, type_id)) % self.workers
+
+    def _check_alive(self, shards):
+        """
+        :raises: ShardError if any of the given shards' processes have died.
+        """
+        dead = [shard for shard in shards
+                if not self._processes[shard].is_alive()]
+        if dead:
+            raise ShardError('; '.join([
+                'shard %d exited with code %s' % (
+                    shard, self._processes[shard].exitcode)
+                for shard in dead]))
+
+    def _put(self, shard, message):
+        """
+        Sends a message to a shard, waiting for room in its queue.
+
+        :raises: ShardError if the shard dies while we wait.
+        """
+        while True:
+            self._check_alive([shard])
+            try:
+                self._inboxes[shard].put(message, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                continue
+
+    def submit(self, items_in_region_list):
+        """
+        Sends a region+item list to the shard that owns it. Blocks if that
+        shard is too far behind.
+
+        :param items_in_region_list: A MarketItemsInRegionList or
+            HistoryItemsInRegionList (or one of their lazy or columnar
+            counterparts).
+        """
+        shard = self.get_shard(
+            items_in_region_list.region_id, items_in_region_list.type_id)
+        self._put(shard, (_UPDATE, _to_columnar(items_in_region_list)))
+
+    def submit_list(self, order_or_history):
+        """
+        Sends each region+item list in an order or history list to the
+        shard that owns it.
+
+        :type order_or_history: MarketOrderList or MarketHistoryList
+        """
+        for items_in_region_list in order_or_history.iter_groups():
+            self.submit(items_in_region_list)
+
+    def _ask(self, shards, kind, *payload):
+        """
+        Sends a query to some shards, and waits for all of them to answer.
+        Each shard answers after it has applied all of the updates that
+        were submitted before the query.
+
+        :rtype: list
+        :returns: The results, in shard order.
+        :raises: ShardError if the query fails, or a shard dies before
+            answering.
+        """
+        self._request_id += 1
+        request_id = self._request_id
+        for shard in shards:
+            self._put(shard, (kind, request_id) + payload)
+
+        results = []
+        errors = []
+        for shard in shards:
+            while True:
+                try:
+                    reply_id, succeeded, result = self._outboxes[shard].get(
+                        timeout=POLL_INTERVAL)
+                except Empty:
+                    self._check_alive([shard])
+                    continue
+                # Anything else is left over from an earlier query that
+                # failed part way.
+                if reply_id == request_id:
+                    break
+            if succeeded:
+                results.append(pickle.loads(result))
+            else:
+                errors.append('shard %d: %s' % (shard, result))
+        if errors:
+            raise ShardError('; '.join(errors))
+        return results
+
+    def query(self, method, *args, **kwargs):
+        """
+        Calls a method on every shard's state, and gathers up the results.
+
+        :param str method: The name of the state's method to call.
+        :rtype: list
+        :returns: Each shard's result, in shard order.
+        :raises: ShardError if the call fails in any shard, or a shard has
+            died.
+        """
+        return self._ask(range(self.workers), _QUERY, method, args, kwargs)
+
+    def query_group(self, region_id, type_id, method, *args, **kwargs):
+        """
+        Calls a method on the state of the shard that owns a region+item
+        combo.
+
+        :param int region_id: The region ID. May be None.
+        :param int type_id: The type ID.
+        :param str method: The name of the state's method to call.
+        :returns: The shard's result.
+        :raises: ShardError if the call fails, or the shard has died.
+        """
+        shard = self.get_shard(region_id, type_id)
+        return self._ask([shard], _QUERY, method, args, kwargs)[0]
+
+    def get_failed_update_counts(self):
+        """
+        Updates that raise an exception in a worker are logged and skipped,
+        which leaves that shard's state behind. This is how to find out
+        whether it has happened.
+
+        :rtype: list
+        :returns: The number of updates that each shard has failed to apply,
+            in shard order.
+        :raises: ShardError if a shard has died.
+        """
+        return self._ask(range(self.workers), _FAILURES)
+
+    def close(self):
+        """
+        Stops the workers, once they have finished what's been submitted.
+        """
+        for shard, process in enumerate(self._processes):
+            try:
+                self._put(shard, (_STOP,))
+            except ShardError:
+                # Already dead. Don't wait on anything queued up for it
+                # when this process exits.
+                self._inboxes[shard].cancel_join_thread()
+        for process in self._processes:
+            process.join()
@@ -1,11 +1,31 @@
 """
 Unit tests for the data structures and other top-level modules.
 """
+import os
 import unittest
 import datetime
+import pickle
+import array
+import zlib
+from StringIO import StringIO
+from emds.compat import json
 from emds.data_structures import MarketOrder, MarketOrderList, MarketHistoryList, MarketHistoryEntry, MarketItemsInRegionList, HistoryItemsInRegionList
+from emds.columnar import ColumnarItemsInRegionList, ColumnarHistoryItemsInRegionList, INT64_TYPECODE
 from emds.exceptions import NaiveDatetimeError
-from emds.common_utils import now_dtime_in_utc
+from emds.formats.exceptions import ParseError
+from emds import history_stats
+from emds.benchmarks.generator import generate_message
+from emds.history_stats import SeriesStats, compute_rolling_stats
+from emds.history_store import HistoryStore
+from emds.formats import unified
+from emds.formats.unified import batch
+from emds.merge import OrderState
+from emds.orderbook import OrderBook, build_order_books, \
+    compute_reference_prices
+from emds.pipeline import Pipeline, ReplayTransport, WorkerError, \
+    write_replay_file
+from emds.sharding import ShardedWorkerPool, ShardError
+from emds.common_utils import now_dtime_in_utc, UTC_TZINFO
 
 class MarketOrderListTestCase(unittest.TestCase):
 
@@ -123,6 +143,12 @@ class MarketOrderListTestCase(unittest.TestCase):
         ))
         self.assertEqual(3, len(order_list))
 
+        # Resetting a region+item combo throws out its orders.
+        order_list.set_empty_region(
+            10000068, 10000068, now_dtime_in_utc(),
+            error_if_orders_present=False)
+        self.assertEqual(2, len(order_list))
+
         # Make sure that iterating over a MarketOrderList returns the correct
         # instance type.
         for olist in order_list:
@@ -161,6 +187,151 @@ class MarketOrderListTestCase(unittest.TestCase):
         # Use the MarketOrder instead of the order ID int.
         self.assertTrue(new_order in order_list)
 
+    def test_get_order(self):
+        """
+        Tests order lookups by order ID, on both the order list and the
+        region+item lists within it.
+        """
+        order_list = MarketOrderList()
+        self.assertIsNone(order_list.get_order(2413387906))
+        new_order = MarketOrder(
+            order_id=2413387906,
+            is_bid=True,
+            region_id=10000068,
+            solar_system_id=30005316,
+            station_id=60011521,
+            type_id=10000068,
+            price=52875,
+            volume_entered=10,
+            volume_remaining=4,
+            minimum_volume=1,
+            order_issue_date=now_dtime_in_utc(),
+            order_duration=90,
+            order_range=5,
+            generated_at=now_dtime_in_utc()
+        )
+        order_list.add_order(new_order)
+        self.assertIs(order_list.get_order(2413387906), new_order)
+        # String IDs are coerced, like they are with __contains__.
+        self.assertIs(order_list.get_order('2413387906'), new_order)
+
+        olist = list(order_list.get_all_order_groups())[0]
+        self.assertIs(olist.get_order(2413387906), new_order)
+        self.assertTrue(2413387906 in olist)
+        self.assertIsNone(olist.get_order(1))
+
+        # Replacing the region+item combo drops its orders from the index.
+        order_list.set_empty_region(
+            10000068, 10000068, now_dtime_in_utc(),
+            error_if_orders_present=False)
+        self.assertFalse(2413387906 in order_list)
+        self.assertIsNone(order_list.get_order(2413387906))
+
+    def test_group_lookup(self):
+        """
+        Tests fetching region+item groups directly, and by type or region.
+        """
+        order_list = MarketOrderList()
+        for order_id, region_id, type_id in [(1, 10000068, 34),
+                                             (2, 10000068, 35),
+                                             (3, 10000067, 34),
+                                             (4, None, 34)]:
+            order_list.add_order(MarketOrder(
+                order_id=order_id,
+                is_bid=True,
+                region_id=region_id,
+                solar_system_id=30005316,
+                station_id=60011521,
+                type_id=type_id,
+                price=52875,
+                volume_entered=10,
+                volume_remaining=4,
+                minimum_volume=1,
+                order_issue_date=now_dtime_in_utc(),
+                order_duration=90,
+                order_range=5,
+                generated_at=now_dtime_in_utc()
+            ))
+
+        olist = order_list.get_group(10000068, 34)
+        self.assertIsInstance(olist, MarketItemsInRegionList)
+        self.assertTrue(1 in olist)
+        # IDs are normalized, so strings work too.
+        self.assertIs(order_list.get_group('10000068', '34'), olist)
+        self.assertIsNone(order_list.get_group(10000067, 35))
+        # Orders lacking a region ID are grouped under None.
+        self.assertTrue(4 in order_list.get_group(None, 34))
+
+        def group_keys(groups):
+            return sorted([(g.region_id, g.type_id) for g in groups])
+
+        self.assertEqual(
+            group_keys(order_list.iter_groups(type_id=34)),
+            [(None, 34), (10000067, 34), (10000068, 34)])
+        self.assertEqual(
+            group_keys(order_list.iter_groups(region_id=10000068)),
+            [(10000068, 34), (10000068, 35)])
+        self.assertEqual(
+            group_keys(order_list.iter_groups(type_id=35, region_id=10000068)),
+            [(10000068, 35)])
+        self.assertEqual(list(order_list.iter_groups(type_id=99)), [])
+        self.assertEqual(len(list(order_list.iter_groups())), 4)
+
+    def test_order_slots(self):
+        """
+        MarketOrder is slotted, so make sure it's still pickleable and that
+        the attributes survive the round trip.
+        """
+        order = MarketOrder(
+            order_id=2413387906,
+            is_bid=True,
+            region_id=10000068,
+            solar_system_id=None,
+            station_id=60011521,
+            type_id=10000068,
+            price=52875,
+            volume_entered=10,
+            volume_remaining=4,
+            minimum_volume=1,
+            order_issue_date=now_dtime_in_utc(),
+            order_duration=90,
+            order_range=5,
+            generated_at=now_dtime_in_utc()
+        )
+        # No per-instance __dict__ should be present.
+        self.assertFalse(hasattr(order, '__dict__'))
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(order, protocol))
+            for name in MarketOrder.__slots__:
+                self.assertEqual(
+                    getattr(order, name), getattr(unpickled, name))
+
+    def test_from_trusted_row(self):
+        """
+        The trusted constructor should set every attribute as given.
+        """
+        values = dict(
+            order_id=2413387906,
+            is_bid=True,
+            region_id=10000068,
+            solar_system_id=30005316,
+            station_id=60011521,
+            type_id=10000068,
+            price=52875.0,
+            volume_entered=10,
+            volume_remaining=4,
+            minimum_volume=1,
+            order_issue_date=now_dtime_in_utc(),
+            order_duration=90,
+            order_range=5,
+            generated_at=now_dtime_in_utc()
+        )
+        order = MarketOrder.from_trusted_row(**values)
+        self.assertIsInstance(order, MarketOrder)
+        for name, value in values.items():
+            self.assertEqual(getattr(order, name), value)
+
 class MarketHistoryListTestCase(unittest.TestCase):
 
     def test_naive_datetime(self):
@@ -329,6 +500,12 @@ class MarketHistoryListTestCase(unittest.TestCase):
         # There are now three total.
         self.assertEqual(3, len(history_list))
 
+        # Resetting a region+item combo throws out its entries.
+        history_list.set_empty_region(
+            10000067, 2413387905, now_dtime_in_utc(),
+            error_if_entries_present=False)
+        self.assertEqual(2, len(history_list))
+
     def test_contains(self):
         """
         Tests the __contains__ method via the 'in' Python keyword.
@@ -354,4 +531,729 @@ class MarketHistoryListTestCase(unittest.TestCase):
         # The entry was added, so this should succeed.
         self.assertTrue(2413387906 in history_list)
         # Use the object form.
-        self.assertTrue(new_history in history_list)
\ No newline at end of file
+        self.assertTrue(new_history in history_list)
+
+
+class ColumnarTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.generated_at = now_dtime_in_utc()
+
+    def _make_order(self, order_id, price, solar_system_id=30005316):
+        return MarketOrder(
+            order_id=order_id,
+            is_bid=order_id % 2 == 0,
+            region_id=10000068,
+            solar_system_id=solar_system_id,
+            station_id=60011521,
+            type_id=34,
+            price=price,
+            volume_entered=10,
+            volume_remaining=4,
+            minimum_volume=1,
+            order_issue_date=datetime.datetime(
+                2012, 6, 19, 22, 41, 52, tzinfo=UTC_TZINFO),
+            order_duration=90,
+            order_range=5,
+            generated_at=self.generated_at
+        )
+
+    def test_order_columns(self):
+        """
+        Fills a ColumnarItemsInRegionList, and makes sure the columns and the
+        materialized orders line up with what went in.
+        """
+        orders = [self._make_order(2413387906 + i, 10.5 * (i + 1))
+                  for i in range(3)]
+        orders.append(self._make_order(1, 1.25, solar_system_id=None))
+        olist = ColumnarItemsInRegionList(10000068, 34, self.generated_at)
+        olist.extend(orders[:2])
+        for order in orders[2:]:
+            olist.add_order(order)
+
+        self.assertEqual(len(olist), 4)
+        prices = olist.get_column('price')
+        # The column is the backing array, not a copy.
+        self.assertIs(prices, olist.get_column('price'))
+        self.assertEqual(min(prices), 1.25)
+        self.assertEqual(max(prices), 31.5)
+
+        for original, materialized in zip(orders, olist):
+            self.assertIsInstance(materialized, MarketOrder)
+            for name in MarketOrder.__slots__:
+                self.assertEqual(
+                    getattr(original, name), getattr(materialized, name))
+
+        self.assertTrue(2413387907 in olist)
+        self.assertFalse(5 in olist)
+        self.assertEqual(olist.get_order(2413387907).price, 21.0)
+        self.assertIsNone(olist.get_order(1).solar_system_id)
+
+    def test_extend_columns(self):
+        """
+        Tests bulk-appending raw column values.
+        """
+        olist = ColumnarItemsInRegionList(10000068, 34, self.generated_at)
+        columns = dict([(name, [1, 2]) for name, _ in olist.COLUMNS])
+        columns['price'] = array.array('d', [5.0, 7.5])
+        olist.extend_columns(columns)
+        self.assertEqual(len(olist), 2)
+        self.assertEqual(sum(olist.get_column('price')), 12.5)
+        # Lookups by order ID work after bulk appends, too.
+        self.assertTrue(2 in olist)
+
+        del columns['price']
+        self.assertRaises(ValueError, olist.extend_columns, columns)
+        columns['price'] = [1.0]
+        self.assertRaises(ValueError, olist.extend_columns, columns)
+
+    def test_in_order_list(self):
+        """
+        Columnar region lists can be added to a MarketOrderList.
+        """
+        olist = ColumnarItemsInRegionList(10000068, 34, self.generated_at)
+        olist.add_order(self._make_order(2413387906, 5.0))
+        order_list = MarketOrderList()
+        order_list.add_group(olist)
+        self.assertEqual(len(order_list), 1)
+        self.assertTrue(2413387906 in order_list)
+        # Orders added through the order list end up in the columns.
+        order_list.add_order(self._make_order(2413387907, 6.0))
+        self.assertEqual(len(olist), 2)
+        self.assertEqual(order_list.get_order(2413387907).price, 6.0)
+
+    def test_history_columns(self):
+        """
+        Round-trips history entries through a ColumnarHistoryItemsInRegionList.
+        """
+        entry = MarketHistoryEntry(
+            type_id=34,
+            region_id=10000068,
+            historical_date=datetime.datetime(
+                2012, 6, 19, tzinfo=UTC_TZINFO),
+            num_orders=5,
+            low_price=5.0,
+            high_price=10.5,
+            average_price=7.0,
+            total_quantity=200,
+            generated_at=now_dtime_in_utc(),
+        )
+        entry_list = ColumnarHistoryItemsInRegionList.from_region_list(
+            HistoryItemsInRegionList(10000068, 34, now_dtime_in_utc()))
+        entry_list.add_entry(entry)
+        self.assertEqual(len(entry_list), 1)
+        self.assertEqual(list(entry_list.get_column('total_quantity')), [200])
+        materialized = entry_list.entries[0]
+        self.assertEqual(materialized.historical_date, entry.historical_date)
+        self.assertEqual(materialized.average_price, 7.0)
+
+        history_list = MarketHistoryList()
+        history_list.add_group(entry_list)
+        self.assertEqual(len(history_list), 1)
+        self.assertTrue(34 in history_list)
+
+
+class OrderBookTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.generated_at = now_dtime_in_utc()
+        self.order_list = MarketOrderList()
+        # (order_id, is_bid, price, volume_remaining)
+        for order_id, is_bid, price, volume_remaining in (
+                (1, True, 10.0, 5), (2, True, 9.0, 10), (3, True, 10.0, 5),
+                (4, False, 12.0, 3), (5, False, 15.0, 7), (6, False, 13.0, 10)):
+            self.order_list.add_order(MarketOrder(
+                order_id=order_id,
+                is_bid=is_bid,
+                region_id=10000068,
+                solar_system_id=30005316,
+                station_id=60011521,
+                type_id=34,
+                price=price,
+                volume_entered=volume_remaining,
+                volume_remaining=volume_remaining,
+                minimum_volume=1,
+                order_issue_date=self.generated_at,
+                order_duration=90,
+                order_range=5,
+                generated_at=self.generated_at
+            ))
+
+    def _check_book(self, book):
+        self.assertEqual(book.best_bid, 10.0)
+        self.assertEqual(book.best_ask, 12.0)
+        self.assertEqual(book.spread, 2.0)
+        self.assertEqual(book.bids.get_levels(), [(10.0, 10.0), (9.0, 10.0)])
+        self.assertEqual(book.asks.get_levels(1), [(12.0, 3.0)])
+
+        self.assertEqual(book.get_depth(True, 1), 10.0)
+        self.assertEqual(book.get_depth(False, 2), 13.0)
+        self.assertEqual(book.get_depth(False, 10), 20.0)
+        self.assertEqual(book.bids.get_volume_at_price(9.5), 10.0)
+        self.assertEqual(book.asks.get_volume_at_price(13.0), 13.0)
+        self.assertEqual(book.asks.get_volume_at_price(11.0), 0.0)
+
+        # 3 @ 12, then 2 @ 13.
+        self.assertEqual(book.get_weighted_price(False, 5), 62.0 / 5)
+        self.assertEqual(book.get_weighted_price(False, 3), 12.0)
+        self.assertEqual(book.get_weighted_price(True, 20), 9.5)
+        self.assertEqual(book.get_weighted_price(True, 21), None)
+        self.assertRaises(ValueError, book.get_weighted_price, True, 0)
+
+    def test_order_book(self):
+        """
+        Build books from regular and columnar region+item lists.
+        """
+        books = build_order_books(self.order_list)
+        self.assertEqual(books.keys(), [(10000068, 34)])
+        self._check_book(books[(10000068, 34)])
+
+        group = self.order_list.get_group(10000068, 34)
+        self._check_book(OrderBook.from_region_list(
+            ColumnarItemsInRegionList.from_region_list(group)))
+
+    def test_reference_prices(self):
+        """
+        Reference prices average over the best slice of each side's volume.
+        """
+        prices = compute_reference_prices(self.order_list, percentile=50)
+        reference = prices[(10000068, 34)]
+        # The best 10 of 20 bid units are all at 10.
+        self.assertEqual(reference.buy_price, 10.0)
+        # The best 10 of 20 ask units: 3 @ 12, then 7 @ 13.
+        self.assertEqual(reference.sell_price, (3 * 12.0 + 7 * 13.0) / 10)
+        self.assertEqual(reference.buy_volume, 20.0)
+        self.assertEqual(reference.sell_orders, 3)
+        self.assertEqual(reference.max_buy_price, 10.0)
+        self.assertEqual(reference.min_sell_price, 12.0)
+
+        group = self.order_list.get_group(10000068, 34)
+        book = OrderBook.from_region_list(
+            ColumnarItemsInRegionList.from_region_list(group))
+        self.assertEqual(book.get_reference_prices().sell_price, 12.0)
+        self.assertEqual(book.bids.order_count, 3)
+        self.assertRaises(ValueError, book.get_reference_prices, 0)
+
+        empty = OrderBook.from_region_list(
+            MarketItemsInRegionList(10000068, 34, self.generated_at))
+        self.assertEqual(empty.get_reference_prices().buy_price, None)
+
+    def test_empty_book(self):
+        book = OrderBook.from_region_list(
+            MarketItemsInRegionList(10000068, 34, self.generated_at))
+        self.assertEqual(book.best_bid, None)
+        self.assertEqual(book.spread, None)
+        self.assertEqual(book.get_depth(True, 5), 0.0)
+        self.assertEqual(book.get_weighted_price(False, 1), None)
+
+
+class OrderStateTestCase(unittest.TestCase):
+
+    def _make_group(self, generated_at, orders):
+        group = MarketItemsInRegionList(10000068, 34, generated_at)
+        for order_id, price, volume_remaining in orders:
+            group.add_order(MarketOrder(
+                order_id=order_id,
+                is_bid=True,
+                region_id=10000068,
+                solar_system_id=30005316,
+                station_id=60011521,
+                type_id=34,
+                price=price,
+                volume_entered=100,
+                volume_remaining=volume_remaining,
+                minimum_volume=1,
+                order_issue_date=generated_at,
+                order_duration=90,
+                order_range=5,
+                generated_at=generated_at
+            ))
+        return group
+
+    def test_merge(self):
+        """
+        Merge a few snapshots, and check the diffs.
+        """
+        first = datetime.datetime(2012, 6, 19, 12, tzinfo=UTC_TZINFO)
+        second = first + datetime.timedelta(minutes=5)
+        state = OrderState()
+
+        order_list = MarketOrderList()
+        order_list.add_group(self._make_group(
+            first, [(1, 10.0, 5), (2, 11.0, 5), (3, 12.0, 5)]))
+        diffs = state.merge_order_list(order_list)
+        self.assertEqual(len(diffs), 1)
+        self.assertEqual(len(diffs[0].added), 3)
+        self.assertEqual(len(state), 3)
+
+        # Order 1 is unchanged, 2 is partially filled, 3 is gone, and 4 is
+        # new.
+        diff = state.merge(self._make_group(
+            second, [(1, 10.0, 5), (2, 11.0, 2), (4, 9.0, 1)]))
+        self.assertEqual([order.order_id for order in diff.added], [4])
+        self.assertEqual([order.order_id for order in diff.removed], [3])
+        self.assertEqual(
+            [(old.volume_remaining, new.volume_remaining)
+             for old, new in diff.changed], [(5, 2)])
+        self.assertEqual(len(diff), 3)
+
+        group = state.get_group(10000068, 34)
+        self.assertEqual(group.generated_at, second)
+        self.assertEqual(group.get_order(2).volume_remaining, 2)
+        self.assertFalse(3 in group)
+
+        # Older snapshots are ignored.
+        self.assertEqual(
+            state.merge(self._make_group(first, [(5, 1.0, 1)])), None)
+        self.assertEqual(sorted([order.order_id for order in group]), [1, 2, 4])
+
+        # Columnar snapshots merge the same way.
+        third = second + datetime.timedelta(minutes=5)
+        diff = state.merge(ColumnarItemsInRegionList.from_region_list(
+            self._make_group(third, [(2, 11.0, 2), (5, 8.0, 1)])))
+        self.assertEqual([order.order_id for order in diff.added], [5])
+        self.assertEqual(
+            sorted([order.order_id for order in diff.removed]), [1, 4])
+        self.assertEqual(diff.changed, [])
+        self.assertEqual(sorted([order.order_id for order in group]), [2, 5])
+
+    def test_merge_duplicates_and_failures(self):
+        """
+        A repeated order ID should count once, with the last copy winning,
+        and a snapshot that fails part way through shouldn't be half merged.
+        """
+        first = datetime.datetime(2012, 6, 19, 12, tzinfo=UTC_TZINFO)
+        second = first + datetime.timedelta(minutes=5)
+        state = OrderState()
+        state.merge(self._make_group(first, [(1, 10.0, 5), (2, 11.0, 5)]))
+
+        diff = state.merge(self._make_group(
+            second, [(2, 11.0, 1), (3, 9.0, 1), (2, 11.0, 5), (3, 9.5, 1)]))
+        self.assertEqual([order.order_id for order in diff.added], [3])
+        self.assertEqual(diff.added[0].price, 9.5)
+        self.assertEqual([order.order_id for order in diff.removed], [1])
+        self.assertEqual(diff.changed, [])
+        group = state.get_group(10000068, 34)
+        self.assertEqual(sorted([order.order_id for order in group]), [2, 3])
+        self.assertEqual(group.get_order(2).volume_remaining, 5)
+
+        # The second row has a bad price, which only comes up once the lazy
+        # rowset is being iterated over.
+        order_list = MarketOrderList()
+        order_list.add_group(self._make_group(
+            second + datetime.timedelta(minutes=5),
+            [(2, 11.0, 2), (4, 8.0, 1)]))
+        message = json.loads(unified.encode_to_json(order_list))
+        message['rowsets'][0]['rows'][1][0] = 'cheap'
+        lazy_group = unified.parse_from_json(
+            json.dumps(message), lazy=True).get_group(10000068, 34)
+        self.assertRaises(ParseError, state.merge, lazy_group)
+        self.assertEqual(group.generated_at, second)
+        self.assertEqual(sorted([order.order_id for order in group]), [2, 3])
+        self.assertEqual(group.get_order(2).volume_remaining, 5)
+
+
+class HistoryStoreTestCase(unittest.TestCase):
+
+    def _make_group(self, generated_at, days):
+        group = HistoryItemsInRegionList(10000068, 34, generated_at)
+        for day, average_price in days:
+            group.add_entry(MarketHistoryEntry(
+                type_id=34,
+                region_id=10000068,
+                historical_date=datetime.datetime(
+                    2012, 6, day, tzinfo=UTC_TZINFO),
+                num_orders=5,
+                low_price=average_price - 1,
+                high_price=average_price + 1,
+                average_price=average_price,
+                total_quantity=200,
+                generated_at=generated_at,
+            ))
+        return group
+
+    def test_upsert(self):
+        """
+        Newer uploads should win on overlapping days, and older ones should
+        only fill in gaps.
+        """
+        first = datetime.datetime(2012, 6, 20, tzinfo=UTC_TZINFO)
+        second = first + datetime.timedelta(hours=1)
+        store = HistoryStore()
+
+        self.assertEqual(store.upsert(self._make_group(
+            first, [(3, 10.0), (1, 11.0), (5, 12.0)])), 3)
+        self.assertEqual(store.upsert(self._make_group(
+            second, [(5, 20.0), (6, 21.0), (2, 22.0)])), 3)
+        # Day 4 is new, but day 6 was generated more recently.
+        self.assertEqual(store.upsert(self._make_group(
+            first, [(6, 30.0), (4, 31.0)])), 1)
+
+        series = store.get_series(10000068, 34)
+        self.assertEqual(
+            list(series.get_column('average_price')),
+            [11.0, 22.0, 10.0, 31.0, 20.0, 21.0])
+        self.assertEqual(
+            [entry.historical_date.day for entry in series],
+            [1, 2, 3, 4, 5, 6])
+        self.assertEqual(series.get_entry(
+            datetime.datetime(2012, 6, 5, tzinfo=UTC_TZINFO)).generated_at,
+            second)
+        self.assertEqual(series.get_entry(
+            datetime.datetime(2012, 6, 7, tzinfo=UTC_TZINFO)), None)
+
+        sliced = series.get_range(
+            start=datetime.datetime(2012, 6, 2, tzinfo=UTC_TZINFO),
+            end=datetime.datetime(2012, 6, 4, tzinfo=UTC_TZINFO))
+        self.assertEqual(
+            list(sliced.get_column('average_price')), [22.0, 10.0, 31.0])
+        self.assertEqual(len(series.get_range(
+            start=datetime.datetime(2012, 6, 6, tzinfo=UTC_TZINFO))), 1)
+
+    def test_save_load(self):
+        history_list = MarketHistoryList()
+        history_list.add_group(self._make_group(
+            now_dtime_in_utc(), [(1, 10.0), (2, 11.0)]))
+        store = HistoryStore()
+        store.upsert_history_list(history_list)
+
+        fobj = StringIO()
+        store.save(fobj)
+        loaded = HistoryStore.load(StringIO(fobj.getvalue()))
+        self.assertEqual(len(loaded), 1)
+        series = loaded.get_series(10000068, 34)
+        self.assertEqual(list(series.get_column('average_price')), [10.0, 11.0])
+
+        self.assertRaises(
+            ParseError, HistoryStore.load, StringIO(fobj.getvalue()[:-1]))
+        self.assertRaises(ParseError, HistoryStore.load, StringIO('X' * 14))
+
+    def test_load_column_mismatch(self):
+        """
+        Files whose column names, typecodes or count differ from this
+        build's are rejected, even when the item sizes happen to match.
+        """
+        history_list = MarketHistoryList()
+        history_list.add_group(self._make_group(
+            now_dtime_in_utc(), [(1, 10.0)]))
+        store = HistoryStore()
+        store.upsert_history_list(history_list)
+        fobj = StringIO()
+        store.save(fobj)
+        data = fobj.getvalue()
+
+        int_column = '%s\x08historical_date' % INT64_TYPECODE
+        self.assertTrue(int_column in data)
+        for replacement in ('d\x08historical_date',
+                            int_column.replace('date', 'dote')):
+            self.assertRaises(
+                ParseError, HistoryStore.load,
+                StringIO(data.replace(int_column, replacement)))
+        # One column fewer than expected.
+        self.assertRaises(
+            ParseError, HistoryStore.load,
+            StringIO(data[:13] + chr(ord(data[13]) - 1) + data[14:]))
+
+
+class HistoryStatsTestCase(unittest.TestCase):
+
+    def test_rolling_stats(self):
+        """
+        Check the pure Python stats against hand-worked values. The NumPy
+        version is checked against it, when NumPy is installed.
+        """
+        generated_at = now_dtime_in_utc()
+        history_list = MarketHistoryList()
+        for type_id, prices in ((34, [10.0, 11.0, 0.0, 10.0, 11.0, 12.1]),
+                                (35, [5.0, 6.0])):
+            for day, price in enumerate(prices):
+                history_list.add_entry(MarketHistoryEntry(
+                    type_id=type_id,
+                    region_id=10000068,
+                    historical_date=datetime.datetime(
+                        2012, 6, day + 1, tzinfo=UTC_TZINFO),
+                    num_orders=5,
+                    low_price=price - day,
+                    high_price=price + day,
+                    average_price=price,
+                    total_quantity=day + 1,
+                    generated_at=generated_at,
+                ))
+        store = HistoryStore()
+        store.upsert_history_list(history_list)
+
+        def assert_values(values, expected):
+            self.assertEqual(len(values), len(expected))
+            for value, expected_value in zip(values, expected):
+                if expected_value is None:
+                    self.assertTrue(value != value)
+                else:
+                    self.assertAlmostEqual(value, expected_value)
+
+        stats = compute_rolling_stats(store, window=2, use_numpy=False)
+        self.assertEqual(len(stats), 2)
+        series_stats = stats[(10000068, 34)]
+        self.assertEqual(len(series_stats), 6)
+        assert_values(series_stats.moving_average,
+                      [None, 10.5, 5.5, 5.0, 10.5, 11.55])
+        # (10 * 1 + 11 * 2) / 3, and so on.
+        assert_values(series_stats.vwap,
+                      [None, 32.0 / 3, 22.0 / 5, 40.0 / 7, 95.0 / 9,
+                       127.6 / 11])
+        assert_values(series_stats.range_low, [None, 10, -2, -2, 7, 7])
+        assert_values(series_stats.range_high, [None, 12, 12, 13, 15, 17.1])
+        # +10% then -100%, undefined changes from a zero price, then a
+        # steady +10%.
+        assert_values(series_stats.volatility,
+                      [None, None, 0.55, None, None, 0.0])
+
+        # Too short for a window of 3.
+        stats = compute_rolling_stats(store, window=3, use_numpy=False)
+        assert_values(stats[(10000068, 35)].vwap, [None, None])
+
+        if history_stats.numpy is not None:
+            for window in (1, 2, 3):
+                stats = compute_rolling_stats(
+                    store, window=window, use_numpy=False)
+                numpy_stats = compute_rolling_stats(
+                    store, window=window, use_numpy=True)
+                for key, series_stats in stats.items():
+                    for name in SeriesStats.STATS:
+                        assert_values(
+                            getattr(numpy_stats[key], name),
+                            [None if value != value else value
+                             for value in getattr(series_stats, name)])
+
+    @unittest.skipIf(history_stats.numpy is None, 'NumPy is not installed.')
+    def test_numpy_mixed_magnitudes(self):
+        """
+        Cheap items that come after very expensive ones get the same stats
+        from the NumPy version as from the pure Python one.
+        """
+        generated_at = now_dtime_in_utc()
+        history_list = MarketHistoryList()
+        for type_id, scale in ((34, 1e9), (35, 0.01), (36, 1e9), (37, 1.0)):
+            for day in range(30):
+                price = scale * (1 + (day * 7 % 11) / 10.0)
+                history_list.add_entry(MarketHistoryEntry(
+                    type_id=type_id,
+                    region_id=10000068,
+                    historical_date=datetime.datetime(
+                        2012, 6, day + 1, tzinfo=UTC_TZINFO),
+                    num_orders=5,
+                    low_price=price * 0.9,
+                    high_price=price * 1.1,
+                    average_price=price,
+                    total_quantity=int(1e6 / scale) + day,
+                    generated_at=generated_at,
+                ))
+        store = HistoryStore()
+        store.upsert_history_list(history_list)
+
+        stats = compute_rolling_stats(store, window=5, use_numpy=False)
+        numpy_stats = compute_rolling_stats(store, window=5, use_numpy=True)
+        for key, series_stats in stats.items():
+            for name in SeriesStats.STATS:
+                for value, numpy_value in zip(
+                        getattr(series_stats, name),
+                        getattr(numpy_stats[key], name)):
+                    if value != value:
+                        self.assertTrue(numpy_value != numpy_value)
+                    else:
+                        self.assertTrue(
+                            abs(value - numpy_value) <= 1e-9 * abs(value),
+                            '%s %s: %r != %r' % (
+                                key, name, value, numpy_value))
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        generated_at = now_dtime_in_utc()
+        self.messages = []
+        for order_id in range(1, 6):
+            order_list = MarketOrderList()
+            order_list.add_order(MarketOrder(
+                order_id=order_id,
+                is_bid=True,
+                region_id=10000068,
+                solar_system_id=30005316,
+                station_id=60011521,
+                type_id=34,
+                price=10.0,
+                volume_entered=10,
+                volume_remaining=10,
+                minimum_volume=1,
+                order_issue_date=generated_at,
+                order_duration=90,
+                order_range=5,
+                generated_at=generated_at
+            ))
+            self.messages.append(unified.encode_to_compressed(order_list))
+        # These should be skipped. The last two are valid JSON, but one
+        # repeats a region+type rowset, and the other lacks a generatedAt.
+        self.messages.insert(2, zlib.compress('garbage'))
+        duplicated = json.loads(unified.encode_to_json(order_list))
+        duplicated['rowsets'].append(duplicated['rowsets'][0])
+        self.messages.insert(4, zlib.compress(json.dumps(duplicated)))
+        undated = json.loads(unified.encode_to_json(order_list))
+        del undated['rowsets'][0]['generatedAt']
+        self.messages.insert(1, zlib.compress(json.dumps(undated)))
+
+    def _run(self, transport, **kwargs):
+        received = []
+        pipeline = Pipeline(transport, received.append, queue_size=2,
+                            **kwargs)
+        pipeline.run()
+        self.assertEqual(pipeline.received_count, 8)
+        self.assertEqual(pipeline.parsed_count, 5)
+        self.assertEqual(pipeline.invalid_count, 3)
+        # Results come out in the order they went in.
+        self.assertEqual(
+            [next(order_list.get_all_orders_ungrouped()).order_id
+             for order_list in received], [1, 2, 3, 4, 5])
+
+    def test_in_process(self):
+        self._run(ReplayTransport(self.messages), workers=0)
+
+    def test_worker_pool(self):
+        fobj = StringIO()
+        write_replay_file(self.messages, fobj)
+        fobj.seek(0)
+        self._run(ReplayTransport.from_file(fobj), workers=2)
+
+    def test_sink_errors(self):
+        """
+        Exceptions raised by the sink should stop the pipeline, and be
+        re-raised.
+        """
+        def sink(market_list):
+            raise ValueError('Broken sink.')
+
+        pipeline = Pipeline(ReplayTransport(self.messages), sink, workers=0)
+        self.assertRaises(ValueError, pipeline.run)
+
+    def test_dead_worker(self):
+        """
+        A worker process dying mid-message should stop the pipeline, rather
+        than leave it waiting forever.
+        """
+        def die(job):
+            os._exit(1)
+        # Jobs are pickled by name, and the workers are forked, so they
+        # pick this up in place of the real thing.
+        die.__name__ = '_parse_to_columns'
+        die.__module__ = batch.__name__
+        parse_to_columns = batch._parse_to_columns
+        batch._parse_to_columns = die
+        try:
+            pipeline = Pipeline(
+                ReplayTransport(self.messages), lambda market_list: None,
+                workers=1)
+            self.assertRaises(WorkerError, pipeline.run)
+        finally:
+            batch._parse_to_columns = parse_to_columns
+
+
+class ShardedWorkerPoolTestCase(unittest.TestCase):
+
+    def test_sharding(self):
+        """
+        Updates should land on the shard that owns their region+item combo,
+        and queries should see them.
+        """
+        generated_at = now_dtime_in_utc()
+        order_list = MarketOrderList()
+        for order_id, type_id in enumerate((34, 35, 36, 37, 34), 1):
+            order_list.add_order(MarketOrder(
+                order_id=order_id,
+                is_bid=True,
+                region_id=10000068,
+                solar_system_id=30005316,
+                station_id=60011521,
+                type_id=type_id,
+                price=10.0,
+                volume_entered=10,
+                volume_remaining=10,
+                minimum_volume=1,
+                order_issue_date=generated_at,
+                order_duration=90,
+                order_range=5,
+                generated_at=generated_at
+            ))
+
+        with ShardedWorkerPool(OrderState, workers=2) as pool:
+            pool.submit_list(order_list)
+            self.assertEqual(sum(pool.query('__len__')), 5)
+            group = pool.query_group(
+                10000068, 34, 'get_group', 10000068, 34)
+            self.assertEqual(sorted([order.order_id for order in group]),
+                             [1, 5])
+            # Only the owning shard has it.
+            shard = pool.get_shard(10000068, 34)
+            groups = pool.query('get_group', 10000068, 34)
+            self.assertEqual(
+                [index for index, group in enumerate(groups)
+                 if group is not None], [shard])
+            self.assertRaises(ShardError, pool.query, 'no_such_method')
+            # Results that can't be pickled are reported, too.
+            self.assertRaises(ShardError, pool.query,
+                              '__getattribute__', 'merge')
+            self.assertEqual(pool.get_failed_update_counts(), [0, 0])
+
+            # OrderState can't merge history, so the update fails.
+            history_list = MarketHistoryList()
+            history_list.add_entry(MarketHistoryEntry(
+                type_id=34,
+                region_id=10000068,
+                historical_date=generated_at,
+                num_orders=5,
+                low_price=5.0,
+                high_price=10.0,
+                average_price=7.5,
+                total_quantity=100,
+                generated_at=generated_at,
+            ))
+            pool.submit_list(history_list)
+            self.assertEqual(sum(pool.get_failed_update_counts()), 1)
+            self.assertEqual(sum(pool.query('__len__')), 5)
+
+            # Queries to a shard that has died fail rather than hang.
+            pool._processes[shard].terminate()
+            pool._processes[shard].join()
+            self.assertRaises(ShardError, pool.query, '__len__')
+
+
+class GeneratorTestCase(unittest.TestCase):
+    """
+    Tests for the synthetic message generator used by the benchmarks.
+    """
+
+    def test_generate_orders(self):
+        """
+        Messages are repeatable per seed, and parse back into the requested
+        number of rows.
+        """
+        message = generate_message(num_rowsets=4, rows_per_rowset=25, seed=3)
+        self.assertEqual(
+            message, generate_message(num_rowsets=4, rows_per_rowset=25,
+                                      seed=3))
+        self.assertNotEqual(
+            message, generate_message(num_rowsets=4, rows_per_rowset=25,
+                                      seed=4))
+        order_list = unified.parse_from_json(message)
+        self.assertEqual(len(order_list), 100)
+
+    def test_null_regions_and_shuffled_columns(self):
+        """
+        Null regions and shuffled columns survive the round trip.
+        """
+        message = generate_message(
+            'history', num_rowsets=5, rows_per_rowset=10,
+            null_region_ratio=1.0, shuffle_columns=True)
+        history_list = unified.parse_from_json(message)
+        self.assertEqual(len(history_list), 50)
+        self.assertEqual(
+            set([group.region_id for group in history_list.iter_groups()]),
+            set([None]))
+        self.assertRaises(ValueError, generate_message, 'bogus')
@@ -8,7 +8,6 @@ Requirements
 
 * pyzmq
 """
-import zlib
 import zmq
 from emds.formats import unified
 
@@ -25,9 +24,9 @@ subscriber.setsockopt(zmq.SUBSCRIBE, "")
 print("Connected to %s" % receiver_uri)
 
 while True:
-    # Receive raw market JSON strings.
-    market_json = zlib.decompress(subscriber.recv())
-    market_list = unified.parse_from_json(market_json)
+    # Receive compressed market JSON strings, and decompress them as they
+    # are parsed.
+    market_list = unified.parse_from_compressed(subscriber.recv())
 
     # If you want to see the string representation for everything coming
     # down the pipe, this is how.
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+"""
+Like emdr_parser.py, but receiving, parsing, and handling messages are done
+in separate stages, so that a slow consumer doesn't hold up receiving.
+Parsing is done in a pool of worker processes.
+
+Requirements
+------------
+
+* pyzmq
+"""
+from emds.pipeline import Pipeline, ZmqTransport
+
+receiver_uri = 'tcp://relay-linode-atl-1.eve-emdr.com:8050'
+
+def sink(market_list):
+    if market_list.list_type == 'orders':
+        # This is a market order message.
+        print "* Recieved Orders from: %s" % market_list.order_generator
+    else:
+        # This is a history message.
+        print "* Received History from: %s" % market_list.history_generator
+
+print("Connecting to %s" % receiver_uri)
+Pipeline(ZmqTransport(receiver_uri), sink).run()